@@ -60,6 +60,23 @@ def py_eval(user, verb, data, interface):
     chat.send_message(val)
 
 
+@commander_only
+def memory(speaker, verb, data, interface):
+    """memory - Report chunk storage per dimension"""
+    for line in interface.world.memory_report():
+        log.msg(line)
+        interface.world.chat.send_message(line)
+
+
+@commander_only
+def paths(speaker, verb, data, interface):
+    """paths - Report the path cache of the current dimension and the path workers"""
+    for line in (interface.world.dimension.path_cache.report(),
+                 interface.world.path_service.report()):
+        log.msg(line)
+        interface.world.chat.send_message(line)
+
+
 class PluginBehaviour(BehaviourBase):
     pass
 
@@ -82,6 +99,8 @@ verbs = {
     "eid": eid,
     "neighbors": neighbors,
     "eval": py_eval,
+    "memory": memory,
+    "paths": paths,
     "longmsg": longmsg,
     "exception": exception,
     }
@@ -9,7 +9,7 @@ from twisted.internet import reactor
 from twisted.internet.protocol import Protocol, Factory
 from twisted.internet.endpoints import TCP4ServerEndpoint, TCP4ClientEndpoint
 
-from twistedbot.packets import make_packet, parse_packets, packets
+from twistedbot.packets import make_packet, PacketBuffer, packets
 from twistedbot import encryption
 from twistedbot import logbot
 
@@ -33,10 +33,10 @@ class ProxyProtocol(Protocol):
     def parse_encrypted_stream(self, bytestream):
         plaintext = self.decipher.decrypt(bytestream)
         self.opposite_proxy_side.protocol.sendData(plaintext)
-        data = self.leftover + plaintext
-        parsed_packets, self.leftover = parse_packets(data)
+        self.buffer.feed(plaintext)
+        parsed_packets = self.buffer.parse()
         processor.process_packets(self.mgsside, parsed_packets,
-                                  encrypted=True, leftover=self.leftover)
+                                  encrypted=True)
 
     def start_encryption(self):
         self.encryption_on = True
@@ -50,7 +50,7 @@ class ProxyServerProtocol(ProxyProtocol):
         self.factory = factory
         self.encryption_on = False
         self.parser = self.parse_stream
-        self.leftover = ""
+        self.buffer = PacketBuffer()
         self.mgsside = self.factory.mgsside
         self.log = self.factory.log
         self.opposite_proxy_side = self.factory.proxyclient
@@ -64,10 +64,10 @@ class ProxyServerProtocol(ProxyProtocol):
         self.factory.proxyclient.protocol.transport.loseConnection()
 
     def parse_stream(self, bytestream):
-        data = self.leftover + bytestream
-        parsed_packets, self.leftover = parse_packets(data)
-        processor.process_packets(
-            self.mgsside, parsed_packets, leftover=self.leftover)
+        self.buffer.feed(bytestream)
+        data = self.buffer.leftover
+        parsed_packets = self.buffer.parse()
+        processor.process_packets(self.mgsside, parsed_packets)
         for p in parsed_packets:
             if p[0] == 253:
                 self.on_encryption_key_request(p[1])
@@ -151,7 +151,7 @@ class ProxyClientProtocol(ProxyProtocol):
         self.factory = factory
         self.encryption_on = False
         self.parser = self.parse_stream
-        self.leftover = ""
+        self.buffer = PacketBuffer()
         self.mgsside = self.factory.mgsside
         self.log = self.factory.log
         self.proxyserver = ProxyServerFactory(self.factory)
@@ -173,12 +173,12 @@ class ProxyClientProtocol(ProxyProtocol):
         if self.proxyserver.protocol is None:
             self.log.msg(
                 "Not having connection to server yet, postpone proxying")
-            self.leftover += bytestream
+            self.buffer.feed(bytestream)
             return
-        data = self.leftover + bytestream
-        parsed_packets, self.leftover = parse_packets(data)
-        processor.process_packets(
-            self.mgsside, parsed_packets, leftover=self.leftover)
+        self.buffer.feed(bytestream)
+        data = self.buffer.leftover
+        parsed_packets = self.buffer.parse()
+        processor.process_packets(self.mgsside, parsed_packets)
         for p in parsed_packets:
             if p[0] == 252:
                 self.on_encryption_key_responce(p[1])
@@ -0,0 +1,117 @@
+"""
+Payloads for the entries of the packet table, for the packet layer tests.
+
+The payloads are built by walking the construct definitions: integers are
+2, so that counted arrays and length prefixed fields are not empty, floats
+are 1.5, flags are True and strings are two characters. The bytes of a
+packet are built by construct, not by the codecs under test.
+"""
+
+from StringIO import StringIO
+
+import syspath_fix
+syspath_fix.update_sys_path()
+
+from construct import Container, Construct, FormatField, StaticField, MetaField
+from construct import MetaArray, Struct, Switch, Value, Adapter, Reconfig
+from construct.adapters import MappingAdapter
+from pynbt import NBTFile, TAG_Short, TAG_String
+
+from twistedbot import packets
+from twistedbot.packetcodec import CodecGenerator
+from twistedbot.packets import LazyNBT, Metadata, entity_metadata, slotdata
+
+
+def gzipped_nbt():
+    nbt = NBTFile(name="tag")
+    nbt["Damage"] = TAG_Short(5)
+    nbt["Name"] = TAG_String(u"pick")
+    sio = StringIO()
+    nbt.save(io=sio, compression=NBTFile.Compression.GZIP)
+    return sio.getvalue()
+
+
+NBT = gzipped_nbt()
+
+
+def slot():
+    return Container(id=1, count=2, damage=3, size=len(NBT), data=LazyNBT(NBT))
+
+
+def metadata():
+    """ one entry of every metadata type """
+    return {0: Metadata("byte", -2), 1: Metadata("short", 300),
+            2: Metadata("int", -70000), 3: Metadata("float", 1.5),
+            4: Metadata("string16", u"n\xe4me"), 5: Metadata("slotdata", slot()),
+            6: Metadata("int_tup", Container(x=1, y=-2, z=3))}
+
+
+# packet id -> fields the generic values do not fit
+overrides = {
+    0x84: lambda: {"size": len(NBT), "nbt": LazyNBT(NBT)},
+}
+
+_codec = CodecGenerator({})
+
+
+def _fill(con, obj, fixed):
+    for sc in con.subcons:
+        if sc.conflags & Construct.FLAG_EMBED:
+            _embedded(sc, obj, fixed)
+        elif isinstance(sc, Value):
+            obj[sc.name] = sc.func(obj)
+        elif sc.name in fixed:
+            obj[sc.name] = fixed[sc.name]
+        else:
+            obj[sc.name] = _value(sc, obj, fixed)
+    return obj
+
+
+def _embedded(con, obj, fixed):
+    while isinstance(con, Reconfig):
+        con = con.subcon
+    if isinstance(con, Struct):
+        _fill(con, obj, fixed)
+    elif isinstance(con, Switch):
+        _embedded(con.cases.get(con.keyfunc(obj), con.default), obj, fixed)
+
+
+def _value(con, ctx, fixed):
+    if con is slotdata:
+        return slot()
+    if con is entity_metadata:
+        return metadata()
+    if isinstance(con, MappingAdapter):
+        return True if True in con.encoding else sorted(con.encoding)[0]
+    if isinstance(con, FormatField):
+        return 1.5 if con.packer.format[1:] in "fd" else 2
+    if isinstance(con, StaticField):
+        return "x" * con.length
+    if isinstance(con, MetaField):
+        return "x" * con.lengthfunc(ctx)
+    if isinstance(con, Struct):
+        return _fill(con, Container(), fixed)
+    if isinstance(con, Switch):
+        return _value(con.cases.get(con.keyfunc(ctx), con.default), ctx, fixed)
+    if isinstance(con, MetaArray):
+        return [_value(con.subcon, ctx, fixed) for _ in xrange(con.countfunc(ctx))]
+    if _codec.is_length_string(con):
+        return u"ab" if con.encoding else "ab"
+    if _codec.is_bit_struct(con):
+        return Container(**dict((sc.name, 1) for sc in con.subcon.subcons))
+    if isinstance(con, (Adapter, Reconfig)):
+        return _value(con.subcon, ctx, fixed)
+    raise NotImplementedError("no sample for %s" % con)
+
+
+def payload(pid):
+    """ Container for the packet pid """
+    fixed = overrides[pid]() if pid in overrides else {}
+    return _fill(packets.packets[pid], Container(), fixed)
+
+
+def packet(pid, obj=None):
+    """ bytes of the packet pid, header included """
+    if obj is None:
+        obj = payload(pid)
+    return chr(pid) + packets.packets[pid].build(obj)
@@ -0,0 +1,60 @@
+import unittest
+
+import syspath_fix
+syspath_fix.update_sys_path()
+
+from twisted.python import log
+
+from twistedbot.chunkpipeline import ChunkPipeline
+
+
+class ChunkPipelineTest(unittest.TestCase):
+
+    def setUp(self):
+        self.errors = []
+        self.observer = lambda event: event.get("header") == "CHUNKS" and \
+            event.get("isError") and self.errors.append(event)
+        log.addObserver(self.observer)
+
+    def tearDown(self):
+        log.removeObserver(self.observer)
+
+    def test_failing_job_is_logged_and_the_rest_applied(self):
+        pipeline = ChunkPipeline()
+        applied = []
+
+        def fail():
+            raise ValueError("bad chunk")
+        pipeline._queue(fail, [], ready=True)
+        pipeline._queue(applied.append, [1], ready=True)
+        pipeline._queue(applied.append, [2], ready=True)
+        pipeline.flush()
+        self.assertEqual(applied, [1, 2])
+        self.assertFalse(pipeline.busy)
+        self.assertEqual(len(self.errors), 1)
+
+    def test_call_waits_for_pending_chunks(self):
+        pipeline = ChunkPipeline()
+        applied = []
+        job = pipeline._queue(lambda name, sections: applied.append(name), ["chunk"])
+        pipeline.call(applied.append, "block")
+        self.assertEqual(applied, [])
+        pipeline._decoded(([], 0.0), job)
+        self.assertEqual(applied, ["chunk", "block"])
+        self.assertFalse(pipeline.busy)
+
+    def test_reset_drops_queued_jobs(self):
+        pipeline = ChunkPipeline()
+        applied = []
+        job = pipeline._queue(lambda sections: applied.append(sections), [])
+        pipeline.call(applied.append, "block")
+        pipeline.reset()
+        self.assertFalse(pipeline.busy)
+        pipeline._decoded(([], 0.0), job)
+        self.assertEqual(applied, [])
+        pipeline.call(applied.append, "next")
+        self.assertEqual(applied, ["next"])
+
+
+if __name__ == "__main__":
+    unittest.main()
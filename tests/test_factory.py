@@ -0,0 +1,52 @@
+import unittest
+
+import syspath_fix
+syspath_fix.update_sys_path()
+
+from twistedbot.factory import MineCraftProtocol
+
+
+class World(object):
+    pass
+
+
+class Buffer(object):
+    """ hands out the packets the test gives it """
+
+    def __init__(self, packets):
+        self.packets = packets
+
+    def feed(self, data):
+        pass
+
+    def parse(self):
+        packets, self.packets = self.packets, []
+        return packets
+
+
+class PacketOrderTest(unittest.TestCase):
+
+    def handle(self, packets):
+        protocol = MineCraftProtocol(World())
+        handled = []
+        protocol.router = dict((pid, lambda c, pid=pid: handled.append(pid))
+                               for pid, _ in packets)
+        protocol.buffer = Buffer(packets)
+        protocol.parse_stream("")
+        return handled
+
+    def test_confirm_transaction_follows_the_slot_updates(self):
+        handled = self.handle([(0x67, None), (0x68, None), (0x6a, None), (0x0d, None)])
+        self.assertEqual(handled, [0x0d, 0x67, 0x68, 0x6a])
+
+    def test_respawn_waits_for_the_queued_packets(self):
+        handled = self.handle([(0x35, None), (0x67, None), (0x09, None), (0x0d, None)])
+        self.assertEqual(handled, [0x67, 0x35, 0x09, 0x0d])
+
+    def test_skipped_packets_are_not_queued(self):
+        queued = MineCraftProtocol.high_priority_packets | MineCraftProtocol.low_priority_packets
+        self.assertFalse(queued & MineCraftProtocol.skip_packets)
+
+
+if __name__ == "__main__":
+    unittest.main()
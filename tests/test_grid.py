@@ -0,0 +1,256 @@
+import marshal
+import shutil
+import tempfile
+import unittest
+import zlib
+from StringIO import StringIO
+
+import syspath_fix
+syspath_fix.update_sys_path()
+
+from twistedbot import blocks, config, grid as grid_module
+from twistedbot.axisbox import AABB
+from twistedbot.chunkcache import ChunkCache
+from twistedbot.grid import Grid, Chunk, NumpyChunk, numpy
+
+
+def chunk_data(block_data, meta_data, add_data=None):
+    """ packet data of a chunk with one section at level 0, biome included """
+    data = block_data + meta_data + "\0" * 2048 * 2
+    if add_data is not None:
+        data += add_data
+    return data + "\0" * 256
+
+
+def make_grid(chunk_class):
+    grid = Grid(None)
+    grid.chunk_class = chunk_class
+    return grid
+
+
+chunk_classes = [Chunk] if numpy is None else [Chunk, NumpyChunk]
+
+
+class AddDataTest(unittest.TestCase):
+
+    def test_add_data_is_dropped(self):
+        ids = "".join(chr(i % 100) for i in xrange(4096))
+        meta = "\x21" * 2048
+        for chunk_class in chunk_classes:
+            plain = make_grid(chunk_class)
+            plain._load_chunk(0, 0, True, 1, 0, StringIO(chunk_data(ids, meta)))
+            grid = make_grid(chunk_class)
+            grid._load_chunk(0, 0, True, 1, 1, StringIO(chunk_data(ids, meta, "\xff" * 2048)))
+            for x, y, z in [(0, 0, 0), (3, 5, 7), (15, 15, 15), (8, 1, 2)]:
+                self.assertEqual(grid.get_block_type(x, y, z), plain.get_block_type(x, y, z))
+                self.assertTrue(grid.get_block_type(x, y, z)[0] < 256)
+                self.assertEqual(grid.get_block_flags(x, y, z), plain.get_block_flags(x, y, z))
+                self.assertEqual(str(grid.get_block(x, y, z)), str(plain.get_block(x, y, z)))
+            self.assertEqual(grid.walkability.section(0, 0, 0), plain.walkability.section(0, 0, 0))
+
+    def test_uniform_section_with_add_data(self):
+        for chunk_class in chunk_classes:
+            grid = make_grid(chunk_class)
+            grid._load_chunk(0, 0, True, 1, 1, StringIO(chunk_data("\x01" * 4096, "\0" * 2048, "\x11" * 2048)))
+            self.assertEqual(grid.get_block_type(4, 4, 4), (1, 0))
+            self.assertEqual(grid.get_block_flags(4, 4, 4), blocks.block_flags[1 << 4])
+
+
+def mixed_section():
+    ids = "".join(chr((i * 7) % 90) for i in xrange(4096))
+    meta = "".join(chr((i * 13) % 256) for i in xrange(2048))
+    return ids, meta
+
+
+def standing_box(x, y, z):
+    return AABB(x + 0.2, y, z + 0.2, x + 0.8, y + 1.8, z + 0.8)
+
+
+class SectionStorageTest(unittest.TestCase):
+
+    def test_mixed_section_takes_the_packet_size(self):
+        ids, meta = mixed_section()
+        for chunk_class in chunk_classes:
+            grid = make_grid(chunk_class)
+            grid._load_chunk(0, 0, True, 1, 0, StringIO(chunk_data(ids, meta)))
+            self.assertEqual(grid.get_chunk((0, 0)).nbytes(), 4096 + 2048)
+
+    def test_few_types_are_kept_compact(self):
+        ids = "".join(chr((1, 3, 4, 13)[i % 4]) for i in xrange(4096))
+        meta = "".join(("\0", "\x10")[i % 2] for i in xrange(2048))
+        for chunk_class in chunk_classes:
+            grid = make_grid(chunk_class)
+            # sections 0 and 1, block ids of both come before their meta
+            data = ids + "\x01" * 4096 + meta + "\0" * 2048 + "\0" * 2048 * 4 + "\0" * 256
+            grid._load_chunk(0, 0, True, 3, 0, StringIO(data))
+            chunk = grid.get_chunk((0, 0))
+            self.assertEqual(chunk.section_info(0), [("palette", 1024 + 4), ("palette", 256 + 2)])
+            self.assertEqual(chunk.section_info(1), [("uniform", 0), ("uniform", 0)])
+            self.assertEqual(chunk.nbytes(), 1286)
+            self.assertEqual(grid.get_block_type(1, 0, 0), (3, 0))
+            self.assertEqual(grid.get_block_type(3, 0, 0), (13, 1))
+            self.assertEqual(grid.get_block_type(1, 16, 0), (1, 0))
+            grid.change_block_to(1, 16, 0, 2, 5)
+            self.assertEqual(chunk.section_info(1)[0], ("dense", 4096))
+            self.assertEqual(grid.get_block_type(1, 16, 0), (2, 5))
+            self.assertEqual(grid.get_block_type(2, 16, 0), (1, 0))
+
+    def test_writes_match_between_classes(self):
+        ids, meta = mixed_section()
+        writes = [(5, 6, 7, 4, 9), (5, 6, 7, 3, 2), (6, 6, 7, 1, 15), (0, 0, 0, 89, 1)]
+        grids = []
+        for chunk_class in chunk_classes:
+            for data in (chunk_data(ids, meta), chunk_data("\x01" * 4096, "\0" * 2048)):
+                grid = make_grid(chunk_class)
+                grid._load_chunk(0, 0, True, 1, 0, StringIO(data))
+                grid.change_blocks(writes[:2])
+                grid.change_block_to(*writes[2])
+                grid.change_blocks(writes[3:])
+                grids.append(grid)
+        for x, y, z in [(5, 6, 7), (6, 6, 7), (0, 0, 0), (7, 6, 7), (4, 6, 7)]:
+            self.assertEqual(len(set(grid.get_block_type(x, y, z) for grid in grids[0::2])), 1)
+            self.assertEqual(len(set(grid.get_block_type(x, y, z) for grid in grids[1::2])), 1)
+        self.assertEqual(grids[0].get_block_type(5, 6, 7), (3, 2))
+        self.assertEqual(grids[1].get_block_type(6, 6, 7), (1, 15))
+        self.assertEqual(grids[1].get_block_type(7, 6, 7), (1, 0))
+
+
+class BudgetTest(unittest.TestCase):
+
+    def test_byte_budget_keeps_the_nearest_chunks(self):
+        ids, meta = mixed_section()
+        for chunk_class in chunk_classes:
+            grid = make_grid(chunk_class)
+            for x in xrange(-3, 4):
+                grid._load_chunk(x, 0, True, 1, 0, StringIO(chunk_data(ids, meta)))
+            chunk = grid.get_chunk((0, 0))
+            size = chunk.memory_estimate()
+            self.assertTrue(size >= chunk.nbytes() + grid_module.CHUNK_OBJECT_BYTES + 256)
+            grid.enforce_budget((0, 0), max_bytes=size * 3, keep_radius=0)
+            self.assertEqual(sorted(grid.chunks), [(-1, 0), (0, 0), (1, 0)])
+            self.assertEqual(len(grid.evicted), 4)
+
+
+class CollisionTest(unittest.TestCase):
+
+    def test_heightmap_shortcut_matches_the_blocks(self):
+        for chunk_class in chunk_classes:
+            grid = make_grid(chunk_class)
+            grid._load_chunk(0, 0, True, 1, 0, StringIO(chunk_data("\x01" * 256 + "\0" * 3840, "\0" * 2048)))
+            grid.change_block_to(5, 3, 5, blocks.Fence.number, 0)
+            boxes = [standing_box(x, y, z) for x, y, z in
+                     [(2, 1, 2), (2, 1.5, 2), (2, 2.2, 2), (5, 4, 5), (5, 4.6, 5), (5, 5.1, 5), (4.6, 6, 4.6)]]
+            for bb in boxes:
+                expected = []
+                for blk in grid.blocks_in_aabb(bb.extend_to(0, -1, 0)):
+                    blk.add_grid_bounding_boxes_to(expected)
+                self.assertEqual([str(b) for b in grid.collision_aabbs_in(bb)], [str(b) for b in expected])
+            self.assertTrue(grid.above_solid(boxes[2].extend_to(0, -1, 0)))
+            self.assertFalse(grid.above_solid(boxes[3].extend_to(0, -1, 0)))
+            self.assertFalse(grid.aabb_collides(boxes[2]))
+            self.assertTrue(grid.aabb_collides(boxes[3]))
+
+
+class RegionTest(unittest.TestCase):
+
+    def test_region_without_numpy(self):
+        ids, meta = mixed_section()
+        grid = make_grid(Chunk)
+        grid._load_chunk(0, 0, True, 1, 0, StringIO(chunk_data(ids, meta)))
+        box = (-2, -1, 3, 5, 18, 17)
+        saved = grid_module.numpy
+        grid_module.numpy = None
+        try:
+            region_ids, region_meta = grid.get_region(*box)
+        finally:
+            grid_module.numpy = saved
+        self.assertEqual((len(region_ids), len(region_ids[0]), len(region_ids[0][0])), (7, 19, 14))
+        for x, y, z in [(-2, -1, 3), (0, 0, 3), (4, 15, 16), (3, 2, 4), (4, 17, 9)]:
+            block_type, block_meta = grid.get_block_type(x, y, z)
+            self.assertEqual(region_ids[x + 2][y + 1][z - 3], block_type)
+            self.assertEqual(region_meta[x + 2][y + 1][z - 3], block_meta)
+        if numpy is not None:
+            numpy_ids, numpy_meta = grid.get_region(*box)
+            self.assertEqual(numpy_ids.tolist(), region_ids)
+            self.assertEqual(numpy_meta.tolist(), region_meta)
+
+
+class StaleChunksTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_stale_chunks_are_not_complete(self):
+        grid = make_grid(Chunk)
+        grid._load_chunk(0, 0, True, 1, 0, StringIO(chunk_data("\x01" * 4096, "\0" * 2048)))
+        bb = standing_box(4, 1, 4)
+        self.assertTrue(grid.aabb_in_complete_chunks(bb))
+        grid.mark_stale()
+        self.assertTrue(grid.get_chunk((0, 0)).stale)
+        self.assertFalse(grid.chunk_complete_at(4, 4))
+        self.assertFalse(grid.aabb_in_complete_chunks(bb))
+        grid._load_chunk(0, 0, True, 1, 0, StringIO(chunk_data("\x01" * 4096, "\0" * 2048)))
+        self.assertTrue(grid.aabb_in_complete_chunks(bb))
+
+    def test_cached_chunks_are_not_complete_after_restart(self):
+        ids, meta = mixed_section()
+        grid = make_grid(Chunk)
+        grid.cache = ChunkCache(self.directory)
+        grid._load_chunk(0, 0, True, 1, 0, StringIO(chunk_data(ids, meta)))
+        grid.dirty.add((0, 0))
+        grid.save_dirty()
+        grid.cache.close()
+        grid = make_grid(Chunk)
+        grid.cache = ChunkCache(self.directory)
+        self.assertEqual(grid.get_block_type(3, 2, 1), (ord(ids[2 * 256 + 16 + 3]), ord(meta[(2 * 256 + 16 + 3) / 2]) >> 4))
+        self.assertTrue(grid.get_chunk((0, 0)).stale)
+        self.assertFalse(grid.aabb_in_complete_chunks(standing_box(3, 2, 1)))
+        grid.cache.close()
+
+    def test_evicted_stale_chunk_stays_stale(self):
+        saved = config.COMPRESS_EVICTED_CHUNKS
+        config.COMPRESS_EVICTED_CHUNKS = True
+        try:
+            grid = make_grid(Chunk)
+            grid._load_chunk(0, 0, True, 1, 0, StringIO(chunk_data("\x01" * 4096, "\0" * 2048)))
+            grid.mark_stale()
+            grid.evict_chunk((0, 0))
+            self.assertFalse(grid.chunk_complete_at(4, 4))
+            self.assertTrue(grid.get_chunk((0, 0)).stale)
+            grid._load_chunk(0, 0, True, 1, 0, StringIO(chunk_data("\x01" * 4096, "\0" * 2048)))
+            grid.evict_chunk((0, 0))
+            self.assertTrue(grid.chunk_complete_at(4, 4))
+            self.assertFalse(grid.get_chunk((0, 0)).stale)
+        finally:
+            config.COMPRESS_EVICTED_CHUNKS = saved
+
+
+class CompressTest(unittest.TestCase):
+
+    def test_compressed_chunks_read_by_either_class(self):
+        ids, meta = mixed_section()
+        for writer in chunk_classes:
+            for reader in chunk_classes:
+                grid = make_grid(writer)
+                grid._load_chunk(0, 0, True, 1, 0, StringIO(chunk_data(ids, meta)))
+                grid.change_block_to(5, 6, 7, 4, 9)
+                data = grid.get_chunk((0, 0)).compress()
+                chunk = reader.decompress((0, 0), data)
+                self.assertTrue(chunk.complete)
+                for pos in xrange(0, 4096, 37):
+                    self.assertEqual(chunk.get_block_id(0, pos), grid.get_chunk((0, 0)).get_block_id(0, pos))
+                    self.assertEqual(chunk.get_meta(0, pos), grid.get_chunk((0, 0)).get_meta(0, pos))
+                pos = 6 * 256 + 7 * 16 + 5
+                self.assertEqual((chunk.get_block_id(0, pos), chunk.get_meta(0, pos)), (4, 9))
+
+    def test_older_format_is_ignored(self):
+        data = zlib.compress(marshal.dumps((True, None, [(0, "\0" * 8192, "\0" * 4096)])))
+        for chunk_class in chunk_classes:
+            self.assertTrue(chunk_class.decompress((0, 0), data) is None)
+
+
+if __name__ == "__main__":
+    unittest.main()
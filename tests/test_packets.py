@@ -0,0 +1,320 @@
+import os
+import shutil
+import struct
+import tempfile
+import unittest
+
+import samples
+
+from construct import Container, ConstructError, MetaField, Struct, UBInt8, SBInt32
+from pynbt import TAG_Short
+
+from twistedbot import packetcodec
+from twistedbot import packets as packetmodule
+from twistedbot.packets import PacketBuffer, decoders, encoders, fast_packets, frame_scanners, packets
+from twistedbot.packets import IncompletePacket, parse_packets
+from twistedbot.packets import LazyNBT, decode_slot, encode_slot, slotdata
+from twistedbot.packets import RawMetadata, decode_metadata, encode_metadata, entity_metadata
+from twistedbot.packets import fast_client_packets, make_fast_packet, make_packet, packets_by_name
+
+
+def destroy_entity(count, eids):
+    return struct.pack(">Bb%dI" % len(eids), 0x1d, count, *eids)
+
+
+def map_chunk_bulk(count, size, data):
+    return struct.pack(">Bhi?", 0x38, count, size, True) + data
+
+
+def fields(con):
+    """ names and struct characters of the integer fields of a struct """
+    out = []
+    for sc in con.subcons:
+        if hasattr(sc, "subcons"):
+            out.extend(fields(sc))
+        else:
+            out.append((sc.name, sc.packer.format[1:]))
+    return out
+
+
+class FastDecoderTest(unittest.TestCase):
+
+    def test_fast_packets_match_construct(self):
+        for pid, (fmt, names) in fast_packets.iteritems():
+            layout = fields(packets[pid])
+            self.assertEqual(sorted(names), sorted(name for name, _ in layout))
+            obj = Container()
+            for i, (name, char) in enumerate(layout):
+                obj[name] = -i - 1 if char.islower() else i + 1
+            buf = PacketBuffer()
+            buf.feed(chr(pid) + packets[pid].build(obj))
+            self.assertEqual(buf.parse(), [(pid, obj)])
+            self.assertEqual(len(buf), 0)
+
+
+def nested(con, values):
+    """ the container of con with the values of its integer fields """
+    obj = Container()
+    for sc in con.subcons:
+        if hasattr(sc, "subcons"):
+            obj[sc.name] = nested(sc, values)
+        else:
+            obj[sc.name] = values[sc.name]
+    return obj
+
+
+class FastEncoderTest(unittest.TestCase):
+
+    def test_fast_packets_match_make_packet(self):
+        for name, (pid, fmt, names) in fast_client_packets.iteritems():
+            self.assertEqual(packets_by_name[name], pid)
+            values = [i + 0.5 if char in "fd" else i + 1 for i, char in enumerate(fmt[1:])]
+            con = packets[pid]
+            self.assertEqual(make_fast_packet(name, *values),
+                             make_packet(name, nested(con, dict(zip(names, values)))), name)
+
+
+def keep_alive(pid):
+    return "\x00" + struct.pack(">i", pid)
+
+
+def chat(message):
+    return "\x03" + packets[0x03].build(Container(message=message))
+
+
+class PacketBufferTest(unittest.TestCase):
+
+    def setUp(self):
+        self.stream = keep_alive(1) + chat(u"hello there") + keep_alive(2) + chat(u"\xe4")
+        self.expected = [(0x00, Container(pid=1)), (0x03, Container(message=u"hello there")),
+                         (0x00, Container(pid=2)), (0x03, Container(message=u"\xe4"))]
+
+    def test_packets_split_across_feeds(self):
+        buf = PacketBuffer()
+        parsed = []
+        for c in self.stream:
+            buf.feed(c)
+            parsed.extend(buf.parse())
+        self.assertEqual(parsed, self.expected)
+        self.assertEqual(len(buf), 0)
+        self.assertEqual(buf.leftover, "")
+
+    def test_incomplete_packet_waits_for_the_missing_bytes(self):
+        data = chat(u"hello there")
+        buf = PacketBuffer()
+        buf.feed(data[:5])
+        self.assertEqual(buf.parse(), [])
+        self.assertEqual(buf.missing, len(data) - 5)
+        buf.feed(data[5:-1])
+        self.assertEqual(buf.missing, 1)
+        self.assertEqual(buf.parse(), [])
+        self.assertEqual(buf.leftover, data[:-1])
+        buf.feed(data[-1:])
+        self.assertEqual(buf.parse(), [(0x03, Container(message=u"hello there"))])
+
+    def test_consumed_data_is_dropped(self):
+        buf = PacketBuffer()
+        buf.compact_size = 8
+        buf.feed(self.stream + keep_alive(3)[:2])
+        self.assertEqual(buf.parse(), self.expected)
+        self.assertEqual((buf.offset, str(buf.data)), (0, keep_alive(3)[:2]))
+        buf.feed(keep_alive(3)[2:])
+        self.assertEqual(buf.parse(), [(0x00, Container(pid=3))])
+        self.assertEqual((buf.offset, len(buf.data)), (0, 0))
+
+    def test_unknown_packet_stops_the_stream(self):
+        parsed, leftover = parse_packets(keep_alive(1) + "\x15" + keep_alive(2))
+        self.assertEqual(parsed, [(0x00, Container(pid=1))])
+        self.assertEqual(leftover, "\x15" + keep_alive(2))
+
+
+class FrameScannerTest(unittest.TestCase):
+
+    def test_every_packet_has_a_scanner(self):
+        self.assertEqual(sorted(frame_scanners), sorted(packets))
+
+    def test_scanners_find_the_end_of_the_packet(self):
+        for pid in packets:
+            data = samples.packet(pid)
+            buf = bytearray("junk" + data + "junk")
+            self.assertEqual(frame_scanners[pid](buf, 4, len(buf)), 4 + len(data), hex(pid))
+
+    def test_partial_frames_are_incomplete(self):
+        for pid in packets:
+            data = samples.packet(pid)
+            for end in xrange(1, len(data)):
+                try:
+                    frame_scanners[pid](bytearray(data[:end]), 0, end)
+                except IncompletePacket as e:
+                    self.assertTrue(end < e.needed <= len(data), (hex(pid), end, e.needed))
+                else:
+                    self.fail("%s complete at %d of %d bytes" % (hex(pid), end, len(data)))
+
+
+class CodecTest(unittest.TestCase):
+
+    def setUp(self):
+        self.saved = packetcodec.cache_name, packetcodec.cache_file, packetcodec.CodecGenerator
+        self.tmp = tempfile.mkdtemp()
+        packetcodec.cache_name = "packets_compiled_test"
+        packetcodec.cache_file = os.path.join(self.tmp, "packets_compiled_test.py")
+        self.generated = generated = []
+
+        class Generator(packetcodec.CodecGenerator):
+            def generate(self, table_hash):
+                generated.append(table_hash)
+                return super(Generator, self).generate(table_hash)
+
+        packetcodec.CodecGenerator = Generator
+        # importing the factory applies config.DECODE_ENTITY_METADATA
+        self.decode_metadata = packetmodule.decode_entity_metadata
+        packetmodule.decode_entity_metadata = True
+
+    def tearDown(self):
+        packetcodec.cache_name, packetcodec.cache_file, packetcodec.CodecGenerator = self.saved
+        packetmodule.decode_entity_metadata = self.decode_metadata
+        shutil.rmtree(self.tmp)
+
+    def test_every_packet_matches_construct(self):
+        for pid in packets:
+            obj = samples.payload(pid)
+            data = samples.packet(pid, obj)
+            parts = [chr(pid)]
+            encoders[pid](obj, parts)
+            self.assertEqual("".join(parts), data, hex(pid))
+            payload, end = decoders[pid](bytearray(data), 1)
+            self.assertEqual(end, len(data), hex(pid))
+            self.assertEqual(payload, packets[pid].parse(data[1:]), hex(pid))
+            self.assertEqual(payload, obj, hex(pid))
+
+    def test_cache_follows_the_table(self):
+        table = {0x01: Struct("data", UBInt8("n"), MetaField("data", lambda ctx: ctx.n)),
+                 0x02: Struct("int", SBInt32("value"))}
+        data = bytearray("\x01\x02abcd")
+        codec = packetcodec.load(table)
+        self.assertEqual(codec.decoders[0x01](data, 1), (Container(n=2, data="ab"), 4))
+        codec = packetcodec.load(table)
+        self.assertEqual(len(self.generated), 1)
+        table[0x01] = Struct("data", UBInt8("n"), MetaField("data", lambda ctx: ctx.n * 2))
+        codec = packetcodec.load(table)
+        self.assertEqual(len(self.generated), 2)
+        self.assertEqual(codec.decoders[0x01](data, 1), (Container(n=2, data="abcd"), 6))
+        self.assertEqual(codec.TABLE_HASH, self.generated[-1])
+
+
+class SlotTest(unittest.TestCase):
+
+    def round_trip(self, slot):
+        data = encode_slot(slot)
+        self.assertEqual(data, slotdata.build(slot))
+        decoded, end = decode_slot(bytearray(data + "junk"), 0)
+        self.assertEqual(end, len(data))
+        self.assertEqual(decoded, slotdata.parse(data))
+        return decoded
+
+    def test_slots_match_construct(self):
+        for slot in (Container(id=-1), Container(id=4, count=1, damage=0, size=-1, data=None),
+                     samples.slot()):
+            self.assertEqual(self.round_trip(slot), slot)
+
+    def test_nbt_stays_gzipped_until_read(self):
+        decoded = self.round_trip(samples.slot())
+        self.assertFalse(decoded.data.decoded)
+        self.assertEqual(decoded.data.raw, samples.NBT)
+        self.assertEqual(decoded.data["Damage"].value, 5)
+        self.assertTrue(decoded.data.decoded)
+
+    def test_changed_nbt_is_sent(self):
+        slot = samples.slot()
+        slot.data["Damage"] = TAG_Short(9)
+        decoded = self.round_trip(slot)
+        self.assertEqual(decoded.data["Damage"].value, 9)
+        self.assertEqual(decoded, slot)
+        self.assertNotEqual(decoded, samples.slot())
+
+    def test_nbt_equality(self):
+        raw, read = LazyNBT(samples.NBT), LazyNBT(samples.NBT)
+        read["Name"]
+        self.assertEqual(raw, read)
+        self.assertEqual(read, raw)
+        self.assertEqual(raw, read.nbt)
+        self.assertNotEqual(raw, samples.NBT)
+
+
+class MetadataTest(unittest.TestCase):
+
+    def setUp(self):
+        self.decode_metadata = packetmodule.decode_entity_metadata
+        self.data = entity_metadata.build(samples.metadata())
+
+    def tearDown(self):
+        packetmodule.decode_entity_metadata = self.decode_metadata
+
+    def test_metadata_matches_construct(self):
+        packetmodule.decode_entity_metadata = True
+        decoded, end = decode_metadata(bytearray(self.data + "junk"), 0)
+        self.assertEqual(end, len(self.data))
+        self.assertEqual(decoded, entity_metadata.parse(self.data))
+        self.assertEqual(decoded, samples.metadata())
+        self.assertEqual(encode_metadata(decoded), self.data)
+
+    def test_raw_metadata(self):
+        packetmodule.decode_entity_metadata = False
+        raw, end = decode_metadata(bytearray(self.data + "junk"), 0)
+        self.assertEqual(end, len(self.data))
+        self.assertEqual(raw, RawMetadata(self.data))
+        self.assertEqual(raw.decode(), samples.metadata())
+        self.assertEqual(encode_metadata(raw), self.data)
+
+    def test_raw_metadata_in_a_packet(self):
+        packetmodule.decode_entity_metadata = False
+        buf = PacketBuffer()
+        buf.feed("\x28" + struct.pack(">I", 9) + self.data)
+        self.assertEqual(buf.parse(), [(0x28, Container(eid=9, metadata=RawMetadata(self.data)))])
+
+
+class MalformedFrameTest(unittest.TestCase):
+
+    def assertScanFails(self, data):
+        buf = bytearray(data)
+        self.assertRaises(ConstructError, frame_scanners[buf[0]], buf, 0, len(buf))
+
+    def assertDecodeFails(self, data):
+        buf = bytearray(data)
+        self.assertRaises(ConstructError, decoders[buf[0]], buf, 1)
+
+    def assertStreamStops(self, data):
+        buf = PacketBuffer()
+        buf.feed(keep_alive(7) + data + keep_alive(7))
+        parsed = buf.parse()
+        self.assertEqual([header for header, _ in parsed], [0x00])
+        self.assertEqual(buf.leftover, data + keep_alive(7))
+
+    def test_negative_count(self):
+        data = destroy_entity(-1, [1, 2])
+        self.assertScanFails(data)
+        self.assertDecodeFails(data)
+        self.assertStreamStops(data)
+
+    def test_negative_length(self):
+        data = map_chunk_bulk(0, -3, "\x01\x02\x03")
+        self.assertScanFails(data)
+        self.assertDecodeFails(data)
+        self.assertStreamStops(data)
+
+    def test_unknown_metadata_type(self):
+        data = "\x28" + struct.pack(">I", 1) + "\xe0\x01\x7f"
+        self.assertScanFails(data)
+        self.assertDecodeFails(data)
+        self.assertStreamStops(data)
+
+    def test_negative_string_length(self):
+        data = "\xfa" + struct.pack(">H", 2) + u"mc".encode("utf-16-be") + \
+            struct.pack(">h", -1) + "abc"
+        self.assertScanFails(data)
+        self.assertDecodeFails(data)
+        self.assertStreamStops(data)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,217 @@
+import random
+import unittest
+from StringIO import StringIO
+
+from tests import worlds
+from twistedbot import config, utils
+from twistedbot.pathfinding import AStar, PathCache, IncrementalPlanner
+
+
+def crds_of(path):
+    return [node.coords.tuple for node in path.nodes]
+
+
+class PathCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dimension = worlds.make_dimension(radius=2, pillars=0, walls=False)
+        self.cache = PathCache(self.dimension)
+        self.start = utils.Vector(-20, 1, 0)
+        self.goal = utils.Vector(20, 1, 3)
+        self.path = worlds.run(AStar(dimension=self.dimension, start_coords=self.start,
+                                     end_coords=self.goal, estimate=False)).path
+        self.cache.put(self.start, self.goal, False, self.path)
+
+    def test_exact_hit_is_a_copy(self):
+        path = self.cache.get(self.start, self.goal, False)
+        self.assertEqual(crds_of(path), crds_of(self.path))
+        path.remove_last(2)
+        path.take_step()
+        again = self.cache.get(self.start, self.goal, False)
+        self.assertEqual(len(again), len(self.path))
+        self.assertEqual(again.node_step, 0)
+        self.assertEqual(self.cache.hits, 2)
+
+    def test_suffix_hit(self):
+        middle = self.path.nodes[10].coords
+        path = self.cache.get(middle, self.goal, False)
+        self.assertEqual(crds_of(path), crds_of(self.path)[10:])
+        self.assertEqual(self.cache.suffix_hits, 1)
+
+    def test_misses(self):
+        self.assertTrue(self.cache.get(self.start, self.goal, True) is None)
+        self.assertTrue(self.cache.get(utils.Vector(-20, 1, 5), self.goal, False) is None)
+        self.assertTrue(self.cache.get(self.path.nodes[10].coords, utils.Vector(20, 1, 4), False) is None)
+        self.assertEqual(self.cache.misses, 3)
+
+    def test_least_recently_used_go_first(self):
+        cache = PathCache(self.dimension, size=2)
+        goals = [utils.Vector(20, 1, z) for z in (1, 2, 3)]
+        for goal in goals[:2]:
+            cache.put(self.start, goal, False, self.path)
+        cache.get(self.start, goals[0], False)
+        cache.put(self.start, goals[2], False, self.path)
+        self.assertEqual(len(cache), 2)
+        self.assertTrue(cache.get(self.start, goals[1], False) is None)
+        self.assertTrue(cache.get(self.start, goals[0], False) is not None)
+
+    def test_search_cut_short_is_not_kept(self):
+        goal = utils.Vector(20, 1, -20)
+        astar = AStar(dimension=self.dimension, start_coords=self.start,
+                      end_coords=goal, estimate=True)
+        astar.excessive = -1
+        path = worlds.run(astar).path
+        self.assertTrue(path.estimated)
+        self.assertNotEqual(path.nodes[-1].coords, goal)
+        self.cache.put(self.start, goal, True, path)
+        self.assertEqual(len(self.cache), 1)
+        self.assertTrue(self.cache.get(self.start, goal, True) is None)
+        self.assertFalse(self.cache.get(self.start, self.goal, False).estimated)
+
+    def test_far_change_keeps_the_path(self):
+        worlds.set_block(self.dimension, 0, 1, 14, 1)
+        self.assertEqual(len(self.cache), 1)
+        self.assertEqual(self.cache.invalidated, 0)
+
+    def test_change_on_the_path_drops_it(self):
+        x, y, z = self.path.nodes[20].coords.tuple
+        worlds.set_block(self.dimension, x, y, z, 1)
+        self.assertEqual(len(self.cache), 0)
+        self.assertEqual(self.cache.invalidated, 1)
+
+    def test_change_beside_the_path_drops_it(self):
+        # a block above the head next to the path can stop a jump or a fall
+        x, y, z = self.path.nodes[20].coords.tuple
+        worlds.set_block(self.dimension, x + 1, y + 2, z, 1)
+        self.assertEqual(len(self.cache), 0)
+
+    def test_change_in_another_path_corridor(self):
+        other_start, other_goal = utils.Vector(-20, 1, -20), utils.Vector(20, 1, -20)
+        other = worlds.run(AStar(dimension=self.dimension, start_coords=other_start,
+                                 end_coords=other_goal, estimate=False)).path
+        self.cache.put(other_start, other_goal, False, other)
+        x, y, z = other.nodes[5].coords.tuple
+        worlds.set_block(self.dimension, x, y, z, 1)
+        self.assertEqual(len(self.cache), 1)
+        self.assertTrue(self.cache.get(self.start, self.goal, False) is not None)
+
+
+class IncrementalPlannerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.time_limit = config.PATHFIND_EXEC_TIME_LIMIT
+        config.PATHFIND_EXEC_TIME_LIMIT = 30
+        self.dimension = worlds.make_dimension(radius=2)
+        self.grid = self.dimension.grid
+        self.positions = set(worlds.standing_positions(self.dimension, radius=2))
+        self.planner = IncrementalPlanner()
+
+    def tearDown(self):
+        config.PATHFIND_EXEC_TIME_LIMIT = self.time_limit
+        self.planner.close()
+
+    def replan(self, start, goal, dimension=None):
+        replan = self.planner.replan(dimension or self.dimension, utils.Vector(*start), utils.Vector(*goal))
+        path = worlds.run(replan).path
+        return None if path is None else crds_of(path)
+
+    def assert_shortest(self, crds, start, goal):
+        shortest = worlds.shortest_steps(self.grid, start, goal)
+        if shortest is None:
+            self.assertTrue(crds is None)
+            return
+        self.assertEqual((crds[0], crds[-1]), (start, goal))
+        self.assertEqual(len(crds) - 1, shortest)
+        self.assertTrue(worlds.path_is_valid(self.grid, crds))
+
+    def nearby(self, rnd, crd, spread=2):
+        while True:
+            to = (crd[0] + rnd.randint(-spread, spread), 1, crd[2] + rnd.randint(-spread, spread))
+            if to in self.positions:
+                return to
+
+    def test_following_a_moving_goal(self):
+        rnd = random.Random(3)
+        start, goal = (-25, 1, -25), (20, 1, 20)
+        for crd in (start, goal):
+            worlds.set_block(self.dimension, crd[0], 1, crd[2], 0)
+            self.positions.add(crd)
+        for _ in xrange(15):
+            crds = self.replan(start, goal)
+            self.assert_shortest(crds, start, goal)
+            start = crds[min(len(crds) - 1, rnd.randint(0, 3))]
+            goal = self.nearby(rnd, goal)
+        self.assertEqual(self.planner.resets, 0)
+        self.assertTrue(self.planner.km > 0)
+
+    def test_bot_moving_along_the_path_keeps_the_search(self):
+        start, goal = (-20, 1, 3), (20, 1, 5)
+        crds = self.replan(start, goal)
+        known = len(self.planner.g)
+        expanded = self.planner.expanded
+        start = crds[5]
+        self.assertEqual(self.replan(start, goal), crds[5:])
+        self.assertEqual(self.planner.resets, 0)
+        self.assertTrue(self.planner.expanded - expanded < known / 2)
+
+    def test_bot_leaving_the_search_starts_over(self):
+        crds = self.replan((-20, 1, 3), (-10, 1, 5))
+        start = (20, 1, -20)
+        self.positions.add(start)
+        worlds.set_block(self.dimension, start[0], 1, start[2], 0)
+        crds = self.replan(start, (-10, 1, 5))
+        self.assertEqual(self.planner.resets, 1)
+        self.assert_shortest(crds, start, (-10, 1, 5))
+
+    def test_block_changes_update_the_path(self):
+        start, goal = (-20, 1, 3), (20, 1, 5)
+        crds = self.replan(start, goal)
+        for crd in crds[8:20:3]:
+            worlds.set_block(self.dimension, crd[0], 1, crd[2], 1)
+            worlds.set_block(self.dimension, crd[0], 2, crd[2], 1)
+        changed = self.replan(start, goal)
+        self.assertEqual(self.planner.resets, 0)
+        self.assertNotEqual(changed, crds)
+        self.assert_shortest(changed, start, goal)
+        # and the way opens again
+        for crd in crds[8:20:3]:
+            worlds.set_block(self.dimension, crd[0], 2, crd[2], 0)
+            worlds.set_block(self.dimension, crd[0], 1, crd[2], 0)
+        self.assertEqual(len(self.replan(start, goal)), len(crds))
+
+    def test_chunk_load_under_the_search_starts_over(self):
+        start, goal = (-20, 1, 3), (20, 1, 5)
+        self.replan(start, goal)
+        ids = worlds.section(7, pillars=0, walls=False)
+        self.grid._load_chunk(0, 0, True, 1, 0, StringIO(worlds.chunk_data(ids)))
+        self.grid.chunk_updated(0, 0)
+        self.grid.deliver_changes()
+        crds = self.replan(start, goal)
+        self.assertEqual(self.planner.resets, 1)
+        self.assert_shortest(crds, start, goal)
+
+    def test_unreachable_goal(self):
+        goal = (10, 1, 10)
+        for i in (-1, 0, 1):
+            for j in (-1, 0, 1):
+                for y in (1, 2, 3):
+                    worlds.set_block(self.dimension, goal[0] + i, y, goal[2] + j, 0 if not (i or j) and y < 3 else 1)
+        self.assertTrue(worlds.shortest_steps(self.grid, (-20, 1, 3), goal) is None)
+        self.assertTrue(self.replan((-20, 1, 3), goal) is None)
+
+    def test_newer_replan_stops_an_older_one(self):
+        older = self.planner.replan(self.dimension, utils.Vector(-20, 1, 3), utils.Vector(20, 1, 5))
+        self.replan((-20, 1, 3), (20, 1, 6))
+        self.assertTrue(worlds.run(older).path is None)
+
+    def test_dimension_change(self):
+        self.replan((-20, 1, 3), (20, 1, 5))
+        other = worlds.make_dimension(radius=1, pillars=0, walls=False)
+        crds = self.replan((-5, 1, 0), (5, 1, 0), dimension=other)
+        self.assertEqual(len(crds), 11)
+        self.assertEqual(len(self.grid.subscriptions), 0)
+        self.assertEqual(len(other.grid.subscriptions), 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
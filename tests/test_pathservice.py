@@ -0,0 +1,192 @@
+import time
+import unittest
+
+import worlds
+
+from twisted.internet import reactor
+from twisted.internet.defer import CancelledError
+
+from twistedbot import config, utils
+from twistedbot.pathfinding import AStar
+from twistedbot.pathservice import PathService, search_snapshot
+
+
+def wait(deferred, timeout=30):
+    """ iterate the reactor until the deferred fired, returns its result """
+    results = []
+    deferred.addBoth(results.append)
+    end = time.time() + timeout
+    while not results and time.time() < end:
+        reactor.iterate(0.01)
+    if not results:
+        raise AssertionError("deferred did not fire in %d sec" % timeout)
+    return results[0]
+
+
+def pump(until, timeout=10):
+    end = time.time() + timeout
+    while not until() and time.time() < end:
+        reactor.iterate(0.01)
+
+
+def pump_for(seconds):
+    end = time.time() + seconds
+    while time.time() < end:
+        reactor.iterate(0.01)
+
+
+class SilentResult(object):
+
+    def __init__(self):
+        self.answered = False
+
+    def ready(self):
+        return self.answered
+
+
+class SilentPool(object):
+    """ a pool whose workers answer only when the test says so """
+
+    def __init__(self):
+        self.calls = []
+
+    def apply_async(self, func, args, callback):
+        result = SilentResult()
+        self.calls.append((func, args, callback, result))
+        return result
+
+    def answer(self, index=-1):
+        func, args, callback, result = self.calls[index]
+        result.answered = True
+        callback(func(*args))
+
+    def terminate(self):
+        pass
+
+
+class PathServiceTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dimension = worlds.make_dimension(radius=2)
+        self.positions = worlds.standing_positions(self.dimension, radius=2)
+        self.start = utils.Vector(*self.positions[0])
+        self.end = utils.Vector(*self.positions[-1])
+        self.service = PathService(workers=0)
+        self.saved = (config.PATHFIND_EXEC_TIME_LIMIT, config.PATHFIND_WORKER_TIME_LIMIT,
+                      config.PATHFIND_WORKER_TIME_MARGIN)
+        # a slow machine must not cut the searches short
+        config.PATHFIND_EXEC_TIME_LIMIT = 30
+
+    def tearDown(self):
+        (config.PATHFIND_EXEC_TIME_LIMIT, config.PATHFIND_WORKER_TIME_LIMIT,
+         config.PATHFIND_WORKER_TIME_MARGIN) = self.saved
+        self.service.close()
+
+    def local_path(self, start, end):
+        return worlds.run(AStar(dimension=self.dimension, start_coords=start,
+                                end_coords=end, estimate=False)).path
+
+    def find_with(self, pool):
+        self.service.pool = pool
+        self.service.workers = 1
+        d = self.service.find(self.dimension, self.start, self.end, estimate=False)
+        pump(lambda: len(pool.calls) == self.service.sent and pool.calls)
+        return d
+
+    def test_worker_paths_match_local_searches(self):
+        config.PATHFIND_WORKER_TIME_LIMIT = 30
+        service = PathService(workers=2)
+        try:
+            if service.pool is None:
+                self.skipTest("no worker processes here")
+            for i in xrange(0, len(self.positions), len(self.positions) // 5):
+                start = utils.Vector(*self.positions[i])
+                end = utils.Vector(*self.positions[-1 - i])
+                path = wait(service.find(self.dimension, start, end, estimate=False))
+                local = self.local_path(start, end)
+                self.assertEqual(len(path), len(local))
+                self.assertEqual(path.nodes[-1].coords, end)
+                self.assertIs(path.dimension, self.dimension)
+                self.assertTrue(worlds.path_is_valid(self.dimension.grid,
+                                                     [node.coords.tuple for node in path.nodes]))
+            self.assertEqual(service.local, 0)
+            self.assertFalse(service.searches)
+        finally:
+            service.close()
+
+    def test_changed_snapshot_is_sent_again(self):
+        pool = SilentPool()
+        d = self.find_with(pool)
+        x, y, z = self.positions[len(self.positions) // 2]
+        worlds.set_block(self.dimension, x, y, z, 1)
+        pool.answer()
+        pump(lambda: len(pool.calls) == 2)
+        self.assertEqual((self.service.stale, self.service.sent), (1, 2))
+        pool.answer()
+        path = wait(d)
+        self.assertEqual(len(path), len(self.local_path(self.start, self.end)))
+
+    def test_cancel_drops_the_result(self):
+        pool = SilentPool()
+        d = self.find_with(pool)
+        search = list(self.service.searches)[0]
+        d.cancel()
+        self.assertTrue(wait(d).check(CancelledError))
+        pool.answer()
+        reactor.iterate(0.01)
+        self.assertEqual(self.service.finished, 0)
+        self.assertFalse(self.service.searches)
+        self.assertFalse(self.service.jobs)
+        self.assertIsNone(search.job)
+
+    def test_no_workers_searches_on_the_reactor(self):
+        path = wait(self.service.find(self.dimension, self.start, self.end, estimate=False))
+        self.assertEqual(len(path), len(self.local_path(self.start, self.end)))
+        self.assertEqual((self.service.local, self.service.sent), (1, 0))
+
+    def test_worker_failure_searches_on_the_reactor(self):
+        pool = SilentPool()
+        d = self.find_with(pool)
+        pool.calls[-1][2]((None, None, "Traceback: worker failed"))
+        path = wait(d)
+        self.assertEqual(len(path), len(self.local_path(self.start, self.end)))
+        self.assertEqual((self.service.failed, self.service.local), (1, 1))
+
+    def test_lost_worker_result_searches_on_the_reactor(self):
+        config.PATHFIND_WORKER_TIME_LIMIT, config.PATHFIND_WORKER_TIME_MARGIN = 0.01, 0.05
+        pool = SilentPool()
+        d = self.find_with(pool)
+        path = wait(d)
+        self.assertEqual(len(path), len(self.local_path(self.start, self.end)))
+        self.assertEqual((self.service.lost, self.service.local), (1, 1))
+        # a late answer is dropped
+        pool.answer()
+        reactor.iterate(0.01)
+        self.assertEqual(self.service.finished, 0)
+        self.assertFalse(self.service.searches)
+
+    def test_queued_searches_wait_for_a_worker(self):
+        # no deadline runs out in the test
+        config.PATHFIND_WORKER_TIME_LIMIT, config.PATHFIND_WORKER_TIME_MARGIN = 30, 30
+        pool = SilentPool()
+        self.service.pool = pool
+        self.service.workers = 1
+        first = self.service.find(self.dimension, self.start, self.end, estimate=False)
+        second = self.service.find(self.dimension, self.end, self.start, estimate=False)
+        pump(lambda: len(pool.calls) == 2)
+        self.assertIsNotNone(self.service.jobs[0].deadline)
+        self.assertIsNone(self.service.jobs[1].deadline)
+        pump_for(0.1)
+        answered = reactor.seconds()
+        pool.answer(0)
+        self.assertIsNotNone(wait(first))
+        # counted from when the worker took it, not from the send
+        timeout = config.PATHFIND_WORKER_TIME_LIMIT + config.PATHFIND_WORKER_TIME_MARGIN
+        self.assertGreaterEqual(self.service.jobs[0].deadline.getTime(), answered + timeout)
+        pool.answer(1)
+        self.assertIsNotNone(wait(second))
+        self.assertEqual((self.service.finished, self.service.lost, self.service.local), (2, 0, 0))
+        self.assertFalse(self.service.jobs)
+
+    def test_failing_search_reports_the_traceback(self):
+        self.assertIsNotNone(search_snapshot(None, (0, 0, 0), (1, 1, 1), True, 1)[2])
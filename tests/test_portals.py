@@ -0,0 +1,113 @@
+import random
+import unittest
+
+from tests import worlds
+from twistedbot import utils
+from twistedbot.pathfinding import HPAStar
+from twistedbot.portals import SearchCache
+
+
+class SearchCacheTest(unittest.TestCase):
+
+    def test_keeps_the_most_recently_used(self):
+        cache = SearchCache(size=3)
+        for i in xrange(4):
+            cache.put(i, ({i: 0, -i: 1}, {}))
+        self.assertEqual(len(cache), 3)
+        self.assertEqual(cache.positions, 6)
+        self.assertTrue(cache.get(0) is None)
+        cache.get(1)
+        cache.put(4, ({4: 0}, {}))
+        self.assertTrue(cache.get(1) is not None)
+        self.assertTrue(cache.get(2) is None)
+        self.assertEqual(cache.positions, 5)
+        cache.clear()
+        self.assertEqual((len(cache), cache.positions), (0, 0))
+
+
+class PortalGraphTest(unittest.TestCase):
+
+    def test_searches_are_bounded(self):
+        dimension = worlds.make_dimension(radius=2)
+        graph = dimension.grid.portals
+        graph.searched.size = 20
+        for crd in worlds.standing_positions(dimension, radius=2)[::7]:
+            list(graph.cluster_at(crd).edges_from(crd))
+        self.assertEqual(len(graph.searched), 20)
+        self.assertEqual(graph.searched.positions,
+                         sum(len(found[0]) for found in graph.searched.searches.itervalues()))
+        report = dimension.grid.memory_report()
+        self.assertEqual(report["portal_searches"], 20)
+
+    def test_rebuilt_cluster_does_not_reuse_searches(self):
+        dimension = worlds.make_dimension(radius=1, pillars=0, walls=False)
+        graph = dimension.grid.portals
+        start = (2, 1, 2)
+        distances, _ = graph.cluster_at(start).search_from(start)
+        self.assertEqual(distances[(2, 1, 5)], 3)
+        # a wall across the cluster
+        for z in xrange(16):
+            worlds.set_block(dimension, 3, 1, z, 1)
+            worlds.set_block(dimension, 3, 2, z, 1)
+        distances, _ = graph.cluster_at(start).search_from(start)
+        self.assertFalse((5, 1, 5) in distances)
+
+
+def enclose(dimension, x, z):
+    """ wall in the standing position x, 1, z """
+    for i in (-1, 0, 1):
+        for j in (-1, 0, 1):
+            if i or j:
+                for y in (1, 2, 3):
+                    worlds.set_block(dimension, x + i, y, z + j, 1)
+    worlds.set_block(dimension, x, 1, z, 0)
+    worlds.set_block(dimension, x, 2, z, 0)
+
+
+class HPAStarTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dimension = worlds.make_dimension(radius=3)
+        self.positions = worlds.standing_positions(self.dimension, radius=3)
+
+    def search(self, start, goal, estimate=False):
+        return worlds.run(HPAStar(dimension=self.dimension, start_coords=utils.Vector(*start),
+                                  end_coords=utils.Vector(*goal), estimate=estimate))
+
+    def test_refined_paths_are_valid_and_short(self):
+        rnd = random.Random(5)
+        for _ in xrange(10):
+            start, goal = rnd.choice(self.positions), rnd.choice(self.positions)
+            path = self.search(start, goal).path
+            crds = [node.coords.tuple for node in path.nodes]
+            self.assertEqual((crds[0], crds[-1]), (start, goal))
+            self.assertTrue(worlds.path_is_valid(self.dimension.grid, crds))
+            shortest = worlds.shortest_steps(self.dimension.grid, start, goal)
+            self.assertTrue(shortest <= len(crds) - 1 <= shortest * 1.25, (start, goal, shortest, len(crds)))
+
+    def test_paths_follow_block_changes(self):
+        start, goal = (-20, 1, 5), (20, 1, 5)
+        for crd in (start, goal):
+            worlds.set_block(self.dimension, crd[0], 1, crd[2], 0)
+        crds = [node.coords.tuple for node in self.search(start, goal).path.nodes]
+        middle = crds[len(crds) / 2]
+        worlds.set_block(self.dimension, middle[0], 1, middle[2], 1)
+        worlds.set_block(self.dimension, middle[0], 2, middle[2], 1)
+        crds = [node.coords.tuple for node in self.search(start, goal).path.nodes]
+        self.assertFalse(middle in crds)
+        self.assertTrue(worlds.path_is_valid(self.dimension.grid, crds))
+
+    def test_unreachable_goal(self):
+        start, goal = (-30, 1, -30), (30, 1, 30)
+        worlds.set_block(self.dimension, start[0], 1, start[2], 0)
+        enclose(self.dimension, *goal[::2])
+        self.assertTrue(self.search(start, goal).path is None)
+        path = self.search(start, goal, estimate=True).path
+        crds = [node.coords.tuple for node in path.nodes]
+        self.assertEqual(crds[0], start)
+        self.assertNotEqual(crds[-1], goal)
+        self.assertTrue(worlds.path_is_valid(self.dimension.grid, crds))
+
+
+if __name__ == "__main__":
+    unittest.main()
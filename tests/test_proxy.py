@@ -0,0 +1,94 @@
+import struct
+import unittest
+
+import syspath_fix
+syspath_fix.update_sys_path()
+
+from construct import Container
+
+from twistedbot import logbot
+from twistedbot.packets import packets
+
+try:
+    import proxy
+except ImportError:
+    # pycrypto is missing
+    proxy = None
+
+
+class Processor(object):
+
+    def __init__(self):
+        self.packets = []
+
+    def process_packets(self, side, packets, encrypted=False):
+        self.packets.extend(packets)
+
+
+class Peer(object):
+    """ the protocol on the other side of the proxy """
+
+    def __init__(self):
+        self.sent = []
+        self.handshakes = []
+
+    def sendData(self, data):
+        self.sent.append(data)
+
+    def send_handshake(self, c):
+        self.handshakes.append(c)
+
+
+class Side(object):
+
+    def __init__(self, mgsside):
+        self.mgsside = mgsside
+        self.log = logbot.getlogger(mgsside)
+        self.protocol = Peer()
+        self.host, self.port = "localhost", 25565
+
+
+class ProxyTest(unittest.TestCase):
+
+    def setUp(self):
+        if proxy is None:
+            self.skipTest("proxy needs pycrypto")
+        self.processor = proxy.processor = Processor()
+
+    def tearDown(self):
+        if proxy is not None:
+            del proxy.processor
+
+    def server_side(self):
+        factory = Side("SERVER")
+        factory.proxyclient = Side("CLIENT")
+        return proxy.ProxyServerProtocol(factory)
+
+    def test_server_packets_are_processed_when_complete(self):
+        protocol = self.server_side()
+        data = "\x00" + struct.pack(">i", 5)
+        protocol.parse_stream(data[:3])
+        self.assertEqual(self.processor.packets, [])
+        protocol.parse_stream(data[3:])
+        self.assertEqual(self.processor.packets, [(0x00, Container(pid=5))])
+
+    def test_disconnect_is_forwarded_whole(self):
+        protocol = self.server_side()
+        data = "\xff" + packets[0xff].build(Container(message=u"bye"))
+        protocol.parse_stream(data[:4])
+        protocol.parse_stream(data[4:])
+        self.assertEqual(protocol.factory.proxyclient.protocol.sent, [data])
+
+    def test_client_data_waits_for_the_server(self):
+        handshake = Container(protocol=51, username=u"bot",
+                              server_host=u"localhost", server_port=25565)
+        protocol = proxy.ProxyClientProtocol(Side("CLIENT"))
+        protocol.parse_stream("\x02" + packets[0x02].build(handshake))
+        self.assertEqual(self.processor.packets, [])
+        server = protocol.proxyserver.protocol = Peer()
+        protocol.parse_stream("")
+        self.assertEqual(server.handshakes, [handshake])
+
+
+if __name__ == "__main__":
+    unittest.main()
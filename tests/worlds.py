@@ -0,0 +1,110 @@
+"""
+Small deterministic grids for the path search tests.
+"""
+
+import random
+from collections import deque
+from StringIO import StringIO
+
+import syspath_fix
+syspath_fix.update_sys_path()
+
+from twistedbot import utils
+from twistedbot.grid import Grid
+from twistedbot.gridspace import GridSpace
+
+
+STONE = "\x01"
+AIR = "\0"
+
+
+class Dimension(object):
+    """ what the path searches need of world.Dimension """
+
+    def __init__(self):
+        self.grid = Grid(self)
+
+
+def section(seed, pillars=0.15, walls=True):
+    """
+    Block ids of a section: stone floor at y 0, stone pillars at y 1 and,
+    with walls, 2 block high walls along x = 8 with a gap at z 4 to 6.
+    """
+    rnd = random.Random(seed)
+    ids = [AIR] * 4096
+    for z in xrange(16):
+        for x in xrange(16):
+            ids[z * 16 + x] = STONE
+            if rnd.random() < pillars:
+                ids[256 + z * 16 + x] = STONE
+            if walls and x == 8 and not 4 <= z <= 6:
+                ids[256 + z * 16 + x] = STONE
+                ids[512 + z * 16 + x] = STONE
+    return "".join(ids)
+
+
+def chunk_data(ids):
+    return ids + AIR * 2048 + AIR * 2048 * 2 + AIR * 256
+
+
+def make_dimension(radius=3, seed=1, pillars=0.15, walls=True):
+    """ chunks -radius .. radius - 1 in x and z, a section each at level 0 """
+    dimension = Dimension()
+    grid = dimension.grid
+    for chunk_x in xrange(-radius, radius):
+        for chunk_z in xrange(-radius, radius):
+            ids = section((seed, chunk_x, chunk_z), pillars, walls)
+            grid._load_chunk(chunk_x, chunk_z, True, 1, 0, StringIO(chunk_data(ids)))
+    grid.deliver_changes()
+    return dimension
+
+
+def set_block(dimension, x, y, z, block_type):
+    dimension.grid.on_block_change(x, y, z, block_type, 0)
+    dimension.grid.deliver_changes()
+
+
+def standing_positions(dimension, radius=3):
+    gridspace = GridSpace(dimension.grid)
+    side = radius * 16
+    return [(x, 1, z) for x in xrange(-side, side) for z in xrange(-side, side)
+            if gridspace.can_stand(x, 1, z)]
+
+
+def moves_from(grid, crd):
+    return [state.coords.tuple for state in GridSpace(grid).neighbours_of(utils.Vector(*crd))]
+
+
+def path_is_valid(grid, crds):
+    """ every step one GridSpace move from the previous """
+    gridspace = GridSpace(grid)
+    for a, b in zip(crds, crds[1:]):
+        if b not in [state.coords.tuple for state in gridspace.neighbours_of(utils.Vector(*a))]:
+            return False
+    return True
+
+
+def shortest_steps(grid, start, goal):
+    """ fewest GridSpace moves from start to goal, None when unreachable """
+    gridspace = GridSpace(grid)
+    steps = {start: 0}
+    queue = deque([start])
+    while queue:
+        crd = queue.popleft()
+        if crd == goal:
+            return steps[crd]
+        for state in gridspace.neighbours_of(utils.Vector(*crd)):
+            to = state.coords.tuple
+            if to not in steps:
+                steps[to] = steps[crd] + 1
+                queue.append(to)
+    return None
+
+
+def run(search):
+    """ drive an AStar like iterator to the end, returns it """
+    try:
+        while True:
+            search.next()
+    except StopIteration:
+        return search
@@ -2,13 +2,13 @@
 from collections import deque
 
 from twisted.internet.task import cooperate
-from twisted.internet.defer import inlineCallbacks, returnValue
+from twisted.internet.defer import inlineCallbacks, returnValue, CancelledError
 
 import config
 import utils
 import logbot
 import fops
-from pathfinding import AStar
+from pathfinding import AStar, HPAStar, IncrementalPlanner
 from axisbox import AABB
 from gridspace import GridSpace
 from time import time
@@ -408,6 +408,12 @@ class FollowPlayerBehaviour(BehaviourBase):
         self.last_attempt = 0
         # distance * recalc_multiplier = seconds before automatic recalc
         self.recalc_multiplier = 0.25
+        # search state kept between the recalculations
+        self.planner = IncrementalPlanner()
+
+    def cancel(self):
+        self.planner.close()
+        super(FollowPlayerBehaviour, self).cancel()
 
     def from_child(self, status, goal=None, endpoint=None, estimated=None,
                    **kwargs):
@@ -440,9 +446,11 @@ class FollowPlayerBehaviour(BehaviourBase):
         bot_object = self.world.bot.bot_object
         bb = AABB.from_player_coords(entity.position)
         block = self.world.grid.standing_on_block(bb)
+        if block is None:
+            # in the air, aim for where the player lands
+            block = self.world.grid.downward_block(bb)
         if block is None:
             block = self.world.grid.actual_block(bb)
-#        #block = self.world.grid.downward_block(bb)
         distance = bot_object.position.distance(entity.position)
         delay = distance * self.recalc_multiplier
         #don't auto-recalculate more than once a second.
@@ -458,7 +466,8 @@ class FollowPlayerBehaviour(BehaviourBase):
             self.last_attempt = time()
             self.last_block = block
             self.add_subbehaviour(TravelToBehaviour, coords=block.coords,
-                                  shorten_path_by=2, estimate=True)
+                                  shorten_path_by=2, estimate=True,
+                                  planner=self.planner)
 
 
 class TravelToBehaviour(BehaviourBase):
@@ -467,6 +476,7 @@ class TravelToBehaviour(BehaviourBase):
         coords := Coordinates to travel to
         shorten_path_by := remove a number of steps at the end of the path
         recurse := Use an additional instance to smooth motion
+        planner := IncrementalPlanner to ask first, for a moving goal
     """
     def __init__(self, *args, **kwargs):
         super(TravelToBehaviour, self).__init__(*args, **kwargs)
@@ -475,6 +485,9 @@ class TravelToBehaviour(BehaviourBase):
         self.travel_coords = kwargs["coords"]
         self.shorten_path_by = kwargs.get("shorten_path_by", 0)
         self.estimate = kwargs.get('estimate', True)
+        self.planner = kwargs.get('planner', None)
+        # Deferred of the path search in progress
+        self.search = None
         self.ready = False
         self.start_time = time()
         self.fail_count = 0
@@ -493,28 +506,68 @@ class TravelToBehaviour(BehaviourBase):
                             self.world.grid.get_block_coords(value),
                             '(parent)' if self.recurse else '')
 
+    def cancel(self):
+        super(TravelToBehaviour, self).cancel()
+        if self.search is not None:
+            self.search.cancel()
+
     @inlineCallbacks
     def _prepare(self):
         sb = self.bot.standing_on_block(self.bot.bot_object)
         if sb is None:
             self.ready = False
-        else:
-            d = cooperate(AStar(dimension=self.world.dimension,
-                                start_coords=sb.coords,
-                                end_coords=self.travel_coords,
-                                estimate=self.estimate)).whenDone()
+            return
+        path = None
+        if self.planner is not None:
+            d = cooperate(self.planner.replan(self.world.dimension, sb.coords,
+                                              self.travel_coords)).whenDone()
             d.addErrback(logbot.exit_on_error)
-            astar = yield d
-            if astar is None or astar.path is None:
-                self.status = Status.failure
+            replan = yield d
+            path = replan.path
+        # single steps of a parent travel are not worth caching
+        cache = self.world.dimension.path_cache
+        use_cache = self.planner is None and \
+            sb.coords.distance(self.travel_coords) >= config.PATHFIND_MIN
+        if path is None and use_cache:
+            path = cache.get(sb.coords, self.travel_coords, self.estimate)
+        if path is None:
+            distance = sb.coords.distance(self.travel_coords)
+            if config.PATHFIND_MIN <= distance <= config.HPA_MIN_DISTANCE:
+                # in a worker process, see pathservice.py
+                self.search = self.world.path_service.find(
+                    self.world.dimension, sb.coords, self.travel_coords,
+                    estimate=self.estimate)
+                try:
+                    path = yield self.search
+                except CancelledError:
+                    return
+                finally:
+                    self.search = None
             else:
-                current_start = self.bot.standing_on_block(self.bot.bot_object)
-                if sb == current_start:
-                    self.path = astar.path
-                    self.path.remove_last(self.shorten_path_by)
-                    self.ready = True
-                    if len(astar.path) <= self.shorten_path_by + 0.5:
-                        self.status = Status.success
+                if distance > config.HPA_MIN_DISTANCE:
+                    search = HPAStar
+                else:
+                    search = AStar
+                d = cooperate(search(dimension=self.world.dimension,
+                                     start_coords=sb.coords,
+                                     end_coords=self.travel_coords,
+                                     estimate=self.estimate)).whenDone()
+                d.addErrback(logbot.exit_on_error)
+                astar = yield d
+                if astar is not None:
+                    path = astar.path
+            if path is None:
+                self.status = Status.failure
+                return
+            if use_cache:
+                cache.put(sb.coords, self.travel_coords, self.estimate, path)
+        current_start = self.bot.standing_on_block(self.bot.bot_object)
+        if sb == current_start:
+            self.path = path
+            self.path.remove_last(self.shorten_path_by)
+            self.ready = True
+            if len(path) <= self.shorten_path_by + 0.5:
+                self.status = Status.success
 
     def from_child(self, status, no_op=None, **kwargs):
         if self.cancelled:
@@ -556,6 +609,8 @@ class TravelToBehaviour(BehaviourBase):
             return
         while not self.ready:
             yield self._prepare()
+            if self.cancelled:
+                return
             self.fail_count += 1
             if self.fail_count == self.fail_limit:
                 self.ready = True
@@ -1,4 +1,5 @@
 
+import array
 import inspect
 import sys
 
@@ -43,6 +44,8 @@ class Block(object):
     slipperiness = 0.6
     render_as_normal_block = True
     is_opaque_cube = True
+    # type and meta queries also look at the neighbours, see prototype
+    neighbour_dependent = False
 
     def __init__(self, grid, x, y, z, meta):
         self.grid = grid
@@ -50,7 +53,14 @@ class Block(object):
         self.y = y
         self.z = z
         self.meta = meta
-        self.coords = utils.Vector(self.x, self.y, self.z)
+
+    @property
+    def coords(self):
+        try:
+            return self._coords
+        except AttributeError:
+            self._coords = utils.Vector(self.x, self.y, self.z)
+            return self._coords
 
     def __str__(self):
         return "|%s %s %s|" % (self.coords, self.name, utils.meta2str(self.meta))
@@ -475,6 +485,7 @@ class BlockDoor(BlockSolid):
                       AABB(0.0, 0.0, 0.8125, 1.0, 1.0, 1.0)]
     top_part = None
     bottom_part = None
+    neighbour_dependent = True
 
     @property
     def can_fall_through(self):
@@ -1447,6 +1458,7 @@ class Vines(BlockNonSolid):
     number = 106
     name = "Vines"
     material = materials.vine
+    neighbour_dependent = True
 
     @property
     def can_stand_in(self):
@@ -1845,3 +1857,76 @@ selfmembers = inspect.getmembers(sys.modules[__name__], inspect.isclass)
 for _, cl in selfmembers:
     if issubclass(cl, Block) and hasattr(cl, 'number'):
         block_map[cl.number] = cl
+
+# shared blocks, index number << 4 | meta
+prototypes = [None for _ in xrange(256 * 16)]
+
+
+def prototype(number, meta):
+    """
+    Shared block of type number with meta, not bound to coordinates. Good
+    for queries that depend on the type and meta only, grid, x, y and z
+    are None. Types with neighbour_dependent set must not be shared, use
+    Grid.get_block_prototype that handles it.
+    """
+    blk = prototypes[number << 4 | meta]
+    if blk is None:
+        blk = block_map[number](None, None, None, None, meta)
+        prototypes[number << 4 | meta] = blk
+    return blk
+
+
+# Property flags, block_flags[number << 4 | meta] has the bit set when the
+# property is true. Properties that look at the neighbours are not known
+# in advance, their bit is set shifted by NEIGHBOURS_SHIFT instead and
+# Grid.get_block_flags asks the real block.
+FREE = 1 << 0
+FALL_THROUGH = 1 << 1
+STAND_ON = 1 << 2
+STAND_IN = 1 << 3
+COLLIDABLE = 1 << 4
+CLIMBABLE = 1 << 5
+CUBE = 1 << 6
+FLUID = 1 << 7
+WATER = 1 << 8
+LAVA = 1 << 9
+BURNING = 1 << 10
+LADDER = 1 << 11
+VINE = 1 << 12
+NEIGHBOURS_SHIFT = 16
+NEIGHBOURS_MASK = 0xffff << NEIGHBOURS_SHIFT
+
+flag_properties = [(FREE, "is_free"),
+                   (FALL_THROUGH, "can_fall_through"),
+                   (STAND_ON, "can_stand_on"),
+                   (STAND_IN, "can_stand_in"),
+                   (COLLIDABLE, "is_collidable"),
+                   (CLIMBABLE, "is_climbable"),
+                   (CUBE, "is_cube"),
+                   (FLUID, "is_fluid"),
+                   (WATER, "is_water"),
+                   (LAVA, "is_lava"),
+                   (BURNING, "is_burning"),
+                   (LADDER, "is_ladder"),
+                   (VINE, "is_vine")]
+
+
+def compute_flags(blk):
+    """ property flags of blk, unknown ones in the NEIGHBOURS_MASK bits """
+    flags = 0
+    for bit, name in flag_properties:
+        try:
+            if getattr(blk, name):
+                flags |= bit
+        except AttributeError:
+            if blk.neighbour_dependent:
+                flags |= bit << NEIGHBOURS_SHIFT
+    return flags
+
+
+block_flags = array.array('L', [0] * (256 * 16))
+for _number, _cl in enumerate(block_map):
+    if _cl is not None:
+        for _meta in xrange(16):
+            block_flags[_number << 4 | _meta] = \
+                compute_flags(_cl(None, None, None, None, _meta))
@@ -4,10 +4,8 @@ import math
 
 import config
 import utils
-import packets
 import logbot
 import fops
-import blocks
 import behaviours
 from botinterface import BotInterface
 from axisbox import AABB
@@ -150,11 +148,9 @@ class BotEntity(object):
             self.cancel_value = None
 
     def send_location(self, b_obj):
-        self.world.send_packet("player position&look", {
-            "position": packets.Container(x=b_obj.x, y=b_obj.y, z=b_obj.z,
-                                          stance=b_obj.stance),
-            "orientation": packets.Container(yaw=b_obj.yaw, pitch=b_obj.pitch),
-            "grounded": packets.Container(grounded=b_obj.on_ground)})
+        self.world.send_fast_packet("player position&look",
+                                    b_obj.x, b_obj.y, b_obj.stance, b_obj.z,
+                                    b_obj.yaw, b_obj.pitch, b_obj.on_ground)
 
     def send_action(self, b_obj):
         """
@@ -162,8 +158,8 @@ class BotEntity(object):
         """
         if b_obj.action != b_obj._action:
             b_obj.action = b_obj._action
-            data = {"eid": self.eid, "action": b_obj._action}
-            self.world.send_packet("entity action", data)
+            self.world.send_fast_packet("entity action", self.eid,
+                                        b_obj._action)
 
     def turn_to_point(self, b_obj, point):
         if point[0] == b_obj.x and point[2] == b_obj.z:
@@ -205,11 +201,11 @@ class BotEntity(object):
         water_current = utils.Vector(0, 0, 0)
         bb = b_obj.aabb.expand(-0.001, -0.401, -0.001)
         top_y = utils.grid_shift(bb.max_y + 1)
-        for blk in self.world.grid.blocks_in_aabb(bb):
-            if isinstance(blk, blocks.BlockWater):
-                if top_y >= (blk.y + 1 - blk.height_percent):
-                    is_in_water = True
-                    water_current = blk.add_velocity_to(water_current)
+        for x, y, z, _ in self.world.grid.special_blocks_in(bb, kinds=("water",)):
+            blk = self.world.grid.get_block(x, y, z)
+            if top_y >= (blk.y + 1 - blk.height_percent):
+                is_in_water = True
+                water_current = blk.add_velocity_to(water_current)
         if water_current.size > 0:
             water_current.normalize()
             wconst = 0.014
@@ -218,13 +214,8 @@ class BotEntity(object):
         return is_in_water
 
     def handle_lava_movement(self, b_obj):
-        for blk in self.world.grid.blocks_in_aabb(
-                b_obj.aabb.expand(-0.1,
-                                  -0.4,
-                                  -0.1)):
-            if isinstance(blk, blocks.BlockLava):
-                return True
-        return False
+        return bool(self.world.grid.special_blocks_in(
+            b_obj.aabb.expand(-0.1, -0.4, -0.1), kinds=("lava",)))
 
     def move_collisions(self, b_obj, vx, vy, vz):
         if self.is_in_web(b_obj):
@@ -369,7 +360,8 @@ class BotEntity(object):
         slowdown = 0.91
         if b_obj.on_ground:
             slowdown = 0.546
-            block = self.world.grid.get_block(b_obj.grid_x, b_obj.grid_y - 1, b_obj.grid_z)
+            block = self.world.grid.get_block_prototype(
+                b_obj.grid_x, b_obj.grid_y - 1, b_obj.grid_z)
             if block is not None:
                 slowdown = block.slipperiness * 0.91
         return slowdown
@@ -396,25 +388,22 @@ class BotEntity(object):
         is_in_water = False
         bb = b_obj.aabb.expand(-0.001, -0.4010000059604645, -0.001)
         top_y = utils.grid_shift(bb.max_y + 1)
-        for blk in self.world.grid.blocks_in_aabb(bb):
-            if isinstance(blk, blocks.BlockWater):
-                if top_y >= (blk.y + 1 - blk.height_percent):
-                    is_in_water = True
+        for x, y, z, _ in self.world.grid.special_blocks_in(bb, kinds=("water",)):
+            blk = self.world.grid.get_block(x, y, z)
+            if top_y >= (blk.y + 1 - blk.height_percent):
+                is_in_water = True
         return is_in_water
 
     def is_in_web(self, b_obj):
         bb = b_obj.aabb.expand(dx=-0.001, dy=-0.001, dz=-0.001)
-        for blk in self.world.grid.blocks_in_aabb(bb):
-            if isinstance(blk, blocks.Cobweb):
-                return True
-        return False
+        return bool(self.world.grid.special_blocks_in(bb, kinds=("web",)))
 
     def head_inside_water(self, b_obj):
         return self.world.grid.aabb_eyelevel_inside_water(b_obj.aabb)
 
     def do_block_collision(self, b_obj):
         bb = b_obj.aabb.expand(-0.001, -0.001, -0.001)
-        for blk in self.world.grid.blocks_in_aabb(bb):
+        for blk in self.world.grid.block_prototypes_in_aabb(bb):
             blk.on_entity_collided(b_obj)
 
     def is_sneaking(self, b_obj):
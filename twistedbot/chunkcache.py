@@ -0,0 +1,178 @@
+"""
+On disk cache of the chunks seen before, one directory per server and
+dimension, one region file per 32 x 32 chunks.
+
+A region file starts with a header of 1024 (offset, length) pairs, big
+endian uint32, indexed by (z & 31) * 32 + (x & 31), followed by chunks
+as made by Chunk.compress. Rewritten chunks are appended, the dead space
+is reclaimed when a region with more dead than live data is opened.
+Regions are memory mapped for reading, writes happen in one background
+thread.
+"""
+
+import os
+import re
+import mmap
+import struct
+import threading
+from Queue import Queue
+
+from twisted.internet import reactor
+
+import logbot
+
+
+log = logbot.getlogger("CHUNK CACHE")
+
+REGION_SHIFT = 5
+REGION_CHUNKS = 1 << (REGION_SHIFT * 2)
+HEADER = struct.Struct(">%dI" % (REGION_CHUNKS * 2))
+ENTRY = struct.Struct(">II")
+region_name = re.compile(r"^r\.(-?\d+)\.(-?\d+)\.tbr$")
+
+
+class Region(object):
+    def __init__(self, path):
+        self.path = path
+        if not os.path.exists(path):
+            with open(path, "wb") as f:
+                f.write(HEADER.pack(*([0] * REGION_CHUNKS * 2)))
+        self.f = open(path, "r+b")
+        header = HEADER.unpack(self.f.read(HEADER.size))
+        self.index = [(header[i], header[i + 1]) for i in xrange(0, len(header), 2)]
+        if self.dead_bytes() > self.live_bytes():
+            self.compact()
+        self.map = None
+        self.remap()
+
+    def live_bytes(self):
+        return sum(length for _, length in self.index)
+
+    def dead_bytes(self):
+        return os.path.getsize(self.path) - HEADER.size - self.live_bytes()
+
+    def remap(self):
+        if self.map is not None:
+            self.map.close()
+        self.map = mmap.mmap(self.f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def compact(self):
+        """ rewrite the region without the dead space """
+        tmp_path = self.path + ".tmp"
+        index = []
+        with open(tmp_path, "wb") as out:
+            out.write(HEADER.pack(*([0] * REGION_CHUNKS * 2)))
+            for offset, length in self.index:
+                if length:
+                    self.f.seek(offset)
+                    index.append((out.tell(), length))
+                    out.write(self.f.read(length))
+                else:
+                    index.append((0, 0))
+            out.seek(0)
+            out.write(HEADER.pack(*[v for entry in index for v in entry]))
+        self.f.close()
+        os.rename(tmp_path, self.path)
+        self.f = open(self.path, "r+b")
+        self.index = index
+
+    def read(self, i):
+        offset, length = self.index[i]
+        if not length:
+            return None
+        if offset + length > len(self.map):
+            self.remap()
+        return self.map[offset:offset + length]
+
+    def write(self, i, data):
+        """ writer thread only """
+        self.f.seek(0, os.SEEK_END)
+        offset = self.f.tell()
+        self.f.write(data)
+        self.f.seek(i * ENTRY.size)
+        self.f.write(ENTRY.pack(offset, len(data)))
+        self.f.flush()
+        self.index[i] = (offset, len(data))
+
+    def close(self):
+        self.map.close()
+        self.f.close()
+
+
+class ChunkCache(object):
+    """
+    get and put compressed chunks by chunk coords. Puts are visible to get
+    immediately and written to disk in the background.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.regions = {}
+        self.pending = {}
+        self.written = 0
+        for fname in os.listdir(directory):
+            match = region_name.match(fname)
+            if match:
+                rcoords = (int(match.group(1)), int(match.group(2)))
+                self.regions[rcoords] = Region(os.path.join(directory, fname))
+        self.queue = Queue()
+        self.writer = threading.Thread(target=self.write_loop, name="chunk cache writer")
+        self.writer.daemon = True
+        self.writer.start()
+        log.msg("%s: %d regions, %d chunks" % (directory, len(self.regions), len(self)))
+
+    def __len__(self):
+        return sum(1 for region in self.regions.itervalues() for _, length in region.index if length)
+
+    def __contains__(self, coords):
+        return self.get(coords) is not None
+
+    def get(self, coords):
+        """ compressed chunk at chunk coords or None """
+        data = self.pending.get(coords, None)
+        if data is not None:
+            return data
+        region = self.regions.get((coords[0] >> REGION_SHIFT, coords[1] >> REGION_SHIFT), None)
+        if region is None:
+            return None
+        return region.read(self.region_index(coords))
+
+    def put(self, coords, data):
+        self.pending[coords] = data
+        self.queue.put((coords, data))
+
+    def region_index(self, coords):
+        mask = (1 << REGION_SHIFT) - 1
+        return (coords[1] & mask) * (1 << REGION_SHIFT) + (coords[0] & mask)
+
+    def write_loop(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            coords, data = item
+            rcoords = (coords[0] >> REGION_SHIFT, coords[1] >> REGION_SHIFT)
+            try:
+                region = self.regions.get(rcoords, None)
+                if region is None:
+                    path = os.path.join(self.directory, "r.%d.%d.tbr" % rcoords)
+                    region = self.regions.setdefault(rcoords, Region(path))
+                region.write(self.region_index(coords), data)
+            except (IOError, OSError, mmap.error):
+                log.err(None, "cannot write chunk %s to %s" % (coords, self.directory))
+            reactor.callFromThread(self.on_written, coords, data)
+
+    def on_written(self, coords, data):
+        self.written += 1
+        if self.pending.get(coords, None) is data:
+            del self.pending[coords]
+
+    def close(self):
+        """ finish the pending writes """
+        self.queue.put(None)
+        self.writer.join()
+        self.pending.clear()
+        for region in self.regions.itervalues():
+            region.close()
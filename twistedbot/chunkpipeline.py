@@ -0,0 +1,181 @@
+"""
+Map chunk ingestion off the reactor thread.
+
+Chunk data is decompressed and split into sections in the reactor thread
+pool, zlib releases the GIL while it works. The finished chunks are
+applied to their grid on the reactor in the order the packets arrived.
+Grid operations that arrive while chunks are pending (block changes,
+explosions) are queued behind them so they never hit a chunk that is not
+loaded yet.
+"""
+
+import time
+import zlib
+from collections import deque
+from cStringIO import StringIO
+
+from twisted.internet import threads, reactor
+
+import logbot
+from grid import read_chunk_sections
+
+
+log = logbot.getlogger("CHUNKS")
+
+
+def decode_chunk(continuous, primary_bit, add_bit, zdata, chunk_class):
+    """ runs in the thread pool, returns (sections, decode time) """
+    start = time.time()
+    data = StringIO(zlib.decompress(zdata))
+    sections = read_chunk_sections(data, continuous, primary_bit, add_bit,
+                                   chunk_class=chunk_class)
+    return sections, time.time() - start
+
+
+def decode_bulk_chunk(metas, zdata, light_data, chunk_class):
+    """ runs in the thread pool, returns (list of sections, decode time) """
+    start = time.time()
+    data = StringIO(zlib.decompress(zdata))
+    sections = [read_chunk_sections(data, True, meta.primary_bitmap,
+                                    meta.add_bitmap, light_data=light_data,
+                                    chunk_class=chunk_class)
+                for meta in metas]
+    return sections, time.time() - start
+
+
+class Job(object):
+    __slots__ = ("ready", "func", "args", "queued")
+
+    def __init__(self, func, args, ready):
+        self.ready = ready
+        self.func = func
+        self.args = args
+        self.queued = time.time()
+
+
+class ChunkPipeline(object):
+    """
+    Queue of grid work applied in arrival order.
+
+    Statistics: depth is the number of jobs waiting, max_depth the deepest
+    the queue got, decode_time and decode_max the total and worst thread
+    pool time per chunk packet, wait_max the worst time from arrival to
+    being applied.
+
+    With a budget, flush applies jobs for at most that many seconds and
+    continues in the next reactor iteration.
+    """
+
+    def __init__(self, budget=None):
+        self.budget = budget
+        self.flush_scheduled = False
+        self.jobs = deque()
+        self.decoded = 0
+        self.decode_time = 0.0
+        self.decode_max = 0.0
+        self.wait_max = 0.0
+        self.max_depth = 0
+        self.burst = 0
+
+    @property
+    def depth(self):
+        return len(self.jobs)
+
+    @property
+    def busy(self):
+        return bool(self.jobs)
+
+    def load_chunk(self, grid, x, z, continuous, primary_bit, add_bit, zdata):
+        job = self._queue(self._apply_chunk,
+                          [grid, x, z, continuous, primary_bit])
+        d = threads.deferToThread(decode_chunk, continuous, primary_bit,
+                                  add_bit, zdata, grid.chunk_class)
+        d.addCallbacks(self._decoded, self._failed,
+                       callbackArgs=(job,), errbackArgs=(job,))
+
+    def load_bulk_chunk(self, grid, metas, zdata, light_data):
+        job = self._queue(self._apply_bulk_chunk, [grid, metas])
+        d = threads.deferToThread(decode_bulk_chunk, metas, zdata,
+                                  light_data, grid.chunk_class)
+        d.addCallbacks(self._decoded, self._failed,
+                       callbackArgs=(job,), errbackArgs=(job,))
+
+    def call(self, func, *args):
+        """ call func now, or after the pending chunks are applied """
+        if self.jobs:
+            self._queue(func, args, ready=True)
+        else:
+            func(*args)
+
+    def _queue(self, func, args, ready=False):
+        job = Job(func, args, ready)
+        self.jobs.append(job)
+        self.burst += 1
+        self.max_depth = max(self.max_depth, len(self.jobs))
+        return job
+
+    def _decoded(self, result, job):
+        sections, decode_time = result
+        self.decoded += 1
+        self.decode_time += decode_time
+        self.decode_max = max(self.decode_max, decode_time)
+        job.args.append(sections)
+        job.ready = True
+        if not self.flush_scheduled:
+            self.flush()
+
+    def _failed(self, failure, job):
+        log.err(failure, "chunk decoding failed")
+        job.func = None
+        job.ready = True
+        if not self.flush_scheduled:
+            self.flush()
+
+    def flush(self):
+        """ apply the finished jobs at the head of the queue """
+        self.flush_scheduled = False
+        jobs = self.jobs
+        if self.budget is not None:
+            deadline = time.time() + self.budget
+        while jobs and jobs[0].ready:
+            if self.budget is not None and time.time() > deadline:
+                self.flush_scheduled = True
+                reactor.callLater(0, self.flush)
+                return
+            job = jobs.popleft()
+            self.wait_max = max(self.wait_max, time.time() - job.queued)
+            if job.func is not None:
+                try:
+                    job.func(*job.args)
+                except Exception:
+                    log.err(None, "queued grid job %s failed" % job.func.__name__)
+        if not jobs and self.burst > 1:
+            log.msg("applied %d queued grid jobs, %s" %
+                    (self.burst, self.report()))
+        if not jobs:
+            self.burst = 0
+
+    def reset(self):
+        """ drop the queued jobs, their packets belong to a lost connection """
+        if self.jobs:
+            log.msg("dropping %d queued grid jobs" % len(self.jobs))
+        self.jobs.clear()
+        self.burst = 0
+
+    def _apply_chunk(self, grid, x, z, continuous, primary_bit, sections):
+        grid.load_chunk_sections(x, z, continuous, primary_bit, sections)
+        grid.chunk_updated(x, z)
+
+    def _apply_bulk_chunk(self, grid, metas, sections):
+        for meta, chunk_sections in zip(metas, sections):
+            grid.load_chunk_sections(meta.x, meta.z, True,
+                                     meta.primary_bitmap, chunk_sections)
+        for meta in metas:
+            grid.chunk_updated(meta.x, meta.z)
+
+    def report(self):
+        avg = self.decode_time / self.decoded if self.decoded else 0
+        return ("queue depth %d max %d, decoded %d, decode avg %.1f ms "
+                "max %.1f ms, wait max %.1f ms" %
+                (len(self.jobs), self.max_depth, self.decoded, avg * 1000,
+                 self.decode_max * 1000, self.wait_max * 1000))
@@ -16,9 +16,29 @@ SERVER_PORT = 25565
 PROTOCOL_VERSION = 51  # minecraft version 1.4.7
 CONNECTION_MAX_DELAY = 5
 CONNECTION_INITIAL_DELAY = 0.1
+# keep entity metadata undecoded, nothing in the bot reads it yet
+DECODE_ENTITY_METADATA = False
+# seconds of chunk and tile work done per reactor iteration
+PACKET_TIME_BUDGET = 0.02
 
 WORLD_HEIGHT = 256
 CHUNK_SIDE_LEN = 16
+# store chunk sections in numpy arrays when numpy is installed
+NUMPY_CHUNKS = True
+# loaded chunks kept per dimension, None for no limit; the farthest
+# from the bot are evicted first, never those within CHUNK_KEEP_RADIUS
+CHUNK_BUDGET = 1024
+# an overworld chunk of compact sections takes about 17 KiB, see
+# Chunk.memory_estimate; the byte budget cuts in for chunks that average
+# over 32 KiB, as when most of their sections are dense
+CHUNK_BUDGET_MB = 32
+CHUNK_KEEP_RADIUS = 8
+# keep evicted chunks zlib compressed in memory, up to EVICTED_CHUNKS_MB
+COMPRESS_EVICTED_CHUNKS = True
+EVICTED_CHUNKS_MB = 64
+# chunks seen before are kept on disk here, per server and dimension, and
+# used as stale terrain until the server sends them again; None disables
+CHUNK_CACHE_DIR = "chunk_cache"
 
 PLAYER_HEIGHT = 1.8
 PLAYER_EYELEVEL = 1.62
@@ -54,3 +74,25 @@ PATHFIND_MAX = 256    # (future) Max distance to use pathfinder for
 PATHFIND_MIN = 15     # (future) Always use at least this much pathfinding
 PATHFIND_EXEC_TIME_LIMIT = 1.0 / 10   # in seconds.
 HORIZONTAL_MOVE_DISTANCE_LIMIT = 2.83
+# paths longer than this are searched on the chunk section portal graph
+HPA_MIN_DISTANCE = 48
+HPA_EXEC_TIME_LIMIT = 1.0   # in seconds.
+PORTAL_CLUSTERS = 512
+# in cluster searches kept for the portal graph, least recently used go first
+PORTAL_SEARCHES = 1024
+# paths kept per dimension for repeated travels, see pathfinding.PathCache
+PATH_CACHE_SIZE = 64
+# path searches run in this many worker processes, 0 keeps them on the reactor
+PATHFIND_WORKERS = 2
+PATHFIND_WORKER_TIME_LIMIT = 1.0   # in seconds.
+# a worker result later than its time limit plus this is given up on
+PATHFIND_WORKER_TIME_MARGIN = 2.0   # in seconds.
+# blocks around the start and goal a worker sees, at most this many sections
+PATHFIND_SNAPSHOT_MARGIN = 16
+PATHFIND_SNAPSHOT_SECTIONS = 256
+# sends of a search whose snapshot keeps changing, then it runs on the reactor
+PATHFIND_STALE_RETRIES = 3
+# positions the incremental follow planner keeps before starting over
+DSTAR_MAX_NODES = 65536
+# walkability sections kept per dimension for path searches, 4 KiB each
+WALKABILITY_SECTIONS = 4096
@@ -1,4 +1,5 @@
 
+import time
 from collections import deque
 
 from twisted.internet.protocol import ReconnectingClientFactory, Protocol
@@ -8,11 +9,15 @@ import config
 import logbot
 import proxy_processors.default
 import utils
-from packets import parse_packets, make_packet, packets_by_name, Container
+import packets
+from chunkpipeline import ChunkPipeline
+from packets import PacketBuffer, make_packet, packets_by_name, Container
+from packets import make_fast_packet, decoders
 from proxy_processors.default import process_packets as packet_printout
 
 proxy_processors.default.ignore_packets = []
 proxy_processors.default.filter_packets = []
+packets.decode_entity_metadata = config.DECODE_ENTITY_METADATA
 
 log = logbot.getlogger("FACTORY")
 
@@ -26,12 +31,29 @@ for pack in enabled_packets:
 
 
 class MineCraftProtocol(Protocol):
+    # packets are handled by priority, control and movement first, entity
+    # updates next, chunk and tile work last within PACKET_TIME_BUDGET
+    # per reactor iteration. Window packets, transaction confirms among
+    # them, keep the order the server sent them in.
+    high_priority_packets = set([0x00, 0x01, 0x08, 0x09, 0x0d,
+                                 0xfc, 0xfd, 0xff])
+    low_priority_packets = set([0x33, 0x34, 0x35, 0x38, 0x3c, 0x82])
+    # everything queued before these is handled before them
+    barrier_packets = set([0x09])
+    # the handlers drop these, they are only length-scanned and skipped
+    skip_packets = set([0x29, 0x2a, 0x36, 0x37, 0x3d, 0x3e,
+                        0x83, 0x84, 0xca, 0xfa])
+
     def __init__(self, world):
         self.world = world
         self.world.protocol = self
-        self.leftover = ""
+        self.buffer = PacketBuffer(interest=self.packet_interest())
         self.encryption_on = False
         self.packets = deque()
+        self.high_packets = deque()
+        self.low_packets = deque()
+        self.packet_iter_scheduled = False
+        self.chunks = ChunkPipeline(budget=config.PACKET_TIME_BUDGET)
         self._transactions = {}
         self._last_token = 0
 
@@ -101,6 +123,14 @@ class MineCraftProtocol(Protocol):
             0xff: self.p_error,
         }
 
+    def packet_interest(self):
+        """ ids of the packets to decode, logged packets are decoded too """
+        interest = set(packets_by_name.itervalues()) - self.skip_packets
+        if config.DEBUG:
+            interest.update(pid for pid, logged in
+                            log_packet_types.iteritems() if logged)
+        return interest
+
     def connectionMade(self):
         self.world.connection_made()
         log.msg("sending HANDSHAKE")
@@ -111,6 +141,9 @@ class MineCraftProtocol(Protocol):
 
     def connectionLost(self, reason):
         self.packets = deque()
+        self.high_packets = deque()
+        self.low_packets = deque()
+        self.chunks.reset()
         self.world.on_connection_lost()
 
     def sendData(self, bytestream):
@@ -127,13 +160,19 @@ class MineCraftProtocol(Protocol):
     def parse_stream(self, bytestream):
         if self.encryption_on:
             bytestream = self.decipher.decrypt(bytestream)
-        parsed_packets, self.leftover = parse_packets(
-            self.leftover + bytestream)
+        self.buffer.feed(bytestream)
+        parsed_packets = self.buffer.parse()
         if config.DEBUG:
             packet_printout("SERVER", parsed_packets, self.encryption_on,
-                            self.leftover, log_packet_types)
-        self.packets.extend(parsed_packets)
-        self.packet_iter(self.packets)
+                            types=log_packet_types)
+        for packet in parsed_packets:
+            if packet[0] in self.high_priority_packets:
+                self.high_packets.append(packet)
+            elif packet[0] in self.low_priority_packets:
+                self.low_packets.append(packet)
+            else:
+                self.packets.append(packet)
+        self.packet_iter()
 
     def send_packet(self, name, payload):
         p = make_packet(name, payload)
@@ -143,7 +182,42 @@ class MineCraftProtocol(Protocol):
                             types=log_packet_types)
         self.sendData(p)
 
-    def packet_iter(self, ipackets):
+    def send_fast_packet(self, name, *values):
+        p = make_fast_packet(name, *values)
+        if config.DEBUG:
+            pid = ord(p[0])
+            packet_printout("CLIENT", [(pid, decoders[pid](p, 1)[0])],
+                            types=log_packet_types)
+        self.sendData(p)
+
+    def packet_iter(self):
+        while self.high_packets:
+            packet = self.high_packets.popleft()
+            if packet[0] in self.barrier_packets:
+                self.drain(self.packets)
+                self.drain(self.low_packets)
+            self.process_packet(packet)
+        self.drain(self.packets)
+        deadline = time.time() + config.PACKET_TIME_BUDGET
+        while self.low_packets:
+            if time.time() > deadline:
+                self.schedule_packet_iter()
+                break
+            self.process_packet(self.low_packets.popleft())
+
+    def schedule_packet_iter(self):
+        if not self.packet_iter_scheduled:
+            self.packet_iter_scheduled = True
+            reactor.callLater(0, self.scheduled_packet_iter)
+
+    def scheduled_packet_iter(self):
+        self.packet_iter_scheduled = False
+        try:
+            self.packet_iter()
+        except:
+            logbot.exit_on_error()
+
+    def drain(self, ipackets):
         while ipackets:
             packet = ipackets.popleft()
             self.process_packet(packet)
@@ -202,7 +276,7 @@ class MineCraftProtocol(Protocol):
 
     def p_ping(self, c):
         pid = c.pid
-        self.send_packet("keep alive", {"pid": pid})
+        self.send_fast_packet("keep alive", pid)
 
     def p_login(self, c):
         msg = ("LOGIN DATA eid %s level type: %s, game_mode: %s, "
@@ -359,14 +433,16 @@ class MineCraftProtocol(Protocol):
                                             total_experience=c.total)
 
     def p_chunk(self, c):
-        self.world.grid.on_load_chunk(c.x, c.z, c.continuous, c.primary_bitmap,
-                                      c.add_bitmap, c.data.decode('zlib'))
+        self.chunks.load_chunk(self.world.grid, c.x, c.z, c.continuous,
+                               c.primary_bitmap, c.add_bitmap, c.data)
 
     def p_multi_block_change(self, c):
-        self.world.grid.on_multi_block_change(c.x, c.z, c.blocks)
+        self.chunks.call(self.world.grid.on_multi_block_change,
+                         c.x, c.z, c.blocks)
 
     def p_block_change(self, c):
-        self.world.grid.on_block_change(c.x, c.y, c.z, c.type, c.meta)
+        self.chunks.call(self.world.grid.on_block_change,
+                         c.x, c.y, c.z, c.type, c.meta)
 
     def p_block_action(self, c):
         """
@@ -379,11 +455,12 @@ class MineCraftProtocol(Protocol):
         pass
 
     def p_bulk_chunk(self, c):
-        self.world.grid.on_load_bulk_chunk(c.meta, c.data.decode('zlib'),
-                                           c.light_data)
+        self.chunks.load_bulk_chunk(self.world.grid, c.meta, c.data,
+                                    c.light_data)
 
     def p_explosion(self, c):
-        self.world.grid.on_explosion(c.x, c.y, c.z, c.records)
+        self.chunks.call(self.world.grid.on_explosion,
+                         c.x, c.y, c.z, c.records)
         log.msg("Explosion at %f %f %f radius %f blocks affected %d" %
                 (c.x, c.y, c.z, c.radius, c.count))
 
@@ -1,21 +1,159 @@
 
 import StringIO
 import array
+import bisect
+import marshal
+import zlib
+from collections import defaultdict
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 import utils
 import blocks
 import config
 import logbot
 import fops
+import sections
 from axisbox import AABB
+from walkability import Walkability
+from portals import PortalGraph
 
 
 log = logbot.getlogger("GRID")
 
+# heightmaps, see Grid.column_height
+HEIGHT_UNKNOWN = -2
+STANDABLE = blocks.STAND_ON | blocks.CLIMBABLE
+SOLID = blocks.COLLIDABLE
+
+# block kinds in the special block index, see Grid.special_blocks_in
+special_kinds = (("water", (blocks.FlowingWater.number,
+                            blocks.StillWater.number)),
+                 ("lava", (blocks.FlowingLava.number,
+                           blocks.StillLava.number)),
+                 ("fire", (blocks.Fire.number,)),
+                 ("web", (blocks.Cobweb.number,)),
+                 ("ladder", (blocks.Ladders.number,)),
+                 ("vine", (blocks.Vines.number,)),
+                 ("sign", (blocks.SignPost.number, blocks.WallSign.number)))
+special_numbers = dict(special_kinds)
+special_kind = dict((number, kind) for kind, numbers in special_kinds
+                    for number in numbers)
+# more positions than this in a section are not listed, the section is read
+SPECIAL_DENSE = 2048
+# the chunk object, its attribute dict and section lists, see
+# Chunk.memory_estimate
+CHUNK_OBJECT_BYTES = 1536
+
+if numpy is not None:
+    flag_table = numpy.array(blocks.block_flags, dtype=numpy.uint32)
+    special_codes = numpy.zeros(4096, dtype=numpy.uint8)
+    for _code, (_kind, _numbers) in enumerate(special_kinds):
+        special_codes[list(_numbers)] = _code + 1
+
+
+def pack_nibbles(values):
+    """ numpy array of one value per nibble to packed nibbles, low first """
+    return (values[0::2] & 15) | (values[1::2] << 4)
+
+
+def unpack_nibbles(packed):
+    """ numpy array of packed nibbles to one uint8 per nibble, low first """
+    out = numpy.empty(len(packed) * 2, dtype=numpy.uint8)
+    out[0::2] = packed & 15
+    out[1::2] = packed >> 4
+    return out
+
+
+def column_heights(chunk, masks):
+    """
+    {mask: array('h')} of the highest y per column, indexed z * 16 + x,
+    whose block flags match mask or might match it depending on the
+    neighbours, -1 where there is none. Needs numpy.
+    """
+    tops = dict((mask, numpy.empty((16, 16), dtype=numpy.int16))
+                for mask in masks)
+    for top in tops.itervalues():
+        top.fill(-1)
+    for level in xrange(chunk.levels - 1, -1, -1):
+        if chunk.blocks[level] is None:
+            continue
+        ids, meta = chunk.section_arrays(level)
+        flags = flag_table.take((ids.astype(numpy.uint32) << 4) | meta,
+                                mode='clip')
+        done = True
+        for mask, top in tops.iteritems():
+            hit = (flags & (mask | mask << blocks.NEIGHBOURS_SHIFT)) != 0
+            fill = hit.any(axis=0) & (top < 0)
+            top[fill] = (level << 4) + 15 - hit[::-1].argmax(axis=0)[fill]
+            done = done and (top >= 0).all()
+        if done:
+            break
+    return dict((mask, array.array('h', top.ravel().tolist()))
+                for mask, top in tops.iteritems())
+
+
+def section_specials(chunk, level):
+    """
+    {kind: positions} of the special blocks in a section, positions is a
+    sorted array('H') or None when there are more than SPECIAL_DENSE.
+    """
+    found = {}
+    section = chunk.blocks[level]
+    if isinstance(section, (array.array, sections.UniformSection,
+                            sections.PaletteSection)):
+        if isinstance(section, sections.UniformSection):
+            values = (section.value,)
+        elif isinstance(section, sections.PaletteSection):
+            values = section.palette
+        else:
+            values = None
+        if values is not None and \
+                not any(value in special_kind for value in values):
+            return found
+        data = section.tostring()
+        for kind, numbers in special_kinds:
+            count = sum(data.count(chr(number)) for number in numbers)
+            if count > SPECIAL_DENSE:
+                found[kind] = None
+            elif count:
+                positions = []
+                for number in numbers:
+                    char = chr(number)
+                    pos = data.find(char)
+                    while pos >= 0:
+                        positions.append(pos)
+                        pos = data.find(char, pos + 1)
+                found[kind] = array.array('H', sorted(positions))
+    else:
+        ids = chunk.section_arrays(level)[0].ravel()
+        codes = special_codes.take(ids, mode='clip')
+        hits = numpy.flatnonzero(codes)
+        if len(hits):
+            hit_codes = codes[hits]
+            for code in numpy.unique(hit_codes):
+                positions = hits[hit_codes == code]
+                kind = special_kinds[code - 1][0]
+                if len(positions) > SPECIAL_DENSE:
+                    found[kind] = None
+                else:
+                    found[kind] = array.array(
+                        'H', positions.astype(numpy.uint16).tostring())
+    return found
+
 
 class Chunk(object):
+    """
+    Sections stored as array('B') of block ids and array('B') of packed
+    meta nibbles, in y, z, x order. Sections are loaded in the compact
+    forms from the sections module and made dense on the first write.
+    """
     levels = config.WORLD_HEIGHT / 16
+    # sections are compressed in the packet layout by both chunk classes
+    compress_format = 2
 
     def __init__(self, coords):
         self.coords = coords
@@ -27,10 +165,66 @@ class Chunk(object):
         self.meta = [None for _ in xrange(self.levels)]
         self.block_light = []  # ignore block light
         self.sky_light = []  # ignore sky light
-        self.biome = [None for _ in xrange(config.CHUNK_SIDE_LEN * config.CHUNK_SIDE_LEN)]
+        self.biome = None
         self.complete = False
+        # loaded from the chunk cache, not yet confirmed by the server
+        self.stale = False
+        # flags mask -> column heights, see Grid.column_height
+        self.heights = {}
+        # level -> section_specials of sections that have some
+        self.specials = {}
+
+    @classmethod
+    def make_section(cls, block_data, meta_data, add_data=None):
+        """ section storage from the packet data, add_data is dropped """
+        return sections.compact(block_data), sections.compact(meta_data)
+
+    def get_block_id(self, level, pos):
+        return self.blocks[level][pos]
+
+    def set_block(self, level, pos, block_type, meta):
+        section = self.blocks[level]
+        if not isinstance(section, array.array):
+            section = self.blocks[level] = sections.dense(section)
+        section[pos] = block_type
+        self.set_meta(level, pos, meta)
+
+    def set_blocks(self, level, writes):
+        """ apply a list of (pos, block id, meta) to a section """
+        section = self.blocks[level]
+        if not isinstance(section, array.array):
+            section = self.blocks[level] = sections.dense(section)
+        packed = self.meta[level]
+        if not isinstance(packed, array.array):
+            packed = self.meta[level] = sections.dense(packed)
+        for pos, block_type, meta in writes:
+            section[pos] = block_type
+            half = pos >> 1
+            if pos & 1:
+                packed[half] = (packed[half] & 15) | (meta << 4)
+            else:
+                packed[half] = (packed[half] & 240) | meta
+
+    def section_arrays(self, level):
+        """ (ids, meta) numpy arrays of a section shaped (16, 16, 16) """
+        ids, packed = self.blocks[level], self.meta[level]
+        if not isinstance(ids, array.array):
+            ids = ids.tostring()
+        if not isinstance(packed, array.array):
+            packed = packed.tostring()
+        ids = numpy.frombuffer(ids, dtype=numpy.uint8)
+        packed = numpy.frombuffer(packed, dtype=numpy.uint8)
+        return (ids.reshape(16, 16, 16),
+                unpack_nibbles(packed).reshape(16, 16, 16))
+
+    def section_info(self, level):
+        """ [(kind, bytes)] of the block and meta storage of a section """
+        return [sections.section_info(self.blocks[level]),
+                sections.section_info(self.meta[level])]
 
     def set_meta(self, level, pos, meta):
+        if not isinstance(self.meta[level], array.array):
+            self.meta[level] = sections.dense(self.meta[level])
         val = self.meta[level][pos / 2]
         if pos % 2 == 0:
             val = (val & 240) | meta
@@ -44,22 +238,268 @@ class Chunk(object):
         else:
             return self.meta[level][pos / 2] >> 4
 
+    def section_strings(self, level):
+        """ (ids, packed meta) of a section as strings in the packet layout """
+        return self.blocks[level].tostring(), self.meta[level].tostring()
+
+    def load_section_strings(self, level, ids, meta):
+        self.blocks[level], self.meta[level] = self.make_section(ids, meta)
+
+    def nbytes(self):
+        """ bytes held by the sections of this chunk, shared ones excluded """
+        return sum(nbytes for level in xrange(self.levels)
+                   if self.blocks[level] is not None
+                   for _, nbytes in self.section_info(level))
+
+    def memory_estimate(self):
+        """
+        nbytes plus the heightmaps, biome and special block positions of the
+        chunk and CHUNK_OBJECT_BYTES for the chunk object itself
+        """
+        total = self.nbytes() + CHUNK_OBJECT_BYTES
+        for heights in self.heights.itervalues():
+            total += heights.itemsize * len(heights)
+        if self.biome is not None:
+            total += len(self.biome)
+        for found in self.specials.itervalues():
+            for positions in found.itervalues():
+                if positions is not None:
+                    total += positions.itemsize * len(positions)
+        return total
+
+    def compress(self):
+        """ zlib compressed copy of the chunk, see decompress """
+        packed = [(level,) + self.section_strings(level)
+                  for level in xrange(self.levels)
+                  if self.blocks[level] is not None]
+        biome = None if self.biome is None else self.biome.tostring()
+        return zlib.compress(marshal.dumps((self.compress_format,
+                                            self.complete, biome, packed)), 1)
+
+    @classmethod
+    def decompress(cls, coords, data):
+        """ chunk from compress, None when data is in an older format """
+        stored = marshal.loads(zlib.decompress(data))
+        if len(stored) != 4 or stored[0] != cls.compress_format:
+            return None
+        _, complete, biome, packed = stored
+        chunk = cls(coords)
+        chunk.complete = complete
+        if biome is not None:
+            chunk.biome = array.array('b', biome)
+        for level, ids, meta in packed:
+            chunk.load_section_strings(level, ids, meta)
+        return chunk
+
     def __str__(self):
-        return "%s %s %s" % (str(self.coords), self.complete, [i if i is None else 1 for i in self.blocks])
+        return "%s %s%s %s" % (str(self.coords), self.complete,
+                               " stale" if self.stale else "",
+                               [i if i is None else 1 for i in self.blocks])
+
+
+class NumpyChunk(Chunk):
+    """
+    Dense sections stored as flat numpy uint8 arrays in y, z, x order,
+    block ids and packed meta nibbles as in the packet data. Uniform and
+    palette sections stay compact as in Chunk until the first write.
+    """
+
+    @classmethod
+    def make_section(cls, block_data, meta_data, add_data=None):
+        """ add_data is dropped, the block tables cover 8 bit ids only """
+        return cls.compact(block_data), cls.compact(meta_data)
+
+    @staticmethod
+    def compact(data_str):
+        section = sections.compact(data_str)
+        if isinstance(section, array.array):
+            return numpy.frombuffer(data_str, dtype=numpy.uint8).copy()
+        return section
+
+    @staticmethod
+    def as_array(section):
+        if isinstance(section, numpy.ndarray):
+            return section
+        return numpy.frombuffer(section.tostring(), dtype=numpy.uint8)
+
+    @classmethod
+    def writable(cls, arrays, level):
+        section = arrays[level]
+        if not isinstance(section, numpy.ndarray):
+            section = arrays[level] = cls.as_array(section).copy()
+        return section
+
+    def get_block_id(self, level, pos):
+        return int(self.blocks[level][pos])
+
+    def set_block(self, level, pos, block_type, meta):
+        self.writable(self.blocks, level)[pos] = block_type
+        self.set_meta(level, pos, meta)
+
+    def set_blocks(self, level, writes):
+        positions, ids, metas = zip(*writes)
+        positions = list(positions)
+        # numpy fancy assignment keeps the last write to a position
+        self.writable(self.blocks, level)[positions] = ids
+        meta = unpack_nibbles(self.as_array(self.meta[level]))
+        meta[positions] = metas
+        self.meta[level] = pack_nibbles(meta)
+
+    def section_arrays(self, level):
+        ids = self.as_array(self.blocks[level])
+        meta = unpack_nibbles(self.as_array(self.meta[level]))
+        return ids.reshape(16, 16, 16), meta.reshape(16, 16, 16)
+
+    def section_info(self, level):
+        return [("dense", section.nbytes) if isinstance(section, numpy.ndarray)
+                else sections.section_info(section)
+                for section in (self.blocks[level], self.meta[level])]
+
+    def set_meta(self, level, pos, meta):
+        packed = self.writable(self.meta, level)
+        half = pos >> 1
+        if pos & 1:
+            packed[half] = (packed[half] & 15) | (meta << 4)
+        else:
+            packed[half] = (packed[half] & 240) | meta
+
+    def get_meta(self, level, pos):
+        if pos & 1:
+            return int(self.meta[level][pos >> 1]) >> 4
+        return int(self.meta[level][pos >> 1]) & 15
+
+
+def read_chunk_sections(data, continuous, primary_bit, add_bit,
+                        light_data=True, chunk_class=Chunk):
+    """
+    Read one chunk column from the decompressed data stream.
+
+    Returns (blocks, meta, biome), blocks and meta are lists indexed by
+    section level, in the storage of chunk_class. Touches no grid state,
+    can run outside the reactor.
+    """
+    blocks = [None] * Chunk.levels
+    meta = [None] * Chunk.levels
+    block_data = {}
+    meta_data = {}
+    add_data = {}
+    biome = None
+    for i in xrange(Chunk.levels):
+        if primary_bit & (1 << i):
+            block_data[i] = data.read(4096)  # y, z, x
+    for i in xrange(Chunk.levels):
+        if primary_bit & (1 << i):
+            meta_data[i] = data.read(2048)
+    if light_data:
+        for i in xrange(Chunk.levels):
+            if primary_bit & (1 << i):
+                data_str = data.read(2048)
+                #ndata = array.array('B', data_str)
+        for i in xrange(Chunk.levels):
+            if primary_bit & (1 << i):
+                data_str = data.read(2048)
+                #ndata = array.array('B', data_str)
+    # higher block id value will be used after Mojang adds them
+    if add_bit > 0:
+        for i in xrange(Chunk.levels):
+            if add_bit >> i & 1:
+                add_data[i] = data.read(2048)
+    for i in block_data:
+        blocks[i], meta[i] = chunk_class.make_section(block_data[i],
+                                                      meta_data[i],
+                                                      add_data.get(i, None))
+    if continuous:
+        data_str = data.read(256)
+        biome = array.array('b', data_str)
+    return blocks, meta, biome
+
+
+def touching(bb1, bb2):
+    """ True when the boxes overlap or share a face, edge or corner """
+    for i in xrange(3):
+        if bb1.maxs[i] < bb2.mins[i] or bb1.mins[i] > bb2.maxs[i]:
+            return False
+    return True
+
+
+class GridSubscription(object):
+    """
+    Collects the changed regions a subscriber is interested in, see
+    Grid.subscribe. Touching regions are merged, past max_regions they
+    collapse into one bounding box.
+    """
+    max_regions = 16
+
+    def __init__(self, grid, callback, aabb=None, chunks=None):
+        self.grid = grid
+        self.callback = callback
+        self.aabb = aabb
+        self.chunks = chunks
+        self.regions = []
+
+    def wants(self, bb):
+        if self.aabb is not None and not self.aabb.collides(bb):
+            return False
+        if self.chunks is not None:
+            max_x = ((bb.max_x - 1) >> 4) + 1
+            max_z = ((bb.max_z - 1) >> 4) + 1
+            for chunk_x in xrange(bb.min_x >> 4, max_x):
+                for chunk_z in xrange(bb.min_z >> 4, max_z):
+                    if (chunk_x, chunk_z) in self.chunks:
+                        return True
+            return False
+        return True
+
+    def add(self, bb):
+        if self.aabb is not None:
+            bb = bb.intersection(self.aabb)
+        merged = True
+        while merged:
+            merged = False
+            for i, region in enumerate(self.regions):
+                if touching(region, bb):
+                    bb = bb.union(self.regions.pop(i))
+                    merged = True
+                    break
+        self.regions.append(bb)
+        if len(self.regions) > self.max_regions:
+            self.regions = [reduce(lambda a, b: a.union(b), self.regions)]
+
+    def cancel(self):
+        self.grid.unsubscribe(self)
 
 
 class Grid(object):
+    if numpy is not None and config.NUMPY_CHUNKS:
+        chunk_class = NumpyChunk
+    else:
+        chunk_class = Chunk
+
     def __init__(self, dimension):
         self.dimension = dimension
         self.chunks = {}
         self.chunks_loaded = 0
+        # coords -> (complete, stale, compressed chunk) of evicted chunks,
+        # the compressed chunk is None when it is kept in the chunk cache
+        self.evicted = {}
+        self.evicted_bytes = 0
+        # chunkcache.ChunkCache of this grid and coords of chunks changed
+        # since they were last put into it
+        self.cache = None
+        self.dirty = set()
+        self.subscriptions = []
+        self.walkability = Walkability(self)
+        self.portals = PortalGraph(self)
         self.spawn_position = None
 
     def in_spawn_area(self, coords):
         return abs(coords[0] - self.spawn_position[0]) <= 16 or abs(coords[2] - self.spawn_position[2]) <= 16
 
     def get_chunk(self, coords):
-        return self.chunks.get(coords, None)
+        chunk = self.chunks.get(coords, None)
+        if chunk is None and (self.evicted or self.cache is not None):
+            chunk = self.restore_chunk(coords)
+        return chunk
 
     def make_block(self, x, y, z, block_type, meta):
         return blocks.block_map[block_type](self, x, y, z, meta)
@@ -67,76 +507,375 @@ class Grid(object):
     def get_block_coords(self, crds):
         return self.get_block(crds.x, crds.y, crds.z)
 
+    def get_block_type(self, x, y, z):
+        """ (block id, meta) at x, y, z """
+        if y > 255 or y < 0:
+            return 0, 0
+        chunk = self.chunks.get((x >> 4, z >> 4), None)
+        if chunk is None:
+            if self.evicted or self.cache is not None:
+                chunk = self.restore_chunk((x >> 4, z >> 4))
+            if chunk is None:
+                return 0, 0
+        y_level = y >> 4
+        if chunk.blocks[y_level] is None:
+            return 0, 0
+        pos = (y & 15) * 256 + (z & 15) * 16 + (x & 15)
+        return chunk.get_block_id(y_level, pos), chunk.get_meta(y_level, pos)
+
     def get_block(self, x, y, z):
+        block_type, meta = self.get_block_type(x, y, z)
+        return self.make_block(x, y, z, block_type, meta)
+
+    def get_block_flags(self, x, y, z):
+        """ blocks property flags of the block at x, y, z """
         if y > 255 or y < 0:
-            return self.make_block(x, y, z, 0, 0)
-        chunk_x = x >> 4
-        chunk_z = z >> 4
-        chunk = self.get_chunk((chunk_x, chunk_z))
+            return blocks.block_flags[0]
+        chunk = self.chunks.get((x >> 4, z >> 4), None)
         if chunk is None:
-            return self.make_block(x, y, z, 0, 0)
+            if self.evicted or self.cache is not None:
+                chunk = self.restore_chunk((x >> 4, z >> 4))
+            if chunk is None:
+                return blocks.block_flags[0]
         y_level = y >> 4
-        block_types = chunk.blocks[y_level]
-        if block_types is None:
-            return self.make_block(x, y, z, 0, 0)
-        cx = x & 15
-        cy = y & 15
-        cz = z & 15
-        pos = self.chunk_array_position(cx, cy, cz)
-        return self.make_block(x, y, z, block_types[pos], chunk.get_meta(y_level, pos))
+        if chunk.blocks[y_level] is None:
+            return blocks.block_flags[0]
+        pos = (y & 15) * 256 + (z & 15) * 16 + (x & 15)
+        block_type = chunk.get_block_id(y_level, pos)
+        meta = chunk.get_meta(y_level, pos)
+        flags = blocks.block_flags[block_type << 4 | meta]
+        if flags & blocks.NEIGHBOURS_MASK:
+            flags = blocks.compute_flags(self.make_block(x, y, z, block_type,
+                                                         meta))
+        return flags
+
+    def get_block_prototype(self, x, y, z):
+        """
+        Block at x, y, z for type and meta queries. Usually a shared
+        instance without coordinates, see blocks.prototype.
+        """
+        block_type, meta = self.get_block_type(x, y, z)
+        blk = blocks.prototype(block_type, meta)
+        if blk.neighbour_dependent:
+            return self.make_block(x, y, z, block_type, meta)
+        return blk
+
+    def block_prototypes_in_aabb(self, bb):
+        """ get_block_prototype of the blocks in the grid area of bb """
+        for x, y, z in bb.grid_area:
+            yield self.get_block_prototype(x, y, z)
+
+    def get_region(self, x0, y0, z0, x1, y1, z1):
+        """
+        Block ids and meta of the box x0 <= x < x1, y0 <= y < y1,
+        z0 <= z < z1 as two numpy arrays indexed [x - x0, y - y0, z - z0].
+        Unloaded and out of world blocks read as air. Without numpy the
+        two are nested lists indexed [x - x0][y - y0][z - z0].
+        """
+        if numpy is None:
+            return self.region_lists(x0, y0, z0, x1, y1, z1)
+        shape = (x1 - x0, y1 - y0, z1 - z0)
+        ids = numpy.zeros(shape, dtype=numpy.uint8)
+        metas = numpy.zeros(shape, dtype=numpy.uint8)
+        ylo = max(y0, 0)
+        yhi = min(y1, config.WORLD_HEIGHT)
+        if min(shape) <= 0 or ylo >= yhi:
+            return ids, metas
+        for chunk_x in xrange(x0 >> 4, ((x1 - 1) >> 4) + 1):
+            bx0 = max(x0, chunk_x << 4)
+            bx1 = min(x1, (chunk_x << 4) + 16)
+            for chunk_z in xrange(z0 >> 4, ((z1 - 1) >> 4) + 1):
+                chunk = self.get_chunk((chunk_x, chunk_z))
+                if chunk is None:
+                    continue
+                bz0 = max(z0, chunk_z << 4)
+                bz1 = min(z1, (chunk_z << 4) + 16)
+                for level in xrange(ylo >> 4, ((yhi - 1) >> 4) + 1):
+                    if chunk.blocks[level] is None:
+                        continue
+                    by0 = max(ylo, level << 4)
+                    by1 = min(yhi, (level << 4) + 16)
+                    section_ids, section_meta = chunk.section_arrays(level)
+                    source = (slice(by0 - (level << 4), by1 - (level << 4)),
+                              slice(bz0 & 15, (bz0 & 15) + bz1 - bz0),
+                              slice(bx0 & 15, (bx0 & 15) + bx1 - bx0))
+                    target = (slice(bx0 - x0, bx1 - x0),
+                              slice(by0 - y0, by1 - y0),
+                              slice(bz0 - z0, bz1 - z0))
+                    ids[target] = section_ids[source].transpose(2, 0, 1)
+                    metas[target] = section_meta[source].transpose(2, 0, 1)
+        return ids, metas
+
+    def region_lists(self, x0, y0, z0, x1, y1, z1):
+        """ get_region as nested lists, block by block """
+        ids = []
+        metas = []
+        for x in xrange(x0, x1):
+            ids.append([])
+            metas.append([])
+            for y in xrange(y0, y1):
+                column = [self.get_block_type(x, y, z) for z in xrange(z0, z1)]
+                ids[-1].append([block_type for block_type, _ in column])
+                metas[-1].append([meta for _, meta in column])
+        return ids, metas
+
+    def memory_report(self):
+        """
+        Chunk count and section storage of this grid. Sections counts
+        block and meta storage separately, bytes excludes shared sections.
+        """
+        report = {"chunks": len(self.chunks), "sections": 0, "bytes": 0,
+                  "stale": sum(1 for chunk in self.chunks.itervalues()
+                               if chunk.stale),
+                  "dense": 0, "palette": 0, "uniform": 0,
+                  "evicted": len(self.evicted),
+                  "evicted_bytes": self.evicted_bytes,
+                  "walkability": len(self.walkability),
+                  "portals": len(self.portals),
+                  "portal_searches": len(self.portals.searched),
+                  "portal_positions": self.portals.searched.positions}
+        for chunk in self.chunks.itervalues():
+            for level in xrange(chunk.levels):
+                if chunk.blocks[level] is None:
+                    continue
+                for kind, nbytes in chunk.section_info(level):
+                    report["sections"] += 1
+                    report[kind] += 1
+                    report["bytes"] += nbytes
+        return report
+
+    def evict_chunk(self, coords):
+        """
+        Drop a chunk from memory. Keep it in the chunk cache when there is
+        one, otherwise compressed in memory if configured.
+        """
+        chunk = self.chunks.pop(coords)
+        self.walkability.drop_chunk(*coords)
+        if self.cache is not None:
+            if coords in self.dirty:
+                self.dirty.discard(coords)
+                self.cache.put(coords, chunk.compress())
+            if not chunk.stale:
+                self.evicted[coords] = (chunk.complete, False, None)
+        elif config.COMPRESS_EVICTED_CHUNKS:
+            data = chunk.compress()
+            self.evicted[coords] = (chunk.complete, chunk.stale, data)
+            self.evicted_bytes += len(data)
+
+    def restore_chunk(self, coords):
+        """
+        Bring an evicted chunk back, or load a stale one from the chunk
+        cache. None if there is none.
+        """
+        entry = self.evicted.pop(coords, None)
+        if entry is not None and entry[2] is not None:
+            self.evicted_bytes -= len(entry[2])
+            data = entry[2]
+        elif self.cache is not None:
+            data = self.cache.get(coords)
+            if data is None:
+                return None
+        else:
+            return None
+        chunk = self.chunk_class.decompress(coords, data)
+        if chunk is None:
+            return None
+        chunk.stale = entry is None or entry[1]
+        self.chunks[coords] = chunk
+        self.index_chunk(chunk)
+        return chunk
+
+    def forget_chunk(self, coords):
+        """ drop a chunk from memory, the chunk cache keeps it as stale """
+        chunk = self.chunks.pop(coords, None)
+        self.walkability.drop_chunk(*coords)
+        if chunk is not None and coords in self.dirty:
+            self.dirty.discard(coords)
+            self.cache.put(coords, chunk.compress())
+        entry = self.evicted.pop(coords, None)
+        if entry is not None and entry[2] is not None:
+            self.evicted_bytes -= len(entry[2])
+
+    def save_dirty(self):
+        """ put the changed chunks into the chunk cache """
+        if self.cache is None:
+            return
+        for coords in self.dirty:
+            chunk = self.chunks.get(coords, None)
+            if chunk is not None:
+                self.cache.put(coords, chunk.compress())
+        self.dirty.clear()
+
+    def mark_stale(self):
+        """ everything known so far needs confirmation from the server """
+        for chunk in self.chunks.itervalues():
+            chunk.stale = True
+        self.save_dirty()
+        self.evicted.clear()
+        self.evicted_bytes = 0
+
+    def chunk_stale_at(self, x, z):
+        """ True when the chunk at x, z is from the cache and not sent yet """
+        coords = x >> 4, z >> 4
+        chunk = self.chunks.get(coords, None)
+        if chunk is None:
+            return coords not in self.evicted and self.cache is not None \
+                and coords in self.cache
+        return chunk.stale
+
+    def enforce_budget(self, center=None, max_chunks=None, max_bytes=None,
+                       keep_radius=0):
+        """
+        Evict the chunks farthest from center, chunk coords, until at most
+        max_chunks loaded chunks holding at most max_bytes remain. Chunks
+        within keep_radius of center stay. Without a center every chunk
+        can go. Compressed chunks beyond config.EVICTED_CHUNKS_MB are
+        dropped, farthest first.
+        """
+        if center is None:
+            distance = lambda crd: 0
+        else:
+            distance = lambda crd: max(abs(crd[0] - center[0]),
+                                       abs(crd[1] - center[1]))
+        count = len(self.chunks)
+        total = 0
+        if max_bytes is not None:
+            total = sum(chunk.memory_estimate()
+                        for chunk in self.chunks.itervalues())
+        evicted = 0
+        for crd in sorted(self.chunks, key=distance, reverse=True):
+            if (max_chunks is None or count <= max_chunks) and \
+                    (max_bytes is None or total <= max_bytes):
+                break
+            if center is not None and distance(crd) <= keep_radius:
+                break
+            if max_bytes is not None:
+                total -= self.chunks[crd].memory_estimate()
+            self.evict_chunk(crd)
+            count -= 1
+            evicted += 1
+        dropped = 0
+        max_evicted = config.EVICTED_CHUNKS_MB * 1024 * 1024
+        if self.evicted_bytes > max_evicted:
+            for crd in sorted(self.evicted, key=distance, reverse=True):
+                self.forget_chunk(crd)
+                dropped += 1
+                if self.evicted_bytes <= max_evicted:
+                    break
+        if evicted or dropped:
+            log.msg("evicted %d chunks, dropped %d compressed, %d loaded, "
+                    "%d compressed %.1f KiB" %
+                    (evicted, dropped, len(self.chunks), len(self.evicted),
+                     self.evicted_bytes / 1024.0))
+
+    def subscribe(self, callback, aabb=None, chunks=None):
+        """
+        Have callback(regions) called from deliver_changes with a list of
+        AABBs that changed since the last call. Limit to changes within
+        aabb and/or the set of chunk coords chunks. Sources are chunk
+        loads and unloads through chunk_updated (whole chunk columns),
+        block changes, multi block changes and explosions. Returns a
+        GridSubscription.
+        """
+        subscription = GridSubscription(self, callback, aabb=aabb,
+                                        chunks=chunks)
+        self.subscriptions.append(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        if subscription in self.subscriptions:
+            self.subscriptions.remove(subscription)
+
+    def publish(self, bb):
+        for subscription in self.subscriptions:
+            if subscription.wants(bb):
+                subscription.add(bb)
+
+    def deliver_changes(self):
+        """ called once per tick, hands the collected regions out """
+        for subscription in self.subscriptions[:]:
+            if not subscription.regions:
+                continue
+            regions, subscription.regions = subscription.regions, []
+            try:
+                subscription.callback(regions)
+            except Exception:
+                log.err(None, "grid change subscriber %s failed" %
+                        subscription.callback)
+
+    def chunk_column(self, chunk_x, chunk_z):
+        return AABB(chunk_x << 4, 0, chunk_z << 4,
+                    (chunk_x << 4) + 16, config.WORLD_HEIGHT,
+                    (chunk_z << 4) + 16)
 
     def chunk_updated(self, chunk_x, chunk_z):
-        pass
+        if self.subscriptions:
+            self.publish(self.chunk_column(chunk_x, chunk_z))
 
     def new_chunk(self, x, z):
         crd = (x, z)
-        chunk = Chunk(crd)
+        chunk = self.chunk_class(crd)
         self.chunks[crd] = chunk
         return chunk
 
-    def _load_chunk(self, x, z, continuous, primary_bit, add_bit, data, light_data=True):
+    def load_chunk_sections(self, x, z, continuous, primary_bit, sections):
+        """ store sections returned by read_chunk_sections """
         if primary_bit == 0:
-            try:
-                del self.chunks[(x, z)]
+            if (x, z) in self.chunks or (x, z) in self.evicted:
+                self.forget_chunk((x, z))
                 return
-            except KeyError:
-                pass
         self.chunks_loaded += 1
-        chunk = self.get_chunk((x, z))
-        if chunk is None:
+        if continuous:
+            # complete data, no need to bring back an older copy
+            self.dirty.discard((x, z))
+            self.forget_chunk((x, z))
             chunk = self.new_chunk(x, z)
+        else:
+            chunk = self.get_chunk((x, z))
+            if chunk is None:
+                chunk = self.new_chunk(x, z)
+        if self.cache is not None:
+            self.dirty.add((x, z))
         if continuous:
             chunk.complete = True
+            chunk.stale = False
         else:
             log.msg("WARNING: received noncontinuous chunk, current complete state is %s" % chunk.complete)
+        blocks, meta, biome = sections
         for i in xrange(chunk.levels):
             if primary_bit & (1 << i):
-                data_str = data.read(4096)
-                ndata = array.array('B', data_str)  # y, z, x
-                chunk.blocks[i] = ndata
-        for i in xrange(chunk.levels):
-            if primary_bit & (1 << i):
-                data_str = data.read(2048)
-                ndata = array.array('B', data_str)
-                chunk.meta[i] = ndata
-        if light_data:
-            for i in xrange(chunk.levels):
-                if primary_bit & (1 << i):
-                    data_str = data.read(2048)
-                    #ndata = array.array('B', data_str)
-            for i in xrange(chunk.levels):
-                if primary_bit & (1 << i):
-                    data_str = data.read(2048)
-                    #ndata = array.array('B', data_str)
-        # higher block id value will be used after Mojang adds them
-        if add_bit > 0:
-            for i in xrange(chunk.levels):
-                if add_bit >> i & 1:
-                    data_str = data.read(2048)
-                    ndata = array.array('B', data_str)
+                chunk.blocks[i] = blocks[i]
+                chunk.meta[i] = meta[i]
         if continuous:
-            data_str = data.read(256)
-            chunk.biome = array.array('b', data_str)
+            chunk.biome = biome
+        self.index_chunk(chunk)
+
+    def index_chunk(self, chunk):
+        """ rebuild the per chunk indexes after its sections were replaced """
+        self.walkability.invalidate_chunk(*chunk.coords)
+        self.portals.invalidate_chunk(*chunk.coords)
+        if numpy is not None:
+            chunk.heights = column_heights(chunk, (STANDABLE, SOLID))
+        else:
+            chunk.heights = {}
+        chunk.specials = {}
+        for level in xrange(chunk.levels):
+            if chunk.blocks[level] is not None:
+                self.index_specials(chunk, level)
+
+    def index_specials(self, chunk, level):
+        found = section_specials(chunk, level)
+        if found:
+            chunk.specials[level] = found
+        else:
+            chunk.specials.pop(level, None)
+
+    def _load_chunk(self, x, z, continuous, primary_bit, add_bit, data,
+                    light_data=True):
+        sections = read_chunk_sections(data, continuous, primary_bit, add_bit,
+                                       light_data=light_data,
+                                       chunk_class=self.chunk_class)
+        self.load_chunk_sections(x, z, continuous, primary_bit, sections)
 
     def on_load_chunk(self, x, z, continuous, primary_bit, add_bit, data_array):
         self._load_chunk(x, z, continuous, primary_bit, add_bit, StringIO.StringIO(data_array))
@@ -156,10 +895,9 @@ class Grid(object):
     def change_block_to(self, x, y, z, block_type, meta):
         chunk_x = x >> 4
         chunk_z = z >> 4
-        if (chunk_x, chunk_z) not in self.chunks:
+        chunk = self.get_chunk((chunk_x, chunk_z))
+        if chunk is None:
             return None, None
-        else:
-            chunk = self.get_chunk((chunk_x, chunk_z))
         y_level = y >> 4
         if chunk.blocks[y_level] is None:
             return None, None
@@ -171,38 +909,89 @@ class Grid(object):
         cy = y & 15
         cz = z & 15
         pos = self.chunk_array_position(cx, cy, cz)
-        chunk.blocks[y_level][pos] = block_type
-        chunk.set_meta(y_level, pos, meta)
+        chunk.set_block(y_level, pos, block_type, meta)
+        if block_type in special_kind or current_block.number in special_kind:
+            self.index_specials(chunk, y_level)
+        if self.cache is not None:
+            self.dirty.add((chunk_x, chunk_z))
+        self.update_heights(x, y, z, block_type, meta)
         new_block = self.make_block(x, y, z, block_type, meta)
         return current_block, new_block
 
+    def change_blocks(self, changes):
+        """
+        Apply (x, y, z, block id, meta) changes grouped by section, without
+        building Block objects. Changes in unloaded sections are skipped.
+        Calls blocks_changed once with the bounding box of the changes.
+        """
+        by_section = defaultdict(list)
+        for x, y, z, block_type, meta in changes:
+            if 0 <= y < config.WORLD_HEIGHT:
+                pos = (y & 15) * 256 + (z & 15) * 16 + (x & 15)
+                by_section[(x >> 4, z >> 4, y >> 4)].append(
+                    (pos, block_type, meta))
+        xs, ys, zs = [], [], []
+        for (chunk_x, chunk_z, level), writes in by_section.iteritems():
+            chunk = self.get_chunk((chunk_x, chunk_z))
+            if chunk is None or chunk.blocks[level] is None:
+                continue
+            chunk.set_blocks(level, writes)
+            if level in chunk.specials or any(block_type in special_kind
+                                              for _, block_type, _ in writes):
+                self.index_specials(chunk, level)
+            if self.cache is not None:
+                self.dirty.add((chunk_x, chunk_z))
+            for pos, block_type, meta in writes:
+                self.update_heights((chunk_x << 4) + (pos & 15),
+                                    (level << 4) + (pos >> 8),
+                                    (chunk_z << 4) + ((pos >> 4) & 15),
+                                    block_type, meta)
+            xs.extend((chunk_x << 4) + (pos & 15) for pos, _, _ in writes)
+            ys.extend((level << 4) + (pos >> 8) for pos, _, _ in writes)
+            zs.extend((chunk_z << 4) + ((pos >> 4) & 15)
+                      for pos, _, _ in writes)
+        if not xs:
+            return None
+        bb = AABB(min(xs), min(ys), min(zs),
+                  max(xs) + 1, max(ys) + 1, max(zs) + 1)
+        self.blocks_changed(bb)
+        return bb
+
+    def blocks_changed(self, bb):
+        """ called with the AABB of the blocks changed by a block packet """
+        self.walkability.invalidate(bb)
+        self.portals.invalidate(bb)
+        if self.subscriptions:
+            self.publish(bb)
+
     def on_block_change(self, x, y, z, btype, bmeta):
-        _, _ = self.change_block_to(x, y, z, btype, bmeta)
+        old_block, _ = self.change_block_to(x, y, z, btype, bmeta)
+        if old_block is not None:
+            self.blocks_changed(AABB(x, y, z, x + 1, y + 1, z + 1))
 
     def on_multi_block_change(self, chunk_x, chunk_z, blocks):
         shift_x = chunk_x << 4
         shift_z = chunk_z << 4
-        for block in blocks:
-            _, _ = self.change_block_to(block.x + shift_x, block.y, block.z + shift_z, block.block_id, block.meta)
+        self.change_blocks((block.x + shift_x, block.y, block.z + shift_z,
+                            block.block_id, block.meta) for block in blocks)
 
     def on_explosion(self, x, y, z, records):
-        for rec in records:
-            rx = x + rec.x
-            ry = y + rec.y
-            rz = z + rec.z
-            gx = int(rx)
-            gy = int(ry)
-            gz = int(rz)
-            ob, nb = self.change_block_to(gx, gy, gz, 0, 0)
+        # offsets are relative to the truncated center, like the client does
+        gx = int(x)
+        gy = int(y)
+        gz = int(z)
+        self.change_blocks((gx + rec.x, gy + rec.y, gz + rec.z, 0, 0)
+                           for rec in records)
 
     def chunk_complete_at(self, x, z):
         cx = x >> 4
         cz = z >> 4
-        chunk = self.get_chunk((cx, cz))
+        chunk = self.chunks.get((cx, cz), None)
         if chunk is None:
-            return False
+            entry = self.evicted.get((cx, cz), None)
+            return entry is not None and entry[0] and not entry[1]
         else:
-            return chunk.complete
+            return chunk.complete and not chunk.stale
 
     def blocks_in_aabb(self, bb):
         for x, y, z in bb.grid_area:
@@ -210,11 +999,60 @@ class Grid(object):
             if blk is not None:
                 yield blk
 
+    def special_blocks_in(self, bb, kinds=None):
+        """
+        (x, y, z, kind) of the special blocks, see special_kinds, in the
+        grid area of bb. Limit to the kinds given.
+        """
+        return self.special_blocks_in_box(*bb.grid_box, kinds=kinds)
+
+    def special_blocks_in_box(self, x0, y0, z0, x1, y1, z1, kinds=None):
+        """ like special_blocks_in, the box includes x1, y1, z1 """
+        out = []
+        y0 = max(y0, 0)
+        y1 = min(y1, config.WORLD_HEIGHT - 1)
+        for chunk_x in xrange(x0 >> 4, (x1 >> 4) + 1):
+            for chunk_z in xrange(z0 >> 4, (z1 >> 4) + 1):
+                chunk = self.get_chunk((chunk_x, chunk_z))
+                if chunk is None or not chunk.specials:
+                    continue
+                gx = chunk_x << 4
+                gz = chunk_z << 4
+                lx0, lx1 = max(x0 - gx, 0), min(x1 - gx, 15)
+                lz0, lz1 = max(z0 - gz, 0), min(z1 - gz, 15)
+                for level in xrange(y0 >> 4, (y1 >> 4) + 1):
+                    found = chunk.specials.get(level, None)
+                    if found is None:
+                        continue
+                    gy = level << 4
+                    ly0, ly1 = max(y0 - gy, 0), min(y1 - gy, 15)
+                    for kind, positions in found.iteritems():
+                        if kinds is not None and kind not in kinds:
+                            continue
+                        if positions is None:
+                            numbers = special_numbers[kind]
+                            for y in xrange(ly0, ly1 + 1):
+                                for z in xrange(lz0, lz1 + 1):
+                                    for x in xrange(lx0, lx1 + 1):
+                                        block_id = chunk.get_block_id(
+                                            level, y * 256 + z * 16 + x)
+                                        if block_id in numbers:
+                                            out.append((gx + x, gy + y,
+                                                        gz + z, kind))
+                            continue
+                        for y in xrange(ly0, ly1 + 1):
+                            for z in xrange(lz0, lz1 + 1):
+                                row = y * 256 + z * 16
+                                lo = bisect.bisect_left(positions, row + lx0)
+                                hi = bisect.bisect_right(positions,
+                                                         row + lx1, lo)
+                                for i in xrange(lo, hi):
+                                    out.append((gx + (positions[i] & 15),
+                                                gy + y, gz + z, kind))
+        return out
+
     def contains_liquid(self, bb):
-        for blk in self.blocks_in_aabb(bb):
-            if blk.material.is_liquid:
-                return True
-        return False
+        return bool(self.special_blocks_in(bb, kinds=("water", "lava")))
 
     def aabb_collides(self, bb):
         for col_bb in self.collision_aabbs_in(bb):
@@ -224,27 +1062,40 @@ class Grid(object):
 
     def collision_aabbs_in(self, bb):
         out = []
-        for blk in self.blocks_in_aabb(bb.extend_to(0, -1, 0)):
+        area = bb.extend_to(0, -1, 0)
+        if self.above_solid(area):
+            return out
+        for blk in self.blocks_in_aabb(area):
             blk.add_grid_bounding_boxes_to(out)
         return out
 
+    def above_solid(self, bb):
+        """
+        True when the grid area of bb lies above the highest collidable
+        block of each of its columns, answered from the heightmaps
+        """
+        x0, y0, z0, x1, _, z1 = bb.grid_box
+        for x in xrange(x0, x1 + 1):
+            for z in xrange(z0, z1 + 1):
+                top = self.solid_at(x, z)
+                if top is None or top >= y0:
+                    return False
+        return True
+
     def avoid_aabbs_in(self, bb):
-        out = []
-        for blk in self.blocks_in_aabb(bb):  # lava, fire, web
-            if blk.is_lava or blk.number == blocks.Fire.number or blk.number == blocks.Cobweb.number:
-                out.append(AABB.from_block_cube(blk.x, blk.y, blk.z))
-        return out
+        return [AABB.from_block_cube(x, y, z)
+                for x, y, z, _ in self.special_blocks_in(
+                    bb, kinds=("lava", "fire", "web"))]
 
     def aabb_on_ladder(self, bb):
-        blk = self.get_block(bb.gridpos_x, bb.gridpos_y, bb.gridpos_z)
+        blk = self.get_block_prototype(bb.gridpos_x, bb.gridpos_y,
+                                       bb.gridpos_z)
         return blk.number in (blocks.Ladders.number, blocks.Vines.number)
 
     def aabb_in_water(self, bb):
         #TODO return the bast water block instead of boolean
-        for blk in self.blocks_in_aabb(bb.expand(-0.001, -0.4010000059604645, -0.001)):
-            if blk.is_water:
-                return True
-        return False
+        water = bb.expand(-0.001, -0.4010000059604645, -0.001)
+        return bool(self.special_blocks_in(water, kinds=("water",)))
 
     def standing_on_solidblock(self, bb):
         standing_on = None
@@ -272,18 +1123,99 @@ class Grid(object):
         return self.get_block(bb.gridpos_x, bb.gridpos_y, bb.gridpos_z)
 
     def downward_block(self, bb):
+        """
+        The block above the floor below bb, or the climbable block below
+        it. None if there is no floor.
+        """
         x, y, z = bb.gridpos_x, bb.gridpos_y, bb.gridpos_z
-        block = self.get_block(x, y, z)
-        last_block = block
-        while y > -1024:  # The levels aren't that deep..
-            last_block = block
-            y = y - 1
-            block = self.get_block(x, y, z)
-            if block.can_stand_on:
-                return last_block
-            if block.is_climbable:
-                return block
-        assert y != -1024
+        floor = self.floor_below(x, y, z)
+        if floor is None:
+            return None
+        block = self.get_block(x, floor, z)
+        if block.is_climbable and not block.can_stand_on:
+            return block
+        return self.get_block(x, floor + 1, z)
+
+    def update_heights(self, x, y, z, block_type, meta):
+        """ keep the heightmaps current after the block at x, y, z changed """
+        self.update_column_height(x, y, z,
+                                  blocks.block_flags[block_type << 4 | meta])
+        # neighbour dependent blocks next to it may have changed as well
+        for nx, ny, nz in ((x - 1, y, z), (x + 1, y, z), (x, y, z - 1),
+                           (x, y, z + 1), (x, y - 1, z), (x, y + 1, z)):
+            block_type, meta = self.get_block_type(nx, ny, nz)
+            flags = blocks.block_flags[block_type << 4 | meta]
+            if flags & blocks.NEIGHBOURS_MASK:
+                self.update_column_height(nx, ny, nz, flags)
+
+    def update_column_height(self, x, y, z, flags):
+        chunk = self.chunks.get((x >> 4, z >> 4), None)
+        if chunk is None or not chunk.heights:
+            return
+        column = (z & 15) * 16 + (x & 15)
+        for mask, heights in chunk.heights.iteritems():
+            top = heights[column]
+            if top == HEIGHT_UNKNOWN:
+                continue
+            matches = flags & (mask | mask << blocks.NEIGHBOURS_SHIFT)
+            if y > top and matches:
+                heights[column] = y
+            elif y == top and not matches:
+                heights[column] = HEIGHT_UNKNOWN
+
+    def scan_down(self, x, y, z, mask):
+        """ highest y at or below y whose flags match mask, -1 for none """
+        while y >= 0:
+            if self.get_block_flags(x, y, z) & mask:
+                return y
+            y -= 1
+        return -1
+
+    def column_height(self, x, z, mask):
+        """
+        Highest y at x, z whose block flags match mask, -1 when there is
+        none, None when the chunk is not loaded. Answered from a heightmap
+        per chunk, built at load time with numpy, otherwise filled per
+        column on first use.
+        """
+        chunk = self.get_chunk((x >> 4, z >> 4))
+        if chunk is None:
+            return None
+        heights = chunk.heights.get(mask, None)
+        if heights is None:
+            heights = array.array('h', [HEIGHT_UNKNOWN]) * 256
+            chunk.heights[mask] = heights
+        column = (z & 15) * 16 + (x & 15)
+        y = heights[column]
+        if y == HEIGHT_UNKNOWN:
+            y = self.scan_down(x, config.WORLD_HEIGHT - 1, z, mask)
+        elif y >= 0 and not self.get_block_flags(x, y, z) & mask:
+            # neighbour dependent block that does not match after all
+            y = self.scan_down(x, y - 1, z, mask)
+        heights[column] = y
+        return y
+
+    def surface_at(self, x, z):
+        """ y of the highest block at x, z that can be stood on or climbed """
+        return self.column_height(x, z, STANDABLE)
+
+    def solid_at(self, x, z):
+        """ y of the highest collidable block at x, z """
+        return self.column_height(x, z, SOLID)
+
+    def floor_below(self, x, y, z):
+        """
+        y of the highest block below y at x, z that can be stood on or
+        climbed, None if there is none or the chunk is not loaded.
+        """
+        surface = self.surface_at(x, z)
+        if surface is None or surface < 0:
+            return None
+        if surface < y:
+            return surface
+        floor = self.scan_down(x, min(y, config.WORLD_HEIGHT) - 1, z,
+                               STANDABLE)
+        return floor if floor >= 0 else None
 
     def aabb_in_chunks(self, bb):
         chunk_coords = set()
@@ -292,17 +1224,16 @@ class Grid(object):
         return [self.get_chunk(coord) for coord in chunk_coords]
 
     def aabb_in_complete_chunks(self, bb):
-        for chunk in self.aabb_in_chunks(bb):
-            if chunk is None:
-                return False
-            elif chunk.complete is False:
+        """ stale chunks from the cache count once the server sent them """
+        for x, _, z in bb.grid_area:
+            if not self.chunk_complete_at(x, z):
                 return False
         return True
 
     def aabb_eyelevel_inside_water(self, bb, eye_height=config.PLAYER_EYELEVEL):
         eye_y = bb.min_y + eye_height
         ey = utils.grid_shift(eye_y)
-        blk = self.get_block(bb.gridpos_x, ey, bb.gridpos_z)
+        blk = self.get_block_prototype(bb.gridpos_x, ey, bb.gridpos_z)
         if blk.is_water:
             wh = blk.height_percent - 0.11111111
             return eye_y < (ey + 1 - wh)
@@ -1,40 +1,40 @@
-
-
 import logbot
 import utils
 import fops
+from axisbox import AABB
+from walkability import CAN_BE, CAN_STAND, CAN_JUMP, CAN_FALL, CAN_CLIMB, \
+    IN_FIRE, IN_WATER, CAN_HOLD
 
 
 log = logbot.getlogger("GRIDSPACE")
 
 
 class NodeState(object):
-    def __init__(self, grid, x=None, y=None, z=None, vector=None):
+    def __init__(self, grid, x=None, y=None, z=None, vector=None, bits=None):
         self.grid = grid
         self.x = x
         self.y = y
         self.z = z
         self.coords = utils.Vector(self.x, self.y, self.z)
-        self.block_0 = grid.get_block(self.x, self.y - 1, self.z)
-        self.block_1 = grid.get_block(self.x, self.y, self.z)
-        self.block_2 = grid.get_block(self.x, self.y + 1, self.z)
-        self.can_be = self.block_1.can_fall_through and self.block_2.can_fall_through
-        self.can_stand = self.block_0.can_stand_on and self.can_be
-        self.can_jump = self.can_stand and self.block_1.is_free and self.block_2.is_free
-        self.can_fall = self.can_be and self.block_0.can_fall_through
-        self.can_climb = self.can_be and self.block_1.is_climbable
-        self.in_fire = self.block_1.is_burning or self.block_2.is_burning
-        self.in_water = self.block_1.is_water or self.block_2.is_water
-        self.can_hold = self.in_water or self.block_1.is_ladder or (self.block_1.is_vine and self.block_1.is_climbable)
+        if bits is None:
+            bits = grid.walkability.get(x, y, z)
+        self.can_be = (bits & CAN_BE) != 0
+        self.can_stand = (bits & CAN_STAND) != 0
+        self.can_jump = (bits & CAN_JUMP) != 0
+        self.can_fall = (bits & CAN_FALL) != 0
+        self.can_climb = (bits & CAN_CLIMB) != 0
+        self.in_fire = (bits & IN_FIRE) != 0
+        self.in_water = (bits & IN_WATER) != 0
+        self.can_hold = (bits & CAN_HOLD) != 0
         self.platform_y = self.y
         self.center_x = self.x + 0.5
         self.center_z = self.z + 0.5
 
     def __str__(self):
         if self.can_stand:
-            return "ON %s" % self.block_0
+            return "ON %s" % self.grid.get_block(self.x, self.y - 1, self.z)
         else:
-            return "IN %s" % self.block_1
+            return "IN %s" % self.grid.get_block(self.x, self.y, self.z)
 
     def vertical_center_in(self, center):
         return self.x < center.x and center.x < (self.x + 1) and self.z < center.z and center.z < (self.z + 1)
@@ -50,9 +50,14 @@ class NodeState(object):
 
 
 class GridSpace(object):
+    """
+    States of the positions of one search. The walkability bits come from
+    the grid's Walkability layer, which outlives the searches.
+    """
 
     def __init__(self, grid):
         self.grid = grid
+        self.walkability = grid.walkability
         self.cache = {}
 
     def get_state_coords(self, coords):
@@ -65,7 +70,8 @@ class GridSpace(object):
         try:
             return self.cache[t_coords]
         except KeyError:
-            state = NodeState(self.grid, t_coords[0], t_coords[1], t_coords[2])
+            state = NodeState(self.grid, t_coords[0], t_coords[1], t_coords[2],
+                              bits=self.walkability.get(*t_coords))
             self.cache[t_coords] = state
             return state
 
@@ -73,73 +79,75 @@ class GridSpace(object):
         x = coords.x
         y = coords.y
         z = coords.z
+        bits = self.walkability.get
         base_state = self.get_state_coords(coords)
         if base_state.in_water:
             for k in [0, 1, -1]:
                 for i, j in utils.adjacency:
-                    to_state = self.get_state(x + i, y + k, z + j)
-                    if to_state.in_water:
+                    to_bits = bits(x + i, y + k, z + j)
+                    if to_bits & IN_WATER:
+                        to_state = self.get_state(x + i, y + k, z + j)
                         go = self.can_swim(base_state, to_state)
                         if go:
                             yield to_state
-                    elif to_state.can_stand:
+                    elif to_bits & CAN_STAND:
                         if i != 0 and j != 0:
                             continue
+                        to_state = self.get_state(x + i, y + k, z + j)
                         if k == 0:
                             yield to_state
                         else:
                             go = self.can_go(base_state, to_state)
                             if go:
                                 yield to_state
-                    elif to_state.can_hold:
+                    elif to_bits & CAN_HOLD:
                         if (i != 0 and j != 0) or k != 0:
                             continue
-                        yield to_state
-            to_state = self.get_state(x, y + 1, z)
-            if to_state.in_water:
-                yield to_state
-            to_state = self.get_state(x, y - 1, z)
-            if to_state.can_stand or to_state.in_water:
-                yield to_state
+                        yield self.get_state(x + i, y + k, z + j)
+            if bits(x, y + 1, z) & IN_WATER:
+                yield self.get_state(x, y + 1, z)
+            if bits(x, y - 1, z) & (CAN_STAND | IN_WATER):
+                yield self.get_state(x, y - 1, z)
         elif base_state.can_hold:
             for k in [0, 1, -1]:
                 for i, j in utils.cross:
-                    to_state = self.get_state(x + i, y + k, z + j)
-                    if to_state.can_stand:
+                    to_bits = bits(x + i, y + k, z + j)
+                    if to_bits & CAN_STAND:
+                        to_state = self.get_state(x + i, y + k, z + j)
                         go = self.can_go(base_state, to_state)
                         if go:
                             yield to_state
-                    elif to_state.can_hold:
+                    elif to_bits & CAN_HOLD:
                         if k == 0:
-                            yield to_state
-            to_state = self.get_state(x, y + 1, z)
-            if to_state.can_hold:
-                yield to_state
-            to_state = self.get_state(x, y - 1, z)
-            if to_state.can_stand or to_state.can_hold:
-                yield to_state
+                            yield self.get_state(x + i, y + k, z + j)
+            if bits(x, y + 1, z) & CAN_HOLD:
+                yield self.get_state(x, y + 1, z)
+            if bits(x, y - 1, z) & (CAN_STAND | CAN_HOLD):
+                yield self.get_state(x, y - 1, z)
         else:
             for i, j in utils.adjacency:
-                to_state = self.get_state(x + i, y, z + j)
-                if to_state.can_stand or to_state.can_hold:
+                to_bits = bits(x + i, y, z + j)
+                if to_bits & (CAN_STAND | CAN_HOLD):
+                    to_state = self.get_state(x + i, y, z + j)
                     go = self.can_go(base_state, to_state)
                     if go:
                         yield to_state
-                elif to_state.can_fall:
+                elif to_bits & CAN_FALL:
                     for k in [-1, -2, -3]:
-                        to_state = self.get_state(x + i, y + k, z + j)
-                        if to_state.can_stand or to_state.can_hold:
+                        to_bits = bits(x + i, y + k, z + j)
+                        if to_bits & (CAN_STAND | CAN_HOLD):
+                            to_state = self.get_state(x + i, y + k, z + j)
                             go = self.can_go(base_state, to_state)
                             if go:
                                 yield to_state
                             break
-                        elif to_state.can_fall:
+                        elif to_bits & CAN_FALL:
                             continue
                         else:
                             break
                 else:
-                    to_state = self.get_state(x + i, y + 1, z + j)
-                    if to_state.can_stand or to_state.can_hold:
+                    if bits(x + i, y + 1, z + j) & (CAN_STAND | CAN_HOLD):
+                        to_state = self.get_state(x + i, y + 1, z + j)
                         go = self.can_go(base_state, to_state)
                         if go:
                             yield to_state
@@ -172,8 +180,7 @@ class GridSpace(object):
             if from_state.y == to_state.y:
                 return self.diagonal_free(from_state, to_state, from_state.y)
             elif from_state.y < to_state.y:
-                down = self.get_state(to_state.x, from_state.y, to_state.z)
-                if not down.can_be:
+                if not self.walkability.get(to_state.x, from_state.y, to_state.z) & CAN_BE:
                     return False
                 return self.diagonal_free(from_state, to_state, to_state.y)
             else:
@@ -181,36 +188,41 @@ class GridSpace(object):
                 if not go:
                     return False
                 for i in xrange(from_state.y - to_state.y):
-                    down = self.get_state(to_state.x, from_state.y - i, to_state.z)
-                    if not down.can_be:
+                    if not self.walkability.get(to_state.x, from_state.y - i, to_state.z) & CAN_BE:
                         return False
                 return True
         else:
             if from_state.y == to_state.y:
                 return True
             elif from_state.y < to_state.y:
-                up = self.get_state(from_state.x, from_state.y + 1, from_state.z)
-                if not up.can_be:
+                if not self.walkability.get(from_state.x, from_state.y + 1, from_state.z) & CAN_BE:
                     return False
                 return True
             else:
                 for i in xrange(from_state.y - to_state.y):
-                    down = self.get_state(to_state.x, from_state.y - i, to_state.z)
-                    if not down.can_be:
+                    if not self.walkability.get(to_state.x, from_state.y - i, to_state.z) & CAN_BE:
                         return False
                 return True
 
     def diagonal_free(self, from_state, to_state, y_level):
-        left = self.get_state(to_state.x, y_level, from_state.z)
-        if not left.can_be:
+        if not self.walkability.get(to_state.x, y_level, from_state.z) & CAN_BE:
             return False
-        right = self.get_state(from_state.x, y_level, to_state.z)
-        if not right.can_be:
+        if not self.walkability.get(from_state.x, y_level, to_state.z) & CAN_BE:
             return False
         return True
 
     def can_stand(self, x, y, z):
-        return self.get_state(x, y, z).can_stand
+        return (self.walkability.get(x, y, z) & CAN_STAND) != 0
+
+
+def moves_affected_by(bb):
+    """
+    Box of the positions whose moves can change when the blocks in bb
+    change. Walkability looks 2 blocks up and down and at neighbour
+    dependent blocks, neighbours_of 1 block sideways, 1 up and 3 down.
+    """
+    return AABB(int(bb.min_x) - 2, int(bb.min_y) - 3, int(bb.min_z) - 2,
+                int(bb.max_x) + 2, int(bb.max_y) + 5, int(bb.max_z) + 2)
 
 
 def can_stand_coords(grid, coords):
@@ -0,0 +1,576 @@
+"""
+Compiler of the construct packet table into flat python functions.
+
+For every packet in the table a decode_XX(data, offset) function returning
+(Container, offset) and an encode_XX(container) function returning the
+packet body are generated. Runs of integer fields are read with one
+precompiled struct, strings and byte fields are sliced directly, lambdas
+of the table (lengths, counts, switch keys) are called with the container
+being built as their context, just like construct does. Negative lengths
+and counts raise a ConstructError. Constructs the compiler does not know
+are delegated to construct itself.
+
+The decoders expect the whole packet in data, use the frame scanners from
+packets.py to find out.
+
+The generated module is cached next to this file and tagged with a hash
+of the table, following startups import it directly.
+"""
+
+import os
+import imp
+import types
+import hashlib
+
+from construct import Construct, Struct, Switch, MetaArray, MetaField, Value
+from construct import FormatField, StaticField, Buffered, Reconfig, Adapter
+from construct import StringAdapter, LengthValueAdapter, BitIntegerAdapter
+
+import logbot
+
+
+log = logbot.getlogger("PACKETCODEC")
+
+GENERATOR_VERSION = 2
+
+cache_name = "packets_compiled"
+cache_file = os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                          cache_name + ".py")
+
+
+preamble = '''\
+# generated by packetcodec.py from the packets table, do not edit
+import struct
+import cStringIO
+
+from construct import Container, SwitchError, FieldError, ArrayError
+
+TABLE_HASH = %(table_hash)r
+
+
+def _bytes(data, start, end):
+    return memoryview(data)[start:end].tobytes()
+
+
+def _parse_with(con, data, o, ctx):
+    stream = cStringIO.StringIO(memoryview(data)[o:])
+    value = con._parse(stream, ctx)
+    return value, o + stream.tell()
+
+
+def _build_with(con, value, ctx):
+    stream = cStringIO.StringIO()
+    con._build(value, stream, ctx)
+    return stream.getvalue()
+
+
+def bind(packets, specials):
+'''
+
+
+class CodecGenerator(object):
+    """
+    Walks the packets table and writes the source of the codec module.
+
+    specials maps construct objects to hand written (decode, encode)
+    pairs used in their place, decode(data, offset) -> (value, offset)
+    and encode(value) -> string.
+    """
+
+    def __init__(self, packets, specials=None):
+        self.packets = packets
+        self.specials = specials or {}
+        self.bindings = []
+        self.bound = {}
+        self.functions = []
+        self.struct_functions = {}
+        self.counter = 0
+
+    def tmp(self, prefix="v"):
+        self.counter += 1
+        return "%s%d" % (prefix, self.counter)
+
+    def bind(self, expr):
+        """ module global for the object at the path expr """
+        if expr not in self.bound:
+            name = "_g%d" % len(self.bound)
+            self.bound[expr] = name
+            self.bindings.append((name, expr))
+        return self.bound[expr]
+
+    def bind_struct(self, fmt):
+        return self.bind("struct.Struct(%r)" % fmt)
+
+    def generate(self, table_hash):
+        decoders = []
+        encoders = []
+        for pid in sorted(self.packets):
+            path = "packets[%d]" % pid
+            dec = self.struct_function(self.packets[pid], path, "dec")
+            enc = self.struct_function(self.packets[pid], path, "enc")
+            decoders.append("    %d: %s," % (pid, dec))
+            encoders.append("    %d: %s," % (pid, enc))
+        out = [preamble % {"table_hash": table_hash}]
+        out.append("    global %s" % ", ".join(n for n, _ in self.bindings)
+                   if self.bindings else "    pass")
+        for name, expr in self.bindings:
+            out.append("    %s = %s" % (name, expr))
+        out.append("")
+        for lines in self.functions:
+            out.append("")
+            out.extend(lines)
+            out.append("")
+        out.append("")
+        out.append("decoders = {")
+        out.extend(decoders)
+        out.append("}")
+        out.append("")
+        out.append("encoders = {")
+        out.extend(encoders)
+        out.append("}")
+        out.append("")
+        return "\n".join(out)
+
+    def struct_function(self, con, path, kind):
+        key = (id(con), kind)
+        if key in self.struct_functions:
+            return self.struct_functions[key]
+        name = "_%s%d" % (kind, len(self.struct_functions))
+        self.struct_functions[key] = name
+        lines = []
+        if kind == "dec":
+            lines.append("def %s(data, o):" % name)
+            lines.append("    obj = Container()")
+            lines.append("    d = obj.__dict__")
+            self.dec_fields(con, path, lines, "    ")
+            lines.append("    return obj, o")
+        else:
+            lines.append("def %s(obj, parts):" % name)
+            self.enc_fields(con, path, lines, "    ")
+        self.functions.append(lines)
+        return name
+
+    # decoding
+
+    def dec_fields(self, con, path, lines, ind):
+        """ decode the fields of a struct into d """
+        run = []
+        for i, sc in enumerate(con.subcons):
+            scpath = "%s.subcons[%d]" % (path, i)
+            if isinstance(sc, FormatField) and sc.name is not None and \
+                    sc not in self.specials:
+                run.append(sc)
+                continue
+            self.dec_run(run, lines, ind)
+            run = []
+            if sc.conflags & Construct.FLAG_EMBED:
+                self.dec_embedded(sc, scpath, lines, ind)
+            else:
+                v = self.dec_value(sc, scpath, lines, ind)
+                if sc.name is not None:
+                    lines.append("%sd[%r] = %s" % (ind, sc.name, v))
+        self.dec_run(run, lines, ind)
+
+    def dec_run(self, run, lines, ind):
+        if not run:
+            return
+        fmt = ">" + "".join(sc.packer.format[1:] for sc in run)
+        s = self.bind_struct(fmt)
+        size = sum(sc.length for sc in run)
+        if len(run) == 1:
+            lines.append("%sd[%r] = %s.unpack_from(data, o)[0]" %
+                         (ind, run[0].name, s))
+        else:
+            targets = ", ".join("d[%r]" % sc.name for sc in run)
+            lines.append("%s%s = %s.unpack_from(data, o)" % (ind, targets, s))
+        lines.append("%so += %d" % (ind, size))
+
+    def dec_embedded(self, con, path, lines, ind):
+        if isinstance(con, Reconfig):
+            self.dec_embedded(con.subcon, path + ".subcon", lines, ind)
+        elif isinstance(con, Struct):
+            self.dec_fields(con, path, lines, ind)
+        elif isinstance(con, Switch):
+            self.dec_switch(con, path, lines, ind, embedded=True)
+        elif isinstance(con, Value):
+            pass
+        else:
+            v = self.dec_value(con, path, lines, ind)
+            lines.append("%sd.update(%s)" % (ind, v))
+
+    def dec_switch(self, con, path, lines, ind, embedded=False):
+        key = self.tmp("k")
+        v = self.tmp()
+        lines.append("%s%s = %s(obj)" % (ind, key,
+                                          self.bind(path + ".keyfunc")))
+        keyword = "if"
+        for case_key in sorted(con.cases, key=repr):
+            case = con.cases[case_key]
+            lines.append("%s%s %s == %r:" % (ind, keyword, key, case_key))
+            casepath = "%s.cases[%r]" % (path, case_key)
+            self.dec_case(case, casepath, v, lines, ind + "    ", embedded)
+            keyword = "elif"
+        lines.append("%selse:" % ind)
+        if con.default is Switch.NoDefault:
+            lines.append("%s    raise SwitchError(%s)" % (ind, key))
+        else:
+            self.dec_case(con.default, path + ".default", v, lines,
+                          ind + "    ", embedded)
+        return v
+
+    def dec_case(self, case, path, v, lines, ind, embedded):
+        if embedded:
+            self.dec_embedded(case, path, lines, ind)
+            lines.append("%spass" % ind)
+        else:
+            cv = self.dec_value(case, path, lines, ind)
+            lines.append("%s%s = %s" % (ind, v, cv))
+
+    def dec_value(self, con, path, lines, ind):
+        """ emit code decoding con, return the variable holding the value """
+        v = self.tmp()
+        if con in self.specials:
+            lines.append("%s%s, o = %s(data, o)" %
+                         (ind, v, self.bind("specials[%s][0]" % path)))
+        elif isinstance(con, FormatField):
+            lines.append("%s%s = %s.unpack_from(data, o)[0]" %
+                         (ind, v, self.bind_struct(con.packer.format)))
+            lines.append("%so += %d" % (ind, con.length))
+        elif isinstance(con, StaticField):
+            lines.append("%s%s = _bytes(data, o, o + %d)" %
+                         (ind, v, con.length))
+            lines.append("%so += %d" % (ind, con.length))
+        elif isinstance(con, MetaField):
+            n = self.tmp("n")
+            lines.append("%s%s = %s(obj)" %
+                         (ind, n, self.bind(path + ".lengthfunc")))
+            self.dec_check(n, "FieldError", "length", lines, ind)
+            lines.append("%s%s = _bytes(data, o, o + %s)" % (ind, v, n))
+            lines.append("%so += %s" % (ind, n))
+        elif isinstance(con, Value):
+            lines.append("%s%s = %s(obj)" %
+                         (ind, v, self.bind(path + ".func")))
+        elif isinstance(con, Struct):
+            f = self.struct_function(con, path, "dec")
+            lines.append("%s%s, o = %s(data, o)" % (ind, v, f))
+        elif isinstance(con, Switch):
+            return self.dec_switch(con, path, lines, ind)
+        elif isinstance(con, MetaArray):
+            self.dec_array(con, path, v, lines, ind)
+        elif self.is_length_string(con):
+            self.dec_length_string(con, path, v, lines, ind)
+        elif self.is_bit_struct(con):
+            self.dec_bit_struct(con.subcon, path, v, lines, ind)
+        elif isinstance(con, Reconfig):
+            return self.dec_value(con.subcon, path + ".subcon", lines, ind)
+        elif isinstance(con, Adapter) and \
+                not con.subcon.conflags & Construct.FLAG_EMBED:
+            sv = self.dec_value(con.subcon, path + ".subcon", lines, ind)
+            lines.append("%s%s = %s._decode(%s, obj)" %
+                         (ind, v, self.bind(path), sv))
+        else:
+            lines.append("%s%s, o = _parse_with(%s, data, o, obj)" %
+                         (ind, v, self.bind(path)))
+        return v
+
+    def dec_check(self, n, error, what, lines, ind):
+        """ raise error when the length or count in n is negative """
+        lines.append("%sif %s < 0:" % (ind, n))
+        lines.append("%s    raise %s(\"negative %s %%d\" %% %s)" %
+                     (ind, error, what, n))
+
+    def dec_array(self, con, path, v, lines, ind):
+        n = self.tmp("n")
+        sub = con.subcon
+        lines.append("%s%s = %s(obj)" % (ind, n,
+                                          self.bind(path + ".countfunc")))
+        self.dec_check(n, "ArrayError", "count", lines, ind)
+        if isinstance(sub, FormatField) and sub not in self.specials:
+            char = sub.packer.format[1:]
+            lines.append("%s%s = list(struct.unpack_from('>%%d%s' %% %s, "
+                         "data, o))" % (ind, v, char, n))
+            lines.append("%so += %s * %d" % (ind, n, sub.length))
+            return
+        lines.append("%s%s = []" % (ind, v))
+        lines.append("%sfor _ in xrange(%s):" % (ind, n))
+        ev = self.dec_value(sub, path + ".subcon", lines, ind + "    ")
+        lines.append("%s    %s.append(%s)" % (ind, v, ev))
+
+    def is_length_string(self, con):
+        """ AlphaString and PascalString """
+        return isinstance(con, StringAdapter) and \
+            isinstance(con.subcon, LengthValueAdapter) and \
+            isinstance(con.subcon.subcon, Struct) and \
+            len(con.subcon.subcon.subcons) == 2 and \
+            isinstance(con.subcon.subcon.subcons[0], FormatField)
+
+    def length_string_parts(self, con):
+        from packets import DoubleAdapter
+        lenfield = con.subcon.subcon.subcons[0]
+        factor = 2 if isinstance(con.subcon, DoubleAdapter) else 1
+        return lenfield, factor
+
+    def dec_length_string(self, con, path, v, lines, ind):
+        lenfield, factor = self.length_string_parts(con)
+        n = self.tmp("n")
+        lines.append("%s%s = %s.unpack_from(data, o)[0] * %d" %
+                     (ind, n, self.bind_struct(lenfield.packer.format),
+                      factor))
+        lines.append("%so += %d" % (ind, lenfield.length))
+        self.dec_check(n, "FieldError", "length", lines, ind)
+        lines.append("%s%s = _bytes(data, o, o + %s)" % (ind, v, n))
+        lines.append("%so += %s" % (ind, n))
+        if con.encoding:
+            lines.append("%s%s = %s.decode(%r)" % (ind, v, v, con.encoding))
+
+    def is_bit_struct(self, con):
+        """ static BitStruct of unsigned big endian bit fields """
+        if not isinstance(con, Buffered) or \
+                con.conflags & Construct.FLAG_DYNAMIC or \
+                not isinstance(con.subcon, Struct):
+            return False
+        for sc in con.subcon.subcons:
+            if not isinstance(sc, BitIntegerAdapter) or sc.swapped or \
+                    sc.signed or not isinstance(sc.width, int):
+                return False
+        return con.sizeof() in (1, 2, 4, 8)
+
+    def bit_struct_layout(self, con):
+        fmt = {1: ">B", 2: ">H", 4: ">I", 8: ">Q"}[
+            sum(sc.width for sc in con.subcons) / 8]
+        shift = sum(sc.width for sc in con.subcons)
+        layout = []
+        for sc in con.subcons:
+            shift -= sc.width
+            layout.append((sc.name, shift, (1 << sc.width) - 1))
+        return fmt, layout
+
+    def dec_bit_struct(self, con, path, v, lines, ind):
+        fmt, layout = self.bit_struct_layout(con)
+        b = self.tmp("b")
+        lines.append("%s%s = %s.unpack_from(data, o)[0]" %
+                     (ind, b, self.bind_struct(fmt)))
+        lines.append("%so += %d" % (ind, struct_size(fmt)))
+        lines.append("%s%s = Container()" % (ind, v))
+        lines.append("%s%s.__dict__ = {%s}" % (ind, v, ", ".join(
+            "%r: %s >> %d & %d" % (name, b, shift, mask)
+            for name, shift, mask in layout)))
+
+    # encoding
+
+    def enc_fields(self, con, path, lines, ind):
+        run = []
+        for i, sc in enumerate(con.subcons):
+            scpath = "%s.subcons[%d]" % (path, i)
+            if isinstance(sc, FormatField) and sc.name is not None and \
+                    sc not in self.specials:
+                run.append(sc)
+                continue
+            self.enc_run(run, lines, ind)
+            run = []
+            if sc.conflags & Construct.FLAG_EMBED:
+                self.enc_embedded(sc, scpath, lines, ind)
+            elif not isinstance(sc, Value):
+                v = self.tmp()
+                lines.append("%s%s = obj[%r]" % (ind, v, sc.name))
+                self.enc_value(sc, scpath, v, lines, ind)
+        self.enc_run(run, lines, ind)
+        lines.append("%spass" % ind)
+
+    def enc_run(self, run, lines, ind):
+        if not run:
+            return
+        fmt = ">" + "".join(sc.packer.format[1:] for sc in run)
+        lines.append("%sparts.append(%s.pack(%s))" % (
+            ind, self.bind_struct(fmt),
+            ", ".join("obj[%r]" % sc.name for sc in run)))
+
+    def enc_embedded(self, con, path, lines, ind):
+        if isinstance(con, Reconfig):
+            self.enc_embedded(con.subcon, path + ".subcon", lines, ind)
+        elif isinstance(con, Struct):
+            self.enc_fields(con, path, lines, ind)
+        elif isinstance(con, Switch):
+            self.enc_switch(con, path, "obj", lines, ind, embedded=True)
+        elif isinstance(con, Value):
+            pass
+        else:
+            lines.append("%sparts.append(_build_with(%s, obj, obj))" %
+                         (ind, self.bind(path)))
+
+    def enc_switch(self, con, path, v, lines, ind, embedded=False):
+        key = self.tmp("k")
+        lines.append("%s%s = %s(obj)" % (ind, key,
+                                          self.bind(path + ".keyfunc")))
+        keyword = "if"
+        for case_key in sorted(con.cases, key=repr):
+            case = con.cases[case_key]
+            lines.append("%s%s %s == %r:" % (ind, keyword, key, case_key))
+            casepath = "%s.cases[%r]" % (path, case_key)
+            self.enc_case(case, casepath, v, lines, ind + "    ", embedded)
+            keyword = "elif"
+        lines.append("%selse:" % ind)
+        if con.default is Switch.NoDefault:
+            lines.append("%s    raise SwitchError(%s)" % (ind, key))
+        else:
+            self.enc_case(con.default, path + ".default", v, lines,
+                          ind + "    ", embedded)
+
+    def enc_case(self, case, path, v, lines, ind, embedded):
+        if embedded:
+            self.enc_embedded(case, path, lines, ind)
+        else:
+            self.enc_value(case, path, v, lines, ind)
+        lines.append("%spass" % ind)
+
+    def enc_value(self, con, path, v, lines, ind):
+        """ emit code appending the encoded value of v to parts """
+        if con in self.specials:
+            lines.append("%sparts.append(%s(%s))" %
+                         (ind, self.bind("specials[%s][1]" % path), v))
+        elif isinstance(con, FormatField):
+            lines.append("%sparts.append(%s.pack(%s))" %
+                         (ind, self.bind_struct(con.packer.format), v))
+        elif isinstance(con, (StaticField, MetaField)):
+            lines.append("%sparts.append(%s)" % (ind, v))
+        elif isinstance(con, Value):
+            pass
+        elif isinstance(con, Struct):
+            f = self.struct_function(con, path, "enc")
+            lines.append("%s%s(%s, parts)" % (ind, f, v))
+        elif isinstance(con, Switch):
+            self.enc_switch(con, path, v, lines, ind)
+        elif isinstance(con, MetaArray):
+            e = self.tmp("e")
+            lines.append("%sfor %s in %s:" % (ind, e, v))
+            self.enc_value(con.subcon, path + ".subcon", e, lines,
+                           ind + "    ")
+        elif self.is_length_string(con):
+            lenfield, factor = self.length_string_parts(con)
+            s = self.tmp("s")
+            if con.encoding:
+                lines.append("%s%s = %s.encode(%r)" %
+                             (ind, s, v, con.encoding))
+            else:
+                s = v
+            lines.append("%sparts.append(%s.pack(len(%s) / %d))" %
+                         (ind, self.bind_struct(lenfield.packer.format), s,
+                          factor))
+            lines.append("%sparts.append(%s)" % (ind, s))
+        elif self.is_bit_struct(con):
+            fmt, layout = self.bit_struct_layout(con.subcon)
+            lines.append("%sparts.append(%s.pack(%s))" % (
+                ind, self.bind_struct(fmt), " | ".join(
+                    "(%s[%r] & %d) << %d" % (v, name, mask, shift)
+                    for name, shift, mask in layout)))
+        elif isinstance(con, Reconfig):
+            self.enc_value(con.subcon, path + ".subcon", v, lines, ind)
+        elif isinstance(con, Adapter) and \
+                not con.subcon.conflags & Construct.FLAG_EMBED:
+            av = self.tmp()
+            lines.append("%s%s = %s._encode(%s, obj)" %
+                         (ind, av, self.bind(path), v))
+            self.enc_value(con.subcon, path + ".subcon", av, lines, ind)
+        else:
+            lines.append("%sparts.append(_build_with(%s, %s, obj))" %
+                         (ind, self.bind(path), v))
+
+
+def struct_size(fmt):
+    import struct
+    return struct.calcsize(fmt)
+
+
+def describe_code(code):
+    consts = [describe_code(c) if isinstance(c, types.CodeType) else repr(c)
+              for c in code.co_consts]
+    return "%r%r%r" % (code.co_code, consts, code.co_names)
+
+
+def describe_func(func):
+    """ bytecode of func and of the functions it closes over """
+    out = [describe_code(func.func_code)]
+    for cell in func.func_closure or ():
+        value = cell.cell_contents
+        if hasattr(value, "func_code"):
+            out.append(describe_func(value))
+        elif isinstance(value, Construct):
+            out.append("<%s %s>" % (type(value).__name__, value.name))
+        else:
+            out.append(repr(value))
+    return " ".join(out)
+
+
+def describe(con, specials, seen=None):
+    """
+    Canonical description of a construct tree. Lambdas are described by
+    their bytecode, so editing the table changes the description.
+    """
+    if seen is None:
+        seen = {}
+    if id(con) in seen:
+        return seen[id(con)]
+    seen[id(con)] = "<ref %s>" % con.name
+    out = [type(con).__name__, repr(con.name), str(con.conflags)]
+    if con in specials:
+        out.append("special")
+    for attr in ("length", "width", "swapped", "signed", "encoding",
+                 "nested", "decoding", "decdefault"):
+        value = getattr(con, attr, None)
+        if value is not None and not callable(value):
+            out.append("%s=%r" % (attr, value))
+    if isinstance(con, FormatField):
+        out.append(con.packer.format)
+    for attr in ("lengthfunc", "countfunc", "keyfunc", "func", "predicate"):
+        func = getattr(con, attr, None)
+        if func is not None:
+            out.append("%s=%s" % (attr, describe_func(func)))
+    subcons = list(getattr(con, "subcons", ()))
+    if getattr(con, "subcon", None) is not None:
+        subcons.append(con.subcon)
+    if isinstance(con, Switch):
+        for key in sorted(con.cases, key=repr):
+            out.append("case %r" % (key,))
+            subcons.append(con.cases[key])
+        if con.default is not Switch.NoDefault:
+            subcons.append(con.default)
+    out.extend(describe(sc, specials, seen) for sc in subcons)
+    seen[id(con)] = "(%s)" % " ".join(out)
+    return seen[id(con)]
+
+
+def table_hash(packets, specials):
+    h = hashlib.md5("version %d\n" % GENERATOR_VERSION)
+    for pid in sorted(packets):
+        h.update("%d %s\n" % (pid, describe(packets[pid], specials)))
+    return h.hexdigest()
+
+
+def load(packets, specials=None):
+    """
+    Return the codec module for the packet table, generating and caching
+    it when the cached one does not match the table.
+    """
+    specials = specials or {}
+    thash = table_hash(packets, specials)
+    module = None
+    if os.path.exists(cache_file):
+        try:
+            module = imp.load_source(cache_name, cache_file)
+        except Exception:
+            log.msg("cannot load packet codec %s" % cache_file, exc_info=True)
+        if module is not None and getattr(module, "TABLE_HASH", None) != thash:
+            module = None
+    if module is None:
+        log.msg("generating packet codec")
+        source = CodecGenerator(packets, specials).generate(thash)
+        try:
+            with open(cache_file, "w") as f:
+                f.write(source)
+            module = imp.load_source(cache_name, cache_file)
+        except (IOError, OSError):
+            log.msg("cannot write packet codec cache %s" % cache_file)
+            module = imp.new_module(cache_name)
+            exec compile(source, cache_file, "exec") in module.__dict__
+    module.bind(packets, specials)
+    return module
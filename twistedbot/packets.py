@@ -1,6 +1,9 @@
 # -*- coding: utf-8 -*-
 # original version from https://github.com/MostAwesomeDude/bravo
 
+import sys
+import struct
+import cStringIO
 from StringIO import StringIO
 
 from collections import namedtuple
@@ -19,10 +22,14 @@ from construct import SBInt8, SBInt16, SBInt32, SBInt64
 from construct import BFloat32, BFloat64
 from construct import BitStruct, BitField
 from construct import StringAdapter, LengthValueAdapter, Sequence
+from construct import ConstructError, Construct, Reconfig
+from construct import FormatField, StaticField, Buffered, SwitchError
+from construct import FieldError, ArrayError
 
 from pynbt import NBTFile
 
 import logbot
+import packetcodec
 
 # Strings.
 # This one is a UCS2 string, which effectively decodes single writeChar()
@@ -108,10 +115,93 @@ def ByteString(name, size_name, encoding=None):
                          encoding=encoding)
 
 
+def _nbt_bytes(nbt):
+    sio = StringIO()
+    nbt.save(io=sio)
+    return sio.getvalue()
+
+
+class LazyNBT(object):
+    """
+    NBT payload kept gzipped until it is used.
+
+    The tree is decoded on first access, attribute and item access is
+    delegated to it. Saving a value that was never decoded writes the
+    received bytes back.
+    """
+
+    Compression = NBTFile.Compression
+
+    def __init__(self, raw):
+        self.raw = raw
+        self._nbt = None
+
+    @property
+    def nbt(self):
+        if self._nbt is None:
+            self._nbt = NBTFile(StringIO(self.raw),
+                                compression=NBTFile.Compression.GZIP)
+        return self._nbt
+
+    @property
+    def decoded(self):
+        return self._nbt is not None
+
+    def save(self, io, compression=None, little_endian=False):
+        if self._nbt is None and not little_endian and \
+                compression == NBTFile.Compression.GZIP:
+            io.write(self.raw)
+        else:
+            self.nbt.save(io, compression=compression,
+                          little_endian=little_endian)
+
+    def pretty(self, indent=0, indent_str='  '):
+        return self.nbt.pretty(indent=indent, indent_str=indent_str)
+
+    def __getattr__(self, name):
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return getattr(self.nbt, name)
+
+    def __getitem__(self, key):
+        return self.nbt[key]
+
+    def __setitem__(self, key, value):
+        self.nbt[key] = value
+
+    def __contains__(self, key):
+        return key in self.nbt
+
+    def __iter__(self):
+        return iter(self.nbt)
+
+    def __len__(self):
+        return len(self.nbt)
+
+    def __eq__(self, other):
+        if isinstance(other, LazyNBT):
+            if self._nbt is None and other._nbt is None and \
+                    self.raw == other.raw:
+                return True
+            other = other.nbt
+        if not isinstance(other, NBTFile):
+            return False
+        # the tags have no equality, compare what they save to
+        return _nbt_bytes(self.nbt) == _nbt_bytes(other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        if self._nbt is None:
+            return "<LazyNBT %d bytes>" % len(self.raw)
+        return repr(self._nbt)
+
+
 class NBTAdapter(Adapter):
 
     def _decode(self, obj, context):
-        return NBTFile(StringIO(obj), compression=NBTFile.Compression.GZIP)
+        return LazyNBT(obj)
 
     def _encode(self, obj, context):
         sio = StringIO()
@@ -672,36 +762,530 @@ switcher = If(lambda context: context["header"] != 252,
               Switch("payload", packet_stream_print_header, packets)
               )
 
+full_packet = Struct("full_packet",
+                     UBInt8("header"),
+                     Switch("payload",
+                            packet_stream_print_header,
+                            packets),
+                     )
+
 packet_stream = Struct("packet_stream",
-                       OptionalGreedyRange(
-                           Struct("full_packet",
-                                  UBInt8("header"),
-                                  Switch("payload",
-                                         packet_stream_print_header,
-                                         packets),
-                                  ),
-                       ),
+                       OptionalGreedyRange(full_packet),
                        OptionalGreedyRange(
                            UBInt8("leftovers"),
                        ),
                        )
 
 
+# Fixed layout packets which make up most of the server traffic (entity
+# movement, keep alive, time). They are unpacked with precompiled structs
+# instead of going through the construct machinery.
+fast_packets = {
+    0x00: (">i", ("pid",)),
+    0x04: (">qq", ("age_of_world", "daytime")),
+    0x1c: (">Ihhh", ("eid", "dx", "dy", "dz")),
+    0x1e: (">I", ("eid",)),
+    0x1f: (">Ibbb", ("eid", "dx", "dy", "dz")),
+    0x20: (">IBB", ("eid", "yaw", "pitch")),
+    0x21: (">IbbbBB", ("eid", "dx", "dy", "dz", "yaw", "pitch")),
+    0x22: (">IiiiBB", ("eid", "x", "y", "z", "yaw", "pitch")),
+    0x23: (">IB", ("eid", "yaw")),
+}
+
+fast_decoders = dict((pid, (struct.Struct(fmt), names))
+                     for pid, (fmt, names) in fast_packets.iteritems())
+
+
+class IncompletePacket(Exception):
+    """
+    Raised by the frame scanners when the packet is not complete yet.
+    needed is the offset the data has to reach before scanning again.
+    """
+
+    def __init__(self, needed):
+        Exception.__init__(self, needed)
+        self.needed = needed
+
+
+_sshort = struct.Struct(">h")
+
+
+def _scan_string16(data, o, end, ctx):
+    if o + 2 > end:
+        raise IncompletePacket(o + 2)
+    n = o + 2 + ((data[o] << 8 | data[o + 1]) << 1)
+    if n > end:
+        raise IncompletePacket(n)
+    return n
+
+
+def _scan_slot(data, o, end, ctx):
+    if o + 2 > end:
+        raise IncompletePacket(o + 2)
+    if _sshort.unpack_from(data, o)[0] < 0:
+        return o + 2
+    n = o + 7
+    if n > end:
+        raise IncompletePacket(n)
+    size = _sshort.unpack_from(data, o + 5)[0]
+    if size > 0:
+        n += size
+        if n > end:
+            raise IncompletePacket(n)
+    return n
+
+
+_metadata_sizes = {0: 1, 1: 2, 2: 4, 3: 4, 6: 12}
+
+
+def _scan_metadata(data, o, end, ctx):
+    while True:
+        if o >= end:
+            raise IncompletePacket(o + 1)
+        key = data[o]
+        o += 1
+        if key == 0x7f:
+            return o
+        data_type = key >> 5
+        if data_type == 4:
+            o = _scan_string16(data, o, end, ctx)
+        elif data_type == 5:
+            o = _scan_slot(data, o, end, ctx)
+        elif data_type in _metadata_sizes:
+            o += _metadata_sizes[data_type]
+            if o > end:
+                raise IncompletePacket(o)
+        else:
+            raise SwitchError("unknown metadata type %d" % data_type)
+
+
+def _scan_skip(size):
+    def scan(data, o, end, ctx):
+        n = o + size
+        if n > end:
+            raise IncompletePacket(n)
+        return n
+    return scan
+
+
+def _scan_format(name, packer):
+    size = packer.size
+    unpack_from = packer.unpack_from
+
+    def scan(data, o, end, ctx):
+        n = o + size
+        if n > end:
+            raise IncompletePacket(n)
+        ctx[name] = unpack_from(data, o)[0]
+        return n
+    return scan
+
+
+def _scan_metafield(lengthfunc):
+    def scan(data, o, end, ctx):
+        length = lengthfunc(ctx)
+        if length < 0:
+            raise FieldError("negative length %d" % length)
+        n = o + length
+        if n > end:
+            raise IncompletePacket(n)
+        return n
+    return scan
+
+
+def _scan_value(name, func):
+    def scan(data, o, end, ctx):
+        ctx[name] = func(ctx)
+        return o
+    return scan
+
+
+def _scan_struct(subscans, nested):
+    def scan(data, o, end, ctx):
+        if nested:
+            ctx = Container(_=ctx)
+        for subscan in subscans:
+            o = subscan(data, o, end, ctx)
+        return o
+    return scan
+
+
+def _scan_switch(keyfunc, cases, default):
+    def scan(data, o, end, ctx):
+        case = cases.get(keyfunc(ctx), default)
+        if case is None:
+            raise ConstructError("no case for switch key")
+        return case(data, o, end, ctx)
+    return scan
+
+
+def _scan_array(countfunc, subscan, size):
+    def scan(data, o, end, ctx):
+        count = countfunc(ctx)
+        if count < 0:
+            raise ArrayError("negative count %d" % count)
+        if size is not None:
+            n = o + count * size
+            if n > end:
+                raise IncompletePacket(n)
+            return n
+        for _ in xrange(count):
+            o = subscan(data, o, end, ctx)
+        return o
+    return scan
+
+
+def compile_scanner(con, embedded=False):
+    """
+    Build a function scan(data, offset, end, context) for a construct that
+    returns the offset just past it, without building the parsed value.
+    Integer fields are kept in the context so that length and count lambdas
+    of the packet definitions can be evaluated, negative lengths and counts
+    raise a ConstructError.
+
+    Raises NotImplementedError for constructs it does not understand.
+    """
+    if con is entity_metadata:
+        return _scan_metadata
+    if con is slotdata:
+        return _scan_slot
+    if isinstance(con, FormatField):
+        return _scan_format(con.name, con.packer)
+    if not con.conflags & Construct.FLAG_DYNAMIC:
+        return _scan_skip(con.sizeof())
+    if isinstance(con, StaticField):
+        return _scan_skip(con.length)
+    if isinstance(con, MetaField):
+        return _scan_metafield(con.lengthfunc)
+    if isinstance(con, Value):
+        return _scan_value(con.name, con.func)
+    if isinstance(con, Struct):
+        subscans = []
+        for sc in con.subcons:
+            subembedded = bool(sc.conflags & Construct.FLAG_EMBED)
+            subscans.append(compile_scanner(sc, subembedded))
+        return _scan_struct(subscans, con.nested and not embedded)
+    if isinstance(con, Switch):
+        embedded = bool(con.conflags & Construct.FLAG_EMBED)
+        cases = dict((k, compile_scanner(v, embedded))
+                     for k, v in con.cases.iteritems())
+        if con.default is Switch.NoDefault:
+            default = None
+        else:
+            default = compile_scanner(con.default, embedded)
+        return _scan_switch(con.keyfunc, cases, default)
+    if isinstance(con, MetaArray):
+        sub = con.subcon
+        if sub.conflags & Construct.FLAG_DYNAMIC:
+            return _scan_array(con.countfunc, compile_scanner(sub), None)
+        return _scan_array(con.countfunc, None, sub.sizeof())
+    if isinstance(con, Buffered):
+        raise NotImplementedError("dynamic bit struct %s" % con.name)
+    if isinstance(con, (Adapter, Reconfig)):
+        return compile_scanner(con.subcon, embedded)
+    raise NotImplementedError("cannot scan %s" % con)
+
+
+def _frame_scanner(pid, con):
+    if not con.conflags & Construct.FLAG_DYNAMIC:
+        size = 1 + con.sizeof()
+
+        def scan(data, o, end):
+            n = o + size
+            if n > end:
+                raise IncompletePacket(n)
+            return n
+    else:
+        body = compile_scanner(con)
+
+        def scan(data, o, end):
+            return body(data, o + 1, end, Container())
+    return scan
+
+
+# packet id -> scan(data, offset, end) returning the offset of the end of
+# the packet which starts at offset, IncompletePacket is raised when the
+# data ends before that
+frame_scanners = {}
+for _pid, _con in packets.iteritems():
+    try:
+        frame_scanners[_pid] = _frame_scanner(_pid, _con)
+    except NotImplementedError as e:
+        log.msg("no frame scanner for packet %d: %s" % (_pid, e))
+
+
+_ubyte = struct.Struct(">B")
+_ushort = struct.Struct(">H")
+_slot_header = struct.Struct(">hBHh")
+_int_tup = struct.Struct(">iii")
+_metadata_packers = {0: struct.Struct(">b"), 1: _sshort,
+                     2: struct.Struct(">i"), 3: struct.Struct(">f")}
+
+
+def decode_slot(data, o):
+    """ slotdata decoder, returns (slot, offset) """
+    slot = Container()
+    sid = _sshort.unpack_from(data, o)[0]
+    if sid < 0:
+        slot.__dict__ = {"id": sid}
+        return slot, o + 2
+    sid, count, damage, size = _slot_header.unpack_from(data, o)
+    o += 7
+    if size >= 0:
+        nbt = LazyNBT(memoryview(data)[o:o + size].tobytes())
+        o += size
+    else:
+        nbt = None
+    slot.__dict__ = {"id": sid, "count": count, "damage": damage,
+                     "size": size, "data": nbt}
+    return slot, o
+
+
+def encode_slot(slot):
+    if slot.id < 0:
+        return _sshort.pack(slot.id)
+    header = _slot_header.pack(slot.id, slot.count, slot.damage, slot.size)
+    if slot.size < 0:
+        return header
+    sio = StringIO()
+    slot.data.save(io=sio, compression=NBTFile.Compression.GZIP)
+    return header + sio.getvalue()
+
+
+class RawMetadata(object):
+    """
+    Entity metadata left undecoded, see decode_entity_metadata.
+    """
+
+    def __init__(self, raw):
+        self.raw = raw
+
+    def decode(self):
+        """ the {identifier: Metadata} dict """
+        return _decode_metadata(self.raw, 0)[0]
+
+    def __eq__(self, other):
+        return isinstance(other, RawMetadata) and self.raw == other.raw
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __str__(self):
+        return "<RawMetadata %d bytes>" % len(self.raw)
+
+    __repr__ = __str__
+
+
+# entity metadata is kept as RawMetadata when False
+decode_entity_metadata = True
+
+
+def decode_metadata(data, o):
+    """
+    entity metadata decoder, returns ({identifier: Metadata}, offset) or
+    (RawMetadata, offset) if decode_entity_metadata is off
+    """
+    if not decode_entity_metadata:
+        end = _scan_metadata(data, o, len(data), None)
+        return RawMetadata(memoryview(data)[o:end].tobytes()), end
+    return _decode_metadata(data, o)
+
+
+def _decode_metadata(data, o):
+    d = {}
+    while True:
+        key = _ubyte.unpack_from(data, o)[0]
+        o += 1
+        if key == 0x7f:
+            return d, o
+        data_type = key >> 5
+        if data_type == 4:
+            n = _ushort.unpack_from(data, o)[0] << 1
+            o += 2
+            value = memoryview(data)[o:o + n].tobytes().decode("utf-16-be")
+            o += n
+        elif data_type == 5:
+            value, o = decode_slot(data, o)
+        elif data_type == 6:
+            value = Container()
+            x, y, z = _int_tup.unpack_from(data, o)
+            value.__dict__ = {"x": x, "y": y, "z": z}
+            o += 12
+        elif data_type in _metadata_packers:
+            packer = _metadata_packers[data_type]
+            value = packer.unpack_from(data, o)[0]
+            o += packer.size
+        else:
+            raise SwitchError("unknown metadata type %d" % data_type)
+        d[key & 0x1f] = Metadata(metadata_types[data_type], value)
+
+
+def encode_metadata(metadata):
+    if isinstance(metadata, RawMetadata):
+        return metadata.raw
+    parts = []
+    for identifier, (t, value) in metadata.iteritems():
+        data_type = metadata_types.index(t)
+        parts.append(chr(data_type << 5 | identifier))
+        if data_type == 4:
+            value = value.encode("utf-16-be")
+            parts.append(_ushort.pack(len(value) / 2))
+            parts.append(value)
+        elif data_type == 5:
+            parts.append(encode_slot(value))
+        elif data_type == 6:
+            parts.append(_int_tup.pack(value.x, value.y, value.z))
+        else:
+            parts.append(_metadata_packers[data_type].pack(value))
+    parts.append("\x7f")
+    return "".join(parts)
+
+
+# compiled codec of the packet table, packet id -> decode(data, offset)
+# returning (payload, offset) and packet id -> encode(payload, parts)
+# appending the body strings to parts
+codec = packetcodec.load(packets, {
+    slotdata: (decode_slot, encode_slot),
+    entity_metadata: (decode_metadata, encode_metadata),
+})
+decoders = codec.decoders
+encoders = codec.encoders
+
+
+class PacketBuffer(object):
+    """
+    Receive buffer for a packet stream.
+
+    Incoming data is appended to a bytearray and packets are decoded in
+    place from the read offset, through memoryview slices. Partial packets
+    stay where they are until more data arrives, the consumed part of the
+    buffer is dropped only when it is worth the memmove.
+
+    Before a packet is decoded its length is checked by the frame scanner.
+    When it is incomplete, the number of missing bytes is remembered and
+    nothing is parsed until that much data has been fed.
+
+    interest is the set of packet ids worth decoding, the others are
+    only scanned and dropped. None decodes everything.
+    """
+
+    compact_size = 64 * 1024
+
+    def __init__(self, interest=None):
+        self.data = bytearray()
+        self.offset = 0
+        self.missing = 0
+        self.interest = interest
+
+    def __len__(self):
+        return len(self.data) - self.offset
+
+    def feed(self, bytestream):
+        self.data.extend(bytestream)
+        self.missing -= len(bytestream)
+
+    @property
+    def leftover(self):
+        """ unparsed bytes as a string """
+        return memoryview(self.data)[self.offset:].tobytes()
+
+    def parse(self):
+        """
+        Parse out as many complete packets as possible.
+
+        Returns a list of (header, payload) tuples, the incomplete rest stays
+        in the buffer.
+        """
+        if self.missing > 0:
+            return []
+        data = self.data
+        interest = self.interest
+        l = []
+        offset = self.offset
+        end = len(data)
+        stream = None
+        while offset < end:
+            header = data[offset]
+            scanner = frame_scanners.get(header, None)
+            if scanner is None:
+                # unknown packet, the stream cannot continue
+                break
+            try:
+                frame_end = scanner(data, offset, end)
+            except IncompletePacket as e:
+                self.missing = e.needed - end
+                break
+            except ConstructError:
+                break
+            if interest is not None and header not in interest:
+                offset = frame_end
+                continue
+            fast = fast_decoders.get(header, None)
+            if fast is not None:
+                unpacker, names = fast
+                payload = Container()
+                payload.__dict__ = dict(zip(names,
+                                            unpacker.unpack_from(data,
+                                                                 offset + 1)))
+                l.append((header, payload))
+                offset = frame_end
+                continue
+            decoder = decoders.get(header, None)
+            if decoder is not None:
+                try:
+                    payload, _ = decoder(data, offset + 1)
+                except ConstructError:
+                    sys.exc_clear()
+                    break
+                l.append((header, payload))
+                offset = frame_end
+                continue
+            if stream is None:
+                view = memoryview(data)[self.offset:]
+                stream = cStringIO.StringIO(view)
+            stream.seek(offset + 1 - self.offset)
+            try:
+                payload = packets[header].parse_stream(stream)
+            except ConstructError:
+                # the traceback would keep the stream alive
+                sys.exc_clear()
+                break
+            l.append((header, payload))
+            offset = frame_end
+        if stream is not None:
+            # drop the buffer exports, the bytearray cannot be resized
+            # while they are alive
+            del stream, view
+        self.offset = offset
+        self.compact()
+        return l
+
+    def compact(self):
+        if self.offset == len(self.data):
+            del self.data[:]
+            self.offset = 0
+        elif self.offset > self.compact_size and \
+                self.offset * 2 > len(self.data):
+            del self.data[:self.offset]
+            self.offset = 0
+
+
 def parse_packets(bytestream):
     """
     Opportunistically parse out as many packets as possible from a raw
     bytestream.
 
+    Packets listed in fast_packets are unpacked directly, everything else
+    is parsed by the compiled codec.
+
     Returns a tuple containing a list of unpacked packet containers, and any
     leftover unparseable bytes.
     """
 
-    container = packet_stream.parse(bytestream)
-
-    l = [(i.header, i.payload) for i in container.full_packet]
-    leftovers = "".join(chr(i) for i in container.leftovers)
-
-    return l, leftovers
+    buf = PacketBuffer()
+    buf.feed(bytestream)
+    l = buf.parse()
+    return l, buf.leftover
 
 incremental_packet_stream = \
     Struct("incremental_packet_stream",
@@ -762,11 +1346,43 @@ def make_packet(packet, payload, template=None):
     container = Container(**payload)
 
     if template is None:
-        template = packets[header]
+        parts = [chr(header)]
+        encoders[header](container, parts)
+        return "".join(parts)
     payload = template.build(container)
     return chr(header) + payload
 
 
+# packet name -> (packet id, struct format, field names) of the client
+# packets sent every tick, see make_fast_packet
+fast_client_packets = {
+    "keep alive": (0x00, ">i", ("pid",)),
+    "player": (0x0a, ">B", ("grounded",)),
+    "player position": (0x0b, ">ddddB",
+                        ("x", "y", "stance", "z", "grounded")),
+    "player look": (0x0c, ">ffB", ("yaw", "pitch", "grounded")),
+    "player position&look": (0x0d, ">ddddffB",
+                             ("x", "y", "stance", "z", "yaw", "pitch",
+                              "grounded")),
+    "entity action": (0x13, ">IB", ("eid", "action")),
+}
+
+fast_encoders = dict((name, (pid, struct.Struct(">B" + fmt[1:])))
+                     for name, (pid, fmt, _) in fast_client_packets.iteritems())
+
+
+def make_fast_packet(packet, *values):
+    """
+    Constructs a packet bytestream for one of fast_client_packets.
+
+    The payload is passed as plain values, flattened and in the order of
+    the field names, e.g. make_fast_packet("player look", yaw, pitch, True)
+    """
+
+    pid, packer = fast_encoders[packet]
+    return packer.pack(pid, *values)
+
+
 def make_error_packet(message):
     """
     Convenience method to generate an error packet bytestream.
@@ -1,15 +1,21 @@
 
 import heapq
+import math
 import time
+from collections import OrderedDict
 
 import config
 import logbot
-from gridspace import GridSpace
+import utils
+from gridspace import GridSpace, moves_affected_by
+from walkability import CAN_STAND, CAN_HOLD
 
 
 debug = False
 log = logbot.getlogger("ASTAR")
 
+INFINITY = float('inf')
+
 
 class PathNode(object):
     """Node on an astar path.  Be careful that you understand what the
@@ -97,7 +103,7 @@ class Path(object):
         self.start_aabb = start_aabb
         self.node_step = 0
         self.is_finished = False
-        self.estimated = False
+        self.estimated = estimated
 
     def __str__(self):
         nodes = '\n\t'.join([str(n) for n in self.nodes])
@@ -208,7 +214,7 @@ class AStar(object):
         if not self.path:
             path = '<PATH NOT FOUND>'
         else:
-            estimated = '' if self.path.estimated else "(estimated)"
+            estimated = "(estimated)" if self.path.estimated else ''
             path = 'path length %s %s' % (self.best.step, estimated)
             nodes = 'Nodes: %s' % self.path.nodes
         msg = "Finished in %s sec, %s iterations, %s"
@@ -262,3 +268,483 @@ class AStar(object):
                     self.finish()
                     raise StopIteration()
 
+
+
+class HPAStar(object):
+    """Long distance search over the portal graph of the dimension, see
+    portals.py. Used like AStar: iterate until StopIteration, the result is
+    in 'path'. The abstract path is refined into single moves with the in
+    cluster searches it was found with.
+    """
+
+    def __init__(self, dimension=None, start_coords=None, end_coords=None,
+                 estimate=True):
+        self.t_start = time.time()
+        self.dimension = dimension
+        self.portals = dimension.grid.portals
+        self.start = start_coords.tuple
+        self.goal = end_coords.tuple
+        self.estimate = estimate
+        self.excessive = config.HPA_EXEC_TIME_LIMIT
+        self.path = None
+        self.g = {self.start: 0}
+        # position -> (previous position, in cluster parents, entrance)
+        self.came_from = {self.start: None}
+        self.closed_set = set()
+        self.best = self.start
+        self.best_h = self.heuristic_cost_estimate(self.start)
+        self.open_heap = [(self.best_h, self.start)]
+        self.iter_count = 0
+
+    def heuristic_cost_estimate(self, crd):
+        return math.sqrt((crd[0] - self.goal[0]) ** 2 +
+                         (crd[1] - self.goal[1]) ** 2 +
+                         (crd[2] - self.goal[2]) ** 2)
+
+    def next(self):
+        self.iter_count += 1
+        if not self.open_heap:
+            self.finish()
+            raise StopIteration()
+        if time.time() - self.t_start > self.excessive:
+            log.msg("Portal path search timed out between %s and %s" %
+                    (self.start, self.goal))
+            self.finish()
+            raise StopIteration()
+        _, crd = heapq.heappop(self.open_heap)
+        if crd in self.closed_set:
+            return
+        if crd == self.goal:
+            self.best = crd
+            self.finish()
+            raise StopIteration()
+        self.closed_set.add(crd)
+        cluster = self.portals.cluster_at(crd)
+        for to, cost, parents, entrance in cluster.edges_from(crd, self.goal):
+            if to in self.closed_set:
+                continue
+            g = self.g[crd] + cost
+            if to not in self.g or g < self.g[to]:
+                self.g[to] = g
+                self.came_from[to] = (crd, parents, entrance)
+                h = self.heuristic_cost_estimate(to)
+                if h < self.best_h:
+                    self.best = to
+                    self.best_h = h
+                heapq.heappush(self.open_heap, (g + h, to))
+
+    def refine(self, crd):
+        """ positions from start to crd, one move apart """
+        segments = []
+        while self.came_from[crd] is not None:
+            previous, parents, entrance = self.came_from[crd]
+            if entrance is None:
+                segment = []
+                step = crd
+            else:
+                segment = [crd]
+                step = entrance
+            while step != previous:
+                segment.append(step)
+                step = parents[step]
+            segment.reverse()
+            segments.append(segment)
+            crd = previous
+        segments.reverse()
+        return [crd] + [step for segment in segments for step in segment]
+
+    def report(self):
+        if not self.path:
+            path = '<PATH NOT FOUND>'
+        else:
+            estimated = '(estimated)' if self.best != self.goal else ''
+            path = 'path length %s %s' % (len(self.path), estimated)
+        msg = "Portal search finished in %s sec, %s iterations, %d clusters, %s"
+        log.msg(msg % (time.time() - self.t_start, self.iter_count,
+                       len(self.portals), path))
+
+    def finish(self):
+        estimated = self.best != self.goal
+        if not estimated or self.estimate:
+            nodes = [PathNode(utils.Vector(*crd)) for crd in self.refine(self.best)]
+            self.path = Path(dimension=self.dimension, nodes=nodes,
+                             estimated=estimated)
+        self.report()
+
+
+class CachedPath(object):
+    __slots__ = ['crds', 'index', 'bb']
+
+    def __init__(self, path):
+        self.crds = [node.coords.tuple for node in path.nodes]
+        self.index = dict((crd, i) for i, crd in enumerate(self.crds))
+        xs, ys, zs = zip(*self.crds)
+        self.bb = (min(xs), min(ys), min(zs), max(xs), max(ys), max(zs))
+
+    def touched_by(self, bb):
+        """ bb is a moves_affected_by box """
+        min_x, min_y, min_z, max_x, max_y, max_z = self.bb
+        if max_x < bb.min_x or min_x >= bb.max_x or max_y < bb.min_y or \
+                min_y >= bb.max_y or max_z < bb.min_z or min_z >= bb.max_z:
+            return False
+        for x, y, z in self.crds:
+            if bb.min_x <= x < bb.max_x and bb.min_y <= y < bb.max_y and \
+                    bb.min_z <= z < bb.max_z:
+                return True
+        return False
+
+
+class PathCache(object):
+    """Paths found in one dimension by (start, goal, estimate). A start
+    lying on a cached path with the same goal gets the rest of that path.
+    Paths are dropped when the blocks along them change, the least
+    recently used when there are more than config.PATH_CACHE_SIZE.
+    Estimated paths, from searches that ran out of time or could not
+    reach the goal, are not kept.
+    """
+
+    def __init__(self, dimension, size=config.PATH_CACHE_SIZE):
+        self.dimension = dimension
+        self.size = size
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.suffix_hits = 0
+        self.misses = 0
+        self.invalidated = 0
+        dimension.grid.subscribe(self.on_grid_changed)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, start_coords, end_coords, estimate):
+        """ a new Path from start_coords to end_coords or None """
+        key = (start_coords.tuple, end_coords.tuple, estimate)
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.entries[key] = entry
+            self.hits += 1
+            return self.make_path(entry, 0)
+        for other_key, entry in reversed(self.entries.items()):
+            if other_key[1:] == key[1:] and key[0] in entry.index:
+                del self.entries[other_key]
+                self.entries[other_key] = entry
+                self.suffix_hits += 1
+                return self.make_path(entry, entry.index[key[0]])
+        self.misses += 1
+        return None
+
+    def put(self, start_coords, end_coords, estimate, path):
+        if path.estimated:
+            return
+        key = (start_coords.tuple, end_coords.tuple, estimate)
+        self.entries.pop(key, None)
+        self.entries[key] = CachedPath(path)
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+    def make_path(self, entry, start):
+        nodes = [PathNode(utils.Vector(*crd)) for crd in entry.crds[start:]]
+        return Path(dimension=self.dimension, nodes=nodes)
+
+    def on_grid_changed(self, regions):
+        boxes = [moves_affected_by(bb) for bb in regions]
+        for key, entry in self.entries.items():
+            if any(entry.touched_by(bb) for bb in boxes):
+                del self.entries[key]
+                self.invalidated += 1
+
+    def report(self):
+        return ("%d paths, %d hits, %d suffix hits, %d misses, %d invalidated" %
+                (len(self.entries), self.hits, self.suffix_hits, self.misses,
+                 self.invalidated))
+
+
+class Replan(object):
+    """One replan call of an IncrementalPlanner, iterate until
+    StopIteration. The result is in 'path'. Stops early without a path when
+    a newer replan of the same planner started.
+    """
+
+    def __init__(self, planner):
+        self.planner = planner
+        self.generation = planner.generation
+        self.t_start = time.time()
+        self.excessive = config.PATHFIND_EXEC_TIME_LIMIT
+        self.iter_count = 0
+        self.path = None
+
+    def next(self):
+        planner = self.planner
+        if planner.generation != self.generation:
+            raise StopIteration()
+        self.iter_count += 1
+        if time.time() - self.t_start > self.excessive:
+            log.msg("Replan timed out between %s and %s, %d positions known" %
+                    (planner.start, planner.goal, len(planner.g)))
+            raise StopIteration()
+        if planner.expand():
+            return
+        self.path = planner.extract_path()
+        log.msg("Replan finished in %s sec, %s iterations, %s" %
+                (time.time() - self.t_start, self.iter_count,
+                 'path length %d' % len(self.path) if self.path else
+                 '<PATH NOT FOUND>'))
+        raise StopIteration()
+
+
+class IncrementalPlanner(object):
+    """Incremental planner for following a moving goal, Moving Target D*
+    Lite: LPA* searching forward from the bot, with parent pointers.
+
+    g is the cost from the root of the search, so the goal moving only
+    changes the heuristic, the keys are corrected lazily through km. When
+    the bot moved along the path, the part of the search tree below its
+    new position is kept, the rest is dropped and rebuilt from its
+    neighbours. Block changes near known positions update their moves.
+    The search state is kept between replan calls and dropped when the
+    bot left the search tree, a chunk loads under it, it grows beyond
+    config.DSTAR_MAX_NODES or the dimension changes.
+    """
+
+    def __init__(self):
+        self.dimension = None
+        self.subscription = None
+        self.generation = 0
+        self.replans = 0
+        self.resets = 0
+        self.expanded = 0
+        self.reset()
+
+    def reset(self):
+        self.g = {}
+        self.rhs = {}
+        self.parent = {}
+        self.successors_of = {}
+        self.queue = []
+        self.queued = {}
+        self.km = 0
+        self.start = None
+        self.goal = None
+        self.changes = []
+
+    def close(self):
+        if self.subscription is not None:
+            self.subscription.cancel()
+            self.subscription = None
+        self.dimension = None
+        self.generation += 1
+        self.reset()
+
+    def replan(self, dimension, start_coords, end_coords):
+        """ a Replan that brings the search state to the new start and goal """
+        if dimension is not self.dimension:
+            self.close()
+            self.dimension = dimension
+            self.subscription = dimension.grid.subscribe(self.on_grid_changed)
+        self.gridspace = GridSpace(dimension.grid)
+        self.walkability = dimension.grid.walkability
+        self.generation += 1
+        self.replans += 1
+        start = start_coords.tuple
+        goal = end_coords.tuple
+        if self.start is not None and start != self.start:
+            if start not in self.parent or len(self.successors_of) > config.DSTAR_MAX_NODES:
+                self.resets += 1
+                self.reset()
+            else:
+                self.move_start(start)
+        if self.start is not None:
+            self.apply_changes()
+        if self.start is None:
+            self.start = start
+            self.goal = goal
+            self.rhs[start] = 0
+            self.parent[start] = None
+            self.push(start)
+        elif goal != self.goal:
+            self.km += self.heuristic(goal, self.goal)
+            self.goal = goal
+        return Replan(self)
+
+    def move_start(self, start):
+        """
+        Keep the subtree below start, its costs from the old root differ
+        from those from start by the same amount. Drop the rest.
+        """
+        in_subtree = {start: True, None: False}
+
+        def below_start(crd):
+            chain = []
+            seen = set()
+            while crd not in in_subtree:
+                if crd in seen:
+                    # inconsistent positions can point at each other
+                    in_subtree[crd] = False
+                    break
+                seen.add(crd)
+                chain.append(crd)
+                crd = self.parent.get(crd, None)
+            inside = in_subtree[crd]
+            for crd in chain:
+                in_subtree[crd] = inside
+            return inside
+
+        deleted = [crd for crd in self.parent if not below_start(crd)]
+        for crd in deleted:
+            del self.parent[crd]
+            self.g.pop(crd, None)
+            self.rhs.pop(crd, None)
+            self.queued.pop(crd, None)
+        self.parent[start] = None
+        self.rhs[start] = self.g.get(start, self.rhs.get(start, 0))
+        self.start = start
+        for crd in deleted:
+            self.update_vertex(crd)
+
+    def on_grid_changed(self, regions):
+        self.changes.extend(moves_affected_by(bb) for bb in regions)
+
+    def apply_changes(self):
+        """ update the moves of the known positions near changed blocks """
+        changes, self.changes = self.changes, []
+        for bb in changes:
+            volume = (bb.max_x - bb.min_x) * (bb.max_y - bb.min_y) * (bb.max_z - bb.min_z)
+            known = [crd for crd in self.successors_of
+                     if bb.min_x <= crd[0] < bb.max_x and bb.min_y <= crd[1] < bb.max_y and
+                     bb.min_z <= crd[2] < bb.max_z]
+            if not known:
+                continue
+            if volume > 4096:
+                # a chunk came or went under the search
+                self.resets += 1
+                self.reset()
+                return
+            touched = set(known)
+            for crd in known:
+                touched.update(self.successors_of.pop(crd))
+                touched.update(self.successors(crd))
+            for crd in touched:
+                self.update_vertex(crd)
+
+    def heuristic(self, a, b):
+        """ fewest moves from a to b, a move falls at most 3 blocks """
+        dy = b[1] - a[1]
+        return max(abs(b[0] - a[0]), abs(b[2] - a[2]), dy if dy > 0 else -dy / 3.0)
+
+    def calculate_key(self, crd):
+        cost = min(self.g.get(crd, INFINITY), self.rhs.get(crd, INFINITY))
+        return (cost + self.heuristic(crd, self.goal) + self.km, cost)
+
+    def push(self, crd):
+        key = self.calculate_key(crd)
+        self.queued[crd] = key
+        heapq.heappush(self.queue, (key, crd))
+
+    def top(self):
+        """ (key, position) with the smallest key, skipping outdated entries """
+        queue = self.queue
+        while queue:
+            key, crd = queue[0]
+            if self.queued.get(crd, None) == key:
+                return key, crd
+            heapq.heappop(queue)
+        return None, None
+
+    def successors(self, crd):
+        succ = self.successors_of.get(crd, None)
+        if succ is None:
+            succ = self.successors_of[crd] = [state.coords.tuple for state in
+                                              self.gridspace.neighbours_of(utils.Vector(*crd))]
+        return succ
+
+    def predecessors(self, crd):
+        """ known positions with a move to crd """
+        x, y, z = crd
+        bits = self.walkability.get
+        for i in (-1, 0, 1):
+            for j in (-1, 0, 1):
+                # a move goes 1 up or at most 3 down
+                for k in (-1, 0, 1, 2, 3):
+                    pred = (x + i, y + k, z + j)
+                    if pred not in self.g or pred == crd:
+                        continue
+                    if pred != self.start and not bits(*pred) & (CAN_STAND | CAN_HOLD):
+                        continue
+                    if crd in self.successors(pred):
+                        yield pred
+
+    def update_vertex(self, crd):
+        """ recompute rhs and the parent of crd from its predecessors """
+        if crd != self.start:
+            best = INFINITY
+            parent = None
+            for pred in self.predecessors(crd):
+                cost = self.g[pred] + config.COST_DIRECT
+                if cost < best:
+                    best = cost
+                    parent = pred
+            if parent is not None:
+                self.rhs[crd] = best
+                self.parent[crd] = parent
+            else:
+                self.rhs.pop(crd, None)
+                self.parent.pop(crd, None)
+        self.queue_vertex(crd)
+
+    def queue_vertex(self, crd):
+        if self.g.get(crd, INFINITY) != self.rhs.get(crd, INFINITY):
+            self.push(crd)
+        else:
+            self.queued.pop(crd, None)
+
+    def expand(self):
+        """ one step of ComputeShortestPath, False when the goal is settled """
+        key, crd = self.top()
+        goal = self.goal
+        if key is None or (key >= self.calculate_key(goal) and
+                           self.rhs.get(goal, INFINITY) == self.g.get(goal, INFINITY)):
+            return False
+        self.expanded += 1
+        new_key = self.calculate_key(crd)
+        if key < new_key:
+            self.push(crd)
+            return True
+        heapq.heappop(self.queue)
+        del self.queued[crd]
+        rhs = self.rhs.get(crd, INFINITY)
+        if self.g.get(crd, INFINITY) > rhs:
+            self.g[crd] = rhs
+            cost = rhs + config.COST_DIRECT
+            for succ in self.successors(crd):
+                if succ != self.start and cost < self.rhs.get(succ, INFINITY):
+                    self.rhs[succ] = cost
+                    self.parent[succ] = crd
+                    self.queue_vertex(succ)
+        else:
+            del self.g[crd]
+            self.update_vertex(crd)
+            for succ in self.successors(crd):
+                if self.parent.get(succ, None) == crd:
+                    self.update_vertex(succ)
+        return True
+
+    def extract_path(self):
+        """ Path from start to goal along the parent pointers, or None """
+        if self.g.get(self.goal, INFINITY) == INFINITY:
+            return None
+        crds = []
+        crd = self.goal
+        while crd is not None:
+            crds.append(crd)
+            if len(crds) > len(self.parent):
+                return None
+            crd = self.parent.get(crd, None)
+        if crds[-1] != self.start:
+            return None
+        crds.reverse()
+        nodes = [PathNode(utils.Vector(*crd)) for crd in crds]
+        return Path(dimension=self.dimension, nodes=nodes)
+
+    def report(self):
+        return ("%d replans, %d resets, %d expanded, %d positions known" %
+                (self.replans, self.resets, self.expanded, len(self.g)))
@@ -0,0 +1,341 @@
+"""
+Path searches in worker processes, away from the reactor.
+
+A search sends a snapshot of the walkability sections around its start
+and goal to a multiprocessing pool and runs AStar on it there. Positions
+outside the snapshot are not walkable, so the snapshot reaches
+config.PATHFIND_SNAPSHOT_MARGIN blocks beyond the box of the start and
+goal. Results come back through the pool's result thread and are handed
+to the reactor with callFromThread.
+
+While a search is out, a grid subscription on its snapshot box watches
+for changes. A result computed from a snapshot that changed meanwhile is
+dropped and the search sent again. Cancelled searches drop their result.
+Searches run on the reactor as before when there are no workers, when
+the snapshot would be too big, when a worker fails and when no result
+came back config.PATHFIND_WORKER_TIME_MARGIN seconds after the worker
+time limit, as when a worker died. The time counts from when a worker
+takes the search, searches queued behind busy workers wait their turn.
+A result arriving after that is dropped.
+"""
+
+import itertools
+import signal
+import time
+import traceback
+from collections import deque
+
+try:
+    import multiprocessing
+except ImportError:
+    multiprocessing = None
+
+from twisted.internet import reactor
+from twisted.internet.defer import Deferred
+from twisted.internet.task import cooperate
+
+import config
+import logbot
+import utils
+from axisbox import AABB
+from pathfinding import AStar, Path, PathNode
+
+
+log = logbot.getlogger("PATH SERVICE")
+
+
+class SnapshotWalkability(object):
+    """ Walkability.get over the sections of a snapshot """
+
+    def __init__(self, sections):
+        self.sections = sections
+
+    def get(self, x, y, z):
+        section = self.sections.get((x >> 4, z >> 4, y >> 4), None)
+        if section is None:
+            return 0
+        return section[(y & 15) << 8 | (z & 15) << 4 | (x & 15)]
+
+
+class Snapshot(object):
+    """ stands in for the dimension and its grid in a worker """
+
+    def __init__(self, sections):
+        self.grid = self
+        self.walkability = SnapshotWalkability(sections)
+
+
+def init_worker():
+    # the bot handles ctrl-c and terminates the pool
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+def search_snapshot(sections, start, goal, estimate, time_limit):
+    """
+    Worker side of a search. Returns (path positions or None, estimated,
+    None) or (None, None, traceback) when the search failed.
+    """
+    try:
+        snapshot = Snapshot(dict((key, bytearray(data)) for key, data in sections.iteritems()))
+        astar = AStar(dimension=snapshot, start_coords=utils.Vector(*start),
+                      end_coords=utils.Vector(*goal), estimate=estimate)
+        astar.excessive = time_limit
+        astar.report = lambda: None
+        try:
+            while True:
+                astar.next()
+        except StopIteration:
+            pass
+        if astar.path is None:
+            return None, None, None
+        estimated = astar.best.coords != astar.goal_node.coords
+        return [node.coords.tuple for node in astar.path.nodes], estimated, None
+    except Exception:
+        return None, None, traceback.format_exc()
+
+
+class WorkerJob(object):
+    """ a send of a search to the pool, see PathService.jobs """
+
+    def __init__(self, search):
+        self.search = search
+        self.result = None
+        self.deadline = None
+
+
+class PathSearch(object):
+    """ one search handed out by PathService.find """
+
+    def __init__(self, service, dimension, start_coords, end_coords, estimate):
+        self.service = service
+        self.dimension = dimension
+        self.start_coords = start_coords
+        self.end_coords = end_coords
+        self.estimate = estimate
+        self.deferred = Deferred(self.cancel)
+        self.cancelled = False
+        self.stale = False
+        self.attempts = 0
+        self.subscription = None
+        self.task = None
+        # WorkerJob whose result is awaited
+        self.job = None
+        self.t_start = time.time()
+
+    def snapshot_box(self):
+        """ AABB of the sections sent to the worker """
+        start = utils.Vector(*[int(v) for v in self.start_coords.tuple])
+        end = utils.Vector(*[int(v) for v in self.end_coords.tuple])
+        margin = config.PATHFIND_SNAPSHOT_MARGIN
+        min_y = max(0, (min(start.y, end.y) - margin) >> 4 << 4)
+        max_y = min(config.WORLD_HEIGHT, ((max(start.y, end.y) + margin) >> 4) + 1 << 4)
+        return AABB((min(start.x, end.x) - margin) >> 4 << 4, min_y,
+                    (min(start.z, end.z) - margin) >> 4 << 4,
+                    ((max(start.x, end.x) + margin) >> 4) + 1 << 4, max_y,
+                    ((max(start.z, end.z) + margin) >> 4) + 1 << 4)
+
+    def section_keys(self):
+        bb = self.snapshot_box()
+        for chunk_x in xrange(bb.min_x >> 4, bb.max_x >> 4):
+            for chunk_z in xrange(bb.min_z >> 4, bb.max_z >> 4):
+                for level in xrange(bb.min_y >> 4, bb.max_y >> 4):
+                    yield chunk_x, chunk_z, level
+
+    def on_grid_changed(self, regions):
+        self.stale = True
+
+    def watch(self):
+        self.stale = False
+        self.subscription = self.dimension.grid.subscribe(self.on_grid_changed,
+                                                          aabb=self.snapshot_box())
+
+    def unwatch(self):
+        if self.subscription is not None:
+            self.subscription.cancel()
+            self.subscription = None
+
+    def changed(self):
+        """ changed since the snapshot, including the changes not yet delivered """
+        return self.stale or (self.subscription is not None and bool(self.subscription.regions))
+
+    def cancel(self, deferred=None):
+        self.cancelled = True
+        self.job = None
+        self.unwatch()
+        if self.task is not None:
+            self.task.stop()
+            self.task = None
+        self.service.searches.discard(self)
+        self.service.cancelled += 1
+
+    def finish(self, path):
+        self.unwatch()
+        self.task = None
+        self.service.searches.discard(self)
+        if not self.cancelled:
+            self.deferred.callback(path)
+
+
+class PathService(object):
+    """
+    find(dimension, start_coords, end_coords, estimate) returns a Deferred
+    that fires with a Path, or None when no path was found. Cancelling the
+    Deferred drops the search.
+    """
+
+    def __init__(self, workers=config.PATHFIND_WORKERS):
+        self.workers = workers
+        self.pool = None
+        self.searches = set()
+        # jobs not answered yet in the order the workers take them, the
+        # first self.workers are running
+        self.jobs = deque()
+        self.sent = 0
+        self.finished = 0
+        self.local = 0
+        self.stale = 0
+        self.cancelled = 0
+        self.failed = 0
+        self.lost = 0
+        if workers and multiprocessing is not None:
+            try:
+                self.pool = multiprocessing.Pool(workers, init_worker)
+            except (OSError, ImportError) as e:
+                log.msg("Cannot start %d path workers, searching on the reactor: %s" % (workers, e))
+
+    def find(self, dimension, start_coords, end_coords, estimate=True):
+        search = PathSearch(self, dimension, start_coords, end_coords, estimate)
+        self.searches.add(search)
+        if self.pool is None or self.snapshot_size(search) > config.PATHFIND_SNAPSHOT_SECTIONS:
+            self.search_locally(search)
+        else:
+            self.send(search)
+        return search.deferred
+
+    def snapshot_size(self, search):
+        bb = search.snapshot_box()
+        return ((bb.max_x - bb.min_x) >> 4) * ((bb.max_y - bb.min_y) >> 4) * ((bb.max_z - bb.min_z) >> 4)
+
+    def send(self, search):
+        """ build the snapshot a few sections per reactor iteration, then send it """
+        search.attempts += 1
+        search.watch()
+        sections = {}
+
+        def collect():
+            walkability = search.dimension.grid.walkability
+            for key in search.section_keys():
+                if search.cancelled:
+                    return
+                sections[key] = str(walkability.section(*key))
+                yield None
+
+        def submit(_):
+            search.task = None
+            if search.cancelled:
+                return
+            if search.changed():
+                search.unwatch()
+                self.send(search)
+                return
+            self.sent += 1
+            args = (sections, search.start_coords.tuple, search.end_coords.tuple,
+                    search.estimate, config.PATHFIND_WORKER_TIME_LIMIT)
+            job = search.job = WorkerJob(search)
+            callback = lambda result: reactor.callFromThread(self.on_result, job, result)
+            job.result = self.pool.apply_async(search_snapshot, args, callback=callback)
+            self.jobs.append(job)
+            self.start_deadlines()
+
+        search.task = cooperate(collect())
+        search.task.whenDone().addCallbacks(submit, lambda failure: None)
+
+    def start_deadlines(self):
+        """ deadlines of the jobs the workers are running """
+        for job in itertools.islice(self.jobs, self.workers):
+            if job.deadline is None:
+                job.deadline = reactor.callLater(
+                    config.PATHFIND_WORKER_TIME_LIMIT + config.PATHFIND_WORKER_TIME_MARGIN,
+                    self.on_deadline, job)
+
+    def job_done(self, job):
+        """ the job left its worker, the next queued one starts """
+        if job.deadline is not None and job.deadline.active():
+            job.deadline.cancel()
+        if job in self.jobs:
+            self.jobs.remove(job)
+            self.start_deadlines()
+
+    def on_result(self, job, result):
+        self.job_done(job)
+        search = job.search
+        if search.cancelled or search.job is not job:
+            return
+        search.job = None
+        positions, estimated, error = result
+        if error is not None:
+            self.failed += 1
+            log.msg("Path worker failed, searching on the reactor\n%s" % error)
+            search.unwatch()
+            self.search_locally(search)
+            return
+        if search.changed():
+            self.stale += 1
+            search.unwatch()
+            if search.attempts < config.PATHFIND_STALE_RETRIES:
+                self.send(search)
+            else:
+                self.search_locally(search)
+            return
+        self.finished += 1
+        path = None
+        if positions is not None:
+            path = Path(dimension=search.dimension,
+                        nodes=[PathNode(utils.Vector(*crd)) for crd in positions],
+                        estimated=estimated)
+        log.msg("Worker search %s to %s in %.3f sec, %s" %
+                (search.start_coords, search.end_coords, time.time() - search.t_start,
+                 "path length %d" % len(path) if path is not None else "<PATH NOT FOUND>"))
+        search.finish(path)
+
+    def on_deadline(self, job):
+        job.deadline = None
+        if job.result.ready():
+            # the result is on its way to the reactor
+            return
+        self.lost += 1
+        self.job_done(job)
+        search = job.search
+        if search.cancelled or search.job is not job:
+            return
+        log.msg("No result from the path worker in %.1f sec, searching on the reactor" %
+                (time.time() - search.t_start))
+        search.job = None
+        search.unwatch()
+        self.search_locally(search)
+
+    def search_locally(self, search):
+        self.local += 1
+        astar = AStar(dimension=search.dimension, start_coords=search.start_coords,
+                      end_coords=search.end_coords, estimate=search.estimate)
+        search.task = cooperate(astar)
+        d = search.task.whenDone()
+        d.addCallback(lambda astar: search.finish(astar.path))
+        d.addErrback(lambda failure: None if search.cancelled else logbot.exit_on_error(failure))
+
+    def close(self):
+        for search in list(self.searches):
+            search.deferred.cancel()
+        for job in self.jobs:
+            if job.deadline is not None and job.deadline.active():
+                job.deadline.cancel()
+        self.jobs.clear()
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool = None
+
+    def report(self):
+        return "%d workers, %d in flight, %d with the workers, %d sent, %d finished, " \
+            "%d stale, %d cancelled, %d failed, %d lost, %d on the reactor" % \
+            (self.workers if self.pool is not None else 0, len(self.searches), len(self.jobs),
+             self.sent, self.finished, self.stale, self.cancelled, self.failed, self.lost, self.local)
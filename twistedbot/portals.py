@@ -0,0 +1,230 @@
+"""
+Abstract graph over chunk sections for long path searches, HPA* style.
+
+Every 16^3 section is a cluster. Building a cluster records the moves
+GridSpace allows between its walkable positions, and the moves that leave
+it. Positions with moves out of the cluster are grouped into entrances,
+connected runs with the same neighbouring clusters, each represented by
+its middle position. A search steps from a position to the entrances it
+can reach inside its cluster and across them into the next cluster; the
+distances inside a cluster are found once per start position and kept
+until the cluster changes, the config.PORTAL_SEARCHES most recently used
+of the whole graph.
+
+Clusters are built when a search first needs them and dropped when a
+chunk load or block change could have changed them.
+"""
+
+import itertools
+from collections import deque, OrderedDict
+
+import config
+import logbot
+import utils
+from gridspace import GridSpace, moves_affected_by
+from walkability import CAN_STAND, CAN_HOLD
+
+
+log = logbot.getlogger("PORTALS")
+
+WALKABLE = CAN_STAND | CAN_HOLD
+
+
+serials = itertools.count()
+
+
+def cluster_key(x, y, z):
+    return (x >> 4, z >> 4, y >> 4)
+
+
+class SearchCache(object):
+    """
+    In cluster searches by (cluster serial, start position). Keeps the
+    size most recently used, positions counts the positions they hold.
+    """
+
+    def __init__(self, size=config.PORTAL_SEARCHES):
+        self.size = size
+        self.searches = OrderedDict()
+        self.positions = 0
+
+    def __len__(self):
+        return len(self.searches)
+
+    def get(self, key):
+        found = self.searches.pop(key, None)
+        if found is not None:
+            self.searches[key] = found
+        return found
+
+    def put(self, key, found):
+        self.searches[key] = found
+        self.positions += len(found[0])
+        while len(self.searches) > self.size:
+            _, dropped = self.searches.popitem(last=False)
+            self.positions -= len(dropped[0])
+
+    def clear(self):
+        self.searches.clear()
+        self.positions = 0
+
+
+class Cluster(object):
+    """
+    moves: position -> positions one GridSpace move away in this cluster
+    exits: entrance position -> positions one move away in other clusters
+    searched: SearchCache of the in cluster searches, shared by the graph
+    """
+
+    def __init__(self, grid, key, searched=None):
+        self.grid = grid
+        self.key = key
+        # a rebuilt cluster does not see the searches of the one it replaces
+        self.serial = next(serials)
+        self.moves = {}
+        self.exits = {}
+        self.searched = SearchCache() if searched is None else searched
+        if 0 <= key[2] < config.WORLD_HEIGHT >> 4:
+            self.build(grid.walkability.section(*key))
+
+    def build(self, bits):
+        chunk_x, chunk_z, level = self.key
+        x0 = chunk_x << 4
+        y0 = level << 4
+        z0 = chunk_z << 4
+        gridspace = GridSpace(self.grid)
+        leaving = {}
+        for pos in xrange(4096):
+            if not bits[pos] & WALKABLE:
+                continue
+            crd = (x0 + (pos & 15), y0 + (pos >> 8), z0 + ((pos >> 4) & 15))
+            inside, outside = self.neighbours(crd, gridspace)
+            self.moves[crd] = inside
+            if outside:
+                leaving[crd] = outside
+        self.find_entrances(leaving)
+
+    def neighbours(self, crd, gridspace=None):
+        """ positions one move from crd, ([inside the cluster], [outside]) """
+        if gridspace is None:
+            gridspace = GridSpace(self.grid)
+        inside = []
+        outside = []
+        for state in gridspace.neighbours_of(utils.Vector(*crd)):
+            to = state.coords.x, state.coords.y, state.coords.z
+            if cluster_key(*to) == self.key:
+                inside.append(to)
+            else:
+                outside.append(to)
+        return inside, outside
+
+    def find_entrances(self, leaving):
+        """ one entrance per connected run of positions leaving to the same clusters """
+        seen = set()
+        for crd in sorted(leaving):
+            if crd in seen:
+                continue
+            targets = frozenset(cluster_key(*to) for to in leaving[crd])
+            run = []
+            todo = [crd]
+            seen.add(crd)
+            while todo:
+                cur = todo.pop()
+                run.append(cur)
+                for dx in (-1, 0, 1):
+                    for dy in (-1, 0, 1):
+                        for dz in (-1, 0, 1):
+                            nxt = (cur[0] + dx, cur[1] + dy, cur[2] + dz)
+                            if nxt in leaving and nxt not in seen and \
+                                    frozenset(cluster_key(*to) for to in leaving[nxt]) == targets:
+                                seen.add(nxt)
+                                todo.append(nxt)
+            run.sort()
+            middle = run[len(run) / 2]
+            self.exits[middle] = leaving[middle]
+
+    def search_from(self, crd):
+        """
+        (distances, parents) of the positions reachable from crd without
+        leaving the cluster, crd need not be walkable itself.
+        """
+        found = self.searched.get((self.serial, crd))
+        if found is not None:
+            return found
+        distances = {crd: 0}
+        parents = {crd: None}
+        queue = deque([crd])
+        while queue:
+            cur = queue.popleft()
+            moves = self.moves.get(cur, None)
+            if moves is None:
+                moves = self.moves[cur] = self.neighbours(cur)[0]
+            for nxt in moves:
+                if nxt not in distances:
+                    distances[nxt] = distances[cur] + 1
+                    parents[nxt] = cur
+                    queue.append(nxt)
+        found = (distances, parents)
+        self.searched.put((self.serial, crd), found)
+        return found
+
+    def edges_from(self, crd, goal=None):
+        """
+        Yield (position, cost, parents, entrance) of the abstract moves
+        from crd: through each entrance reachable inside the cluster, and
+        to goal, entrance None, if it is in the cluster and reachable.
+        parents leads back to crd.
+        """
+        distances, parents = self.search_from(crd)
+        if goal is not None and goal in distances:
+            yield goal, distances[goal], parents, None
+        for entrance, outside in self.exits.iteritems():
+            if entrance in distances:
+                for to in outside:
+                    yield to, distances[entrance] + 1, parents, entrance
+
+
+class PortalGraph(object):
+    """
+    Clusters of a grid. Keeps at most config.PORTAL_CLUSTERS, starts over
+    when there are more.
+    """
+
+    def __init__(self, grid):
+        self.grid = grid
+        self.clusters = {}
+        self.searched = SearchCache()
+        self.built = 0
+
+    def __len__(self):
+        return len(self.clusters)
+
+    def cluster_at(self, crd):
+        key = cluster_key(*crd)
+        cluster = self.clusters.get(key, None)
+        if cluster is None:
+            if len(self.clusters) >= config.PORTAL_CLUSTERS:
+                log.msg("%d clusters built, starting over" % len(self.clusters))
+                self.clusters.clear()
+                self.searched.clear()
+            cluster = self.clusters[key] = Cluster(self.grid, key, self.searched)
+            self.built += 1
+        return cluster
+
+    def invalidate(self, bb):
+        """ drop the clusters whose moves can depend on the blocks in bb """
+        if not self.clusters:
+            return
+        bb = moves_affected_by(bb)
+        x0 = bb.min_x >> 4
+        x1 = (bb.max_x - 1) >> 4
+        y0 = bb.min_y >> 4
+        y1 = (bb.max_y - 1) >> 4
+        z0 = bb.min_z >> 4
+        z1 = (bb.max_z - 1) >> 4
+        for key in self.clusters.keys():
+            if x0 <= key[0] <= x1 and z0 <= key[1] <= z1 and y0 <= key[2] <= y1:
+                del self.clusters[key]
+
+    def invalidate_chunk(self, chunk_x, chunk_z):
+        self.invalidate(self.grid.chunk_column(chunk_x, chunk_z))
@@ -5,7 +5,7 @@ from collections import defaultdict
 
 import twistedbot.logbot as logbot
 from twistedbot.packets import packets
-from twistedbot.packets import Container, Metadata
+from twistedbot.packets import Container, Metadata, LazyNBT
 
 from pynbt import NBTFile
 
@@ -40,6 +40,8 @@ statistics = defaultdict(lambda: defaultdict(int))
 def format_packet(data, prefix="  ", depth=1):
     """ return formated string of the packet """
     prefixstr = prefix * depth
+    if isinstance(data, LazyNBT):
+        data = data.nbt
     if isinstance(data, NBTFile):
         return data.pretty(indent=depth, indent_str=prefix)
     if isinstance(data, Container) or isinstance(data, types.DictType):
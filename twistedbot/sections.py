@@ -0,0 +1,122 @@
+"""
+Compact read only storage for chunk sections.
+
+Most sections the server sends are all air or all stone, or use only a
+handful of block types. Such sections are kept as a shared
+UniformSection or as a PaletteSection of packed palette indices instead
+of a dense array('B'). Both index like the dense array; the chunk
+classes convert them to their dense storage on the first write.
+"""
+
+import array
+
+
+class UniformSection(object):
+    """ every byte of the section has the same value, shared by all chunks """
+    __slots__ = ("value", "length")
+
+    def __init__(self, value, length):
+        self.value = value
+        self.length = length
+
+    def __getitem__(self, i):
+        return self.value
+
+    def __len__(self):
+        return self.length
+
+    def tostring(self):
+        return chr(self.value) * self.length
+
+    @property
+    def nbytes(self):
+        return 0
+
+
+class PaletteSection(object):
+    """ bytes as 1, 2 or 4 bit indices into a palette of at most 16 values """
+    __slots__ = ("palette", "bits", "mask", "per_byte", "data")
+
+    def __init__(self, palette, data_str):
+        self.palette = palette
+        if len(palette) <= 2:
+            self.bits = 1
+        elif len(palette) <= 4:
+            self.bits = 2
+        else:
+            self.bits = 4
+        self.mask = (1 << self.bits) - 1
+        self.per_byte = 8 / self.bits
+        table = [0] * 256
+        for index, value in enumerate(palette):
+            table[value] = index
+        indices = array.array('B', data_str.translate(''.join(chr(i) for i in table)))
+        packed = indices[0::self.per_byte]
+        for k in xrange(1, self.per_byte):
+            shift = k * self.bits
+            packed = array.array('B', [a | (b << shift) for a, b in zip(packed, indices[k::self.per_byte])])
+        self.data = packed
+
+    def __getitem__(self, i):
+        bits = self.bits
+        index = self.data[i / self.per_byte] >> (i % self.per_byte * bits) & self.mask
+        return self.palette[index]
+
+    def __len__(self):
+        return len(self.data) * self.per_byte
+
+    def tostring(self):
+        table = []
+        for b in xrange(256):
+            values = []
+            for k in xrange(self.per_byte):
+                index = b >> (k * self.bits) & self.mask
+                values.append(chr(self.palette[index]) if index < len(self.palette) else '\x00')
+            table.append(''.join(values))
+        return ''.join(table[b] for b in self.data)
+
+    @property
+    def nbytes(self):
+        return len(self.data) + len(self.palette)
+
+
+uniform_sections = {}
+
+
+def uniform_section(value, length):
+    """ the shared UniformSection for value and length """
+    key = (value, length)
+    section = uniform_sections.get(key, None)
+    if section is None:
+        section = uniform_sections.setdefault(key, UniformSection(value, length))
+    return section
+
+
+def is_uniform(data_str):
+    return data_str == data_str[0] * len(data_str)
+
+
+def compact(data_str):
+    """ smallest storage for the section bytes data_str """
+    if is_uniform(data_str):
+        return uniform_section(ord(data_str[0]), len(data_str))
+    values = set(data_str)
+    if len(values) <= 16:
+        return PaletteSection(tuple(sorted(ord(v) for v in values)), data_str)
+    return array.array('B', data_str)
+
+
+def dense(section):
+    """ writable array('B') copy of a compact section """
+    if isinstance(section, array.array):
+        return section
+    return array.array('B', section.tostring())
+
+
+def section_info(section):
+    """ (kind, bytes held by this section alone) """
+    if isinstance(section, UniformSection):
+        return "uniform", 0
+    elif isinstance(section, PaletteSection):
+        return "palette", section.nbytes
+    return "dense", section.itemsize * len(section)
@@ -54,6 +54,18 @@ class SignWayPoints(object):
         self.sign_points = {}
         self.crd_to_sign = {}
         self.ordered_sign_groups = {}
+        self.dimension.grid.subscribe(self.on_grid_changed)
+
+    def on_grid_changed(self, regions):
+        """ forget waypoints whose sign was removed """
+        grid = self.dimension.grid
+        for crd, sign in self.crd_to_sign.items():
+            if not grid.chunk_complete_at(crd.x, crd.z):
+                continue
+            for bb in regions:
+                if bb.min_x <= crd.x < bb.max_x and bb.min_y <= crd.y < bb.max_y and bb.min_z <= crd.z < bb.max_z:
+                    self.check_sign(sign)
+                    break
 
     def on_new_sign(self, x, y, z, line1, line2, line3, line4):
         sign = Sign(utils.Vector(x, y, z), line1, line2, line3, line4)
@@ -106,6 +118,7 @@ class SignWayPoints(object):
                     del self.ordered_sign_groups[sign.group]
             if sign.name in self.sign_points:
                 del self.sign_points[sign.name]
+            del self.crd_to_sign[crd]
 
     def get_namepoint(self, name):
         if self.has_name_point(name):
@@ -0,0 +1,189 @@
+"""
+Walkability of every block position, kept per dimension and reused by all
+path searches.
+
+Each 16^3 section is a bytearray of 4096 cells indexed like the chunk
+sections, y * 256 + z * 16 + x, holding the CAN_* and IN_* bits below. A
+cell looks at the block under it and the two blocks a player occupies, so
+a section is built from its blocks plus one layer below and above.
+Sections are built on first use and dropped when a block change, chunk
+load or eviction could have changed them.
+"""
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+import blocks
+import config
+import logbot
+
+
+log = logbot.getlogger("WALKABILITY")
+
+CAN_BE = 1 << 0
+CAN_STAND = 1 << 1
+CAN_JUMP = 1 << 2
+CAN_FALL = 1 << 3
+CAN_CLIMB = 1 << 4
+IN_FIRE = 1 << 5
+IN_WATER = 1 << 6
+CAN_HOLD = 1 << 7
+
+if numpy is not None:
+    flag_table = numpy.array(blocks.block_flags, dtype=numpy.uint32)
+
+
+def cell_bits(flags_0, flags_1, flags_2):
+    """ bits of a position from the flags of the block below, at and above it """
+    both = flags_1 & flags_2
+    either = flags_1 | flags_2
+    bits = 0
+    if both & blocks.FALL_THROUGH:
+        bits |= CAN_BE
+        if flags_0 & blocks.STAND_ON:
+            bits |= CAN_STAND
+            if both & blocks.FREE:
+                bits |= CAN_JUMP
+        if flags_0 & blocks.FALL_THROUGH:
+            bits |= CAN_FALL
+        if flags_1 & blocks.CLIMBABLE:
+            bits |= CAN_CLIMB
+    if either & blocks.BURNING:
+        bits |= IN_FIRE
+    if either & blocks.WATER:
+        bits |= IN_WATER | CAN_HOLD
+    if flags_1 & blocks.LADDER or (flags_1 & blocks.VINE and flags_1 & blocks.CLIMBABLE):
+        bits |= CAN_HOLD
+    return bits
+
+
+def section_bits(grid, chunk_x, chunk_z, level):
+    """ bytearray of the cell bits of a section """
+    x0 = chunk_x << 4
+    y0 = level << 4
+    z0 = chunk_z << 4
+    if numpy is not None:
+        return numpy_section_bits(grid, x0, y0, z0)
+    # flags of the 18 layers y0 - 1 .. y0 + 16, indexed layer * 256 + z * 16 + x
+    flags = []
+    for y in xrange(y0 - 1, y0 + 17):
+        for z in xrange(z0, z0 + 16):
+            for x in xrange(x0, x0 + 16):
+                flags.append(grid.get_block_flags(x, y, z))
+    out = bytearray(4096)
+    for pos in xrange(4096):
+        out[pos] = cell_bits(flags[pos], flags[pos + 256], flags[pos + 512])
+    return out
+
+
+def numpy_section_bits(grid, x0, y0, z0):
+    ids, metas = grid.get_region(x0, y0 - 1, z0, x0 + 16, y0 + 17, z0 + 16)
+    flags = flag_table.take((ids.astype(numpy.uint32) << 4) | metas, mode='clip')
+    for i, j, k in zip(*numpy.nonzero(flags & blocks.NEIGHBOURS_MASK)):
+        flags[i, j, k] = grid.get_block_flags(x0 + int(i), y0 - 1 + int(j), z0 + int(k))
+    # [x, y, z] to the [y, z, x] order of the chunk sections
+    flags = flags.transpose(1, 2, 0)
+    flags_0 = flags[0:16]
+    flags_1 = flags[1:17]
+    flags_2 = flags[2:18]
+    both = flags_1 & flags_2
+    either = flags_1 | flags_2
+    can_be = (both & blocks.FALL_THROUGH) != 0
+    can_stand = can_be & ((flags_0 & blocks.STAND_ON) != 0)
+    can_hold = ((either & blocks.WATER) != 0) | ((flags_1 & blocks.LADDER) != 0) | \
+        (((flags_1 & blocks.VINE) != 0) & ((flags_1 & blocks.CLIMBABLE) != 0))
+    out = numpy.zeros((16, 16, 16), dtype=numpy.uint8)
+    out |= can_be * numpy.uint8(CAN_BE)
+    out |= can_stand * numpy.uint8(CAN_STAND)
+    out |= (can_stand & ((both & blocks.FREE) != 0)) * numpy.uint8(CAN_JUMP)
+    out |= (can_be & ((flags_0 & blocks.FALL_THROUGH) != 0)) * numpy.uint8(CAN_FALL)
+    out |= (can_be & ((flags_1 & blocks.CLIMBABLE) != 0)) * numpy.uint8(CAN_CLIMB)
+    out |= ((either & blocks.BURNING) != 0) * numpy.uint8(IN_FIRE)
+    out |= ((either & blocks.WATER) != 0) * numpy.uint8(IN_WATER)
+    out |= can_hold * numpy.uint8(CAN_HOLD)
+    return bytearray(out.tostring())
+
+
+class Walkability(object):
+    """
+    Cell bits of a grid. Keeps at most config.WALKABILITY_SECTIONS built
+    sections, starts over when there are more.
+    """
+
+    def __init__(self, grid):
+        self.grid = grid
+        self.sections = {}
+        self.built = 0
+        self.dropped = 0
+
+    def __len__(self):
+        return len(self.sections)
+
+    def get(self, x, y, z):
+        """ cell bits at x, y, z """
+        if y < 0 or y >= config.WORLD_HEIGHT:
+            return self.outside(x, y, z)
+        key = (x >> 4, z >> 4, y >> 4)
+        section = self.sections.get(key, None)
+        if section is None:
+            section = self.build(key)
+        return section[(y & 15) << 8 | (z & 15) << 4 | (x & 15)]
+
+    def section(self, chunk_x, chunk_z, level):
+        """ bytearray of the cell bits of a section, built if needed """
+        key = (chunk_x, chunk_z, level)
+        section = self.sections.get(key, None)
+        if section is None:
+            section = self.build(key)
+        return section
+
+    def outside(self, x, y, z):
+        grid = self.grid
+        return cell_bits(grid.get_block_flags(x, y - 1, z), grid.get_block_flags(x, y, z),
+                         grid.get_block_flags(x, y + 1, z))
+
+    def build(self, key):
+        if len(self.sections) >= config.WALKABILITY_SECTIONS:
+            log.msg("%d sections built, starting over" % len(self.sections))
+            self.dropped += len(self.sections)
+            self.sections.clear()
+        section = self.sections[key] = section_bits(self.grid, *key)
+        self.built += 1
+        return section
+
+    def invalidate(self, bb):
+        """
+        Drop the sections that depend on the blocks in bb. A cell depends
+        on the blocks one below and above it, and neighbour dependent
+        blocks on their neighbours, hence the margin.
+        """
+        if not self.sections:
+            return
+        x0 = (int(bb.min_x) - 1) >> 4
+        x1 = (int(bb.max_x) + 1) >> 4
+        y0 = max(0, (int(bb.min_y) - 2) >> 4)
+        y1 = min(config.WORLD_HEIGHT - 1, int(bb.max_y) + 2) >> 4
+        z0 = (int(bb.min_z) - 1) >> 4
+        z1 = (int(bb.max_z) + 1) >> 4
+        count = (x1 - x0 + 1) * (y1 - y0 + 1) * (z1 - z0 + 1)
+        if count > len(self.sections):
+            for key in self.sections.keys():
+                if x0 <= key[0] <= x1 and z0 <= key[1] <= z1 and y0 <= key[2] <= y1:
+                    del self.sections[key]
+        else:
+            for chunk_x in xrange(x0, x1 + 1):
+                for chunk_z in xrange(z0, z1 + 1):
+                    for level in xrange(y0, y1 + 1):
+                        self.sections.pop((chunk_x, chunk_z, level), None)
+
+    def invalidate_chunk(self, chunk_x, chunk_z):
+        """ the chunk and the edges of its neighbours changed """
+        self.invalidate(self.grid.chunk_column(chunk_x, chunk_z))
+
+    def drop_chunk(self, chunk_x, chunk_z):
+        """ forget the sections of a chunk that left memory, unchanged """
+        if self.sections:
+            for level in xrange(config.WORLD_HEIGHT >> 4):
+                self.sections.pop((chunk_x, chunk_z, level), None)
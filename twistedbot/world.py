@@ -1,5 +1,6 @@
 
 
+import os
 from collections import defaultdict
 from datetime import datetime
 from Queue import Empty, Full
@@ -14,12 +15,17 @@ from entities import Entities
 from grid import Grid
 from statistics import Statistics
 from chat import Chat
+from chunkcache import ChunkCache
 from botentity import BotEntity
 from signwaypoints import SignWayPoints
+from pathfinding import PathCache
+from pathservice import PathService
 
 
 log = logbot.getlogger("WORLD")
 
+dimension_names = ["nether", "overworld", "end"]
+
 
 class Dimension(object):
 
@@ -28,6 +34,7 @@ class Dimension(object):
         self.entities = Entities(self)
         self.grid = Grid(self)
         self.sign_waypoints = SignWayPoints(self)
+        self.path_cache = PathCache(self)
 
 
 class DummyQueue(object):
@@ -71,6 +78,10 @@ class World(object):
         self.sign_waypoints = None
         self.dimension = None
         self.dimensions = [Dimension(self), Dimension(self), Dimension(self)]
+        # before the chunk cache threads start, the workers are forked
+        self.path_service = PathService()
+        if config.CHUNK_CACHE_DIR is not None and host is not None:
+            self.open_chunk_caches(os.path.join(config.CHUNK_CACHE_DIR, "%s_%s" % (host, port)))
         self.spawn_position = None
         self.game_mode = None
         self.difficulty = None
@@ -99,6 +110,7 @@ class World(object):
     def tick(self):
         tick_start = datetime.now()
         if self.logged_in:
+            self.dimension.grid.deliver_changes()
             self.bot.tick()
             self.chat.tick()
             self.every_n_ticks()
@@ -106,12 +118,40 @@ class World(object):
 
     def every_n_ticks(self, n=100):
         self.game_ticks += 1
+        if self.game_ticks % n == 0:
+            self.enforce_chunk_budget()
+            for dimension in self.dimensions:
+                dimension.grid.save_dirty()
+
+    def open_chunk_caches(self, directory):
+        for name, dimension in zip(dimension_names, self.dimensions):
+            try:
+                dimension.grid.cache = ChunkCache(os.path.join(directory, name))
+            except (IOError, OSError) as e:
+                log.msg("Cannot open chunk cache for %s: %s" % (name, e))
+
+    def enforce_chunk_budget(self):
+        """
+        Keep the current dimension within the chunk budget around the bot,
+        other dimensions are not visible and get evicted entirely.
+        """
+        bot = self.bot.bot_object
+        center = (bot.grid_x >> 4, bot.grid_z >> 4)
+        max_bytes = None if config.CHUNK_BUDGET_MB is None else config.CHUNK_BUDGET_MB * 1024 * 1024
+        for dimension in self.dimensions:
+            if dimension is self.dimension:
+                dimension.grid.enforce_budget(center, config.CHUNK_BUDGET, max_bytes,
+                                              keep_radius=config.CHUNK_KEEP_RADIUS)
+            elif dimension.grid.chunks:
+                dimension.grid.enforce_budget(max_chunks=0)
 
     def on_connection_lost(self):
         self.connected = False
         self.logged_in = False
         self.protocol = None
         self.bot.on_connection_lost()
+        for dimension in self.dimensions:
+            dimension.grid.mark_stale()
 
     def connection_made(self):
         self.connected = True
@@ -120,6 +160,12 @@ class World(object):
         reason = self.shutdown_reason
         reason = reason if reason else "(no reason given)"
         log.msg("Shutting Down: " + reason)
+        for dimension in self.dimensions:
+            if dimension.grid.cache is not None:
+                dimension.grid.save_dirty()
+                dimension.grid.cache.close()
+                dimension.grid.cache = None
+        self.path_service.close()
         if self.protocol._transactions \
           and len(self.protocol._transactions) > 5:
             log.msg("Possible memory leak: %s" % self.factory._transactions)
@@ -138,6 +184,27 @@ class World(object):
         else:
             log.msg("Trying to send %s while disconnected" % name)
 
+    def send_fast_packet(self, name, *values):
+        """ see packets.make_fast_packet """
+        if self.protocol is not None:
+            self.protocol.send_fast_packet(name, *values)
+        else:
+            log.msg("Trying to send %s while disconnected" % name)
+
+    def memory_report(self):
+        """ one line of chunk storage statistics per dimension """
+        lines = []
+        for name, dimension in zip(dimension_names, self.dimensions):
+            report = dimension.grid.memory_report()
+            lines.append("%s: %d chunks (%d stale), %d sections (%d dense, %d palette, %d uniform), "
+                         "%.1f KiB, %d evicted %.1f KiB, %d walkability sections, %d portal clusters, "
+                         "%d portal searches of %d positions" %
+                         (name, report["chunks"], report["stale"], report["sections"], report["dense"],
+                          report["palette"], report["uniform"], report["bytes"] / 1024.0,
+                          report["evicted"], report["evicted_bytes"] / 1024.0, report["walkability"],
+                          report["portals"], report["portal_searches"], report["portal_positions"]))
+        return lines
+
     def dimension_change(self, dimension):
         dim = dimension + 1  # to index from 0
         d = self.dimensions[dim]